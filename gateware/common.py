@@ -1,7 +1,7 @@
 from sys import argv, exit
 from litex.soc.integration.builder import Builder
 from os import system
-from litex.soc.interconnect.csr import CSRStorage
+from litex.soc.interconnect.csr import CSR, CSRStorage
 from migen.genlib.cdc import PulseSynchronizer
 # from numpy import *
 # from matplotlib.pyplot import *
@@ -9,7 +9,25 @@ from migen.genlib.cdc import PulseSynchronizer
 from migen import *
 
 
-def csr_helper(obj, name, regs, cdc=False, pulsed=False, **kwargs):
+def commit_helper(obj, name='commit'):
+    '''
+    add a `commit` CSR for shadow registers
+
+    writing it (value dont matter) pulses the returned signal in the sample
+    clock domain. Pass it as `commit` to csr_helper() for all registers which
+    shall be updated together.
+    '''
+    csr = CSR(name=name)
+    setattr(obj, name, csr)
+    ps = PulseSynchronizer('sys', 'sample')
+    setattr(obj.submodules, name + '_sync', ps)
+    obj.comb += ps.i.eq(csr.re)
+    return ps.o
+
+
+def csr_helper(
+    obj, name, regs, cdc=False, pulsed=False, commit=None, **kwargs
+):
     '''
     handle csr + optional clock domain crossing (cdc) from sys to sample
 
@@ -20,6 +38,11 @@ def csr_helper(obj, name, regs, cdc=False, pulsed=False, **kwargs):
 
     pulsed: instead of latching csr.storage in the sample clock domain,
             make its value valid only for one cycle and zero otherwise
+
+    commit: shadow register mode, overrides cdc and pulsed.
+            A sample clock domain pulse from commit_helper(). csr.storage
+            is only latched when it is asserted, such that all registers
+            sharing the same commit signal change on the same clock edge
     '''
     if type(regs) not in (list, tuple):
         regs = [regs]
@@ -41,7 +64,11 @@ def csr_helper(obj, name, regs, cdc=False, pulsed=False, **kwargs):
             csr.name, len(csr.storage), csr.storage.reset.value
         ))
         setattr(obj, name_, csr)
-        if cdc:
+        if commit is not None:
+            # csr.storage acts as shadow register, it must not change
+            # while commit is in flight through its pulse synchronizer
+            obj.sync.sample += If(commit, reg.eq(csr.storage))
+        elif cdc:
             # csr.storage is fully latched and stable when csr.re is pulsed
             # hence we only need to cross the csr.re pulse into the sample
             # clock domain and then latch csr.storage there once more
@@ -4,23 +4,48 @@ For streaming raw ADC data to memory
 supports a simple trigger state-machine, as you would find it
 on a digital storage oscilloscope
 
+In circular mode (trig_circular = 1), the memories are written
+continuously as a ring buffer once armed, and the acquisition stops
+trig_post samples after the trigger. The trigger sample is at trig_addr,
+the samples before it are in the rest of the buffer.
+
+In segmented mode (trig_segments = n > 0), the memories are split into
+2**n segments. After each trigger, one segment is written and the trigger
+is re-armed in hardware, without software round trip. The sample clock
+counter at each trigger is stored in ts_mem, seg_count counts the
+segments written so far. Not combined with circular mode.
+
+In accumulate mode (acc_count = N > 1), one arming sums N captures
+sample by sample into the memories, re-arming in hardware in between.
+This needs memories wider than N_BITS, the sum of N captures must fit.
+The data are sign extended to the memory width in all modes.
+Not combined with circular mode, with segmented mode each pass of
+2**n segments is summed.
+
 try
 python3 acquisition.py build
+python3 acquisition.py sim
 """
 
 from sys import argv
 
 from migen import *
-from litex.soc.interconnect.csr import AutoCSR, CSR, CSRStorage
+from litex.soc.interconnect.csr import AutoCSR, CSR, CSRStorage, CSRStatus
 from migen.genlib.cdc import PulseSynchronizer
 from migen.genlib.cdc import MultiReg
+from migen.sim import passive
 
 
 class Acquisition(Module, AutoCSR):
-    def __init__(self, mems=None, data_ins=None, N_CHANNELS=1, N_BITS=16):
+    def __init__(self, mems=None, data_ins=None, N_CHANNELS=1, N_BITS=16,
+                 max_segments=64):
         """
         mems
             list of memory objects of length N_CHANNELS
+        max_segments
+            depth of ts_mem, the highest number of segments.
+            Segments must be at least 2 samples long.
+        accumulate mode is only available when mems are wider than N_BITS
         acquisition starts after
           * rising edge on self.trigger
           * data_in of the selected channel crossing trig_level
@@ -38,6 +63,7 @@ class Acquisition(Module, AutoCSR):
 
         if mems is None:
             mems = [Memory(N_BITS, 12) for i in range(N_CHANNELS)]
+        depth = mems[0].depth
 
         trig = Signal()
         # writing trig_csr triggers a single shot acquisition (value dont matter)
@@ -95,36 +121,176 @@ class Acquisition(Module, AutoCSR):
         self.sync.sample += data_trigger_d.eq(data_trigger)
 
         mem_we = Signal()
-        mem_addr = Signal(max=mems[0].depth)
+        mem_addr = Signal(max=depth)
+        mem_addr_next = Signal.like(mem_addr)
+        self.comb += If(mem_addr >= depth - 1,
+            mem_addr_next.eq(0)
+        ).Else(
+            mem_addr_next.eq(mem_addr + 1)
+        )
+
+        # circular (pre-trigger) mode
+        self.trig_circular = CSRStorage(1)
+        circular_ = Signal()
+        self.specials += MultiReg(
+            self.trig_circular.storage, circular_, 'sample'
+        )
+
+        # samples to write after the trigger sample in circular mode
+        self.trig_post = CSRStorage(len(mem_addr), reset=depth // 2)
+        post_ = Signal.like(mem_addr)
+        self.specials += MultiReg(self.trig_post.storage, post_, 'sample')
+
+        # address of the trigger sample
+        trig_addr = Signal.like(mem_addr)
+        self.trig_addr = CSRStatus(len(mem_addr))
+        self.specials += MultiReg(trig_addr, self.trig_addr.status)
+
+        # samples still to be written
+        n_todo = Signal(max=depth + 1)
+
+        # segmented mode: log2(number of segments), 0 = off
+        self.trig_segments = CSRStorage(bits_for(log2_int(max_segments)))
+        segments_ = Signal.like(self.trig_segments.storage)
+        self.specials += MultiReg(
+            self.trig_segments.storage, segments_, 'sample'
+        )
+        seg_len = Signal(max=depth + 1)
+        seg_last = Signal(max=max_segments)
+        circ = Signal()
+        self.comb += [
+            seg_len.eq(depth >> segments_),
+            seg_last.eq((1 << segments_) - 1),
+            circ.eq(circular_ & (segments_ == 0))
+        ]
+
+        # segments written since the last arming
+        seg = Signal(max=max_segments + 1)
+        self.seg_count = CSRStatus(len(seg))
+        self.specials += MultiReg(seg, self.seg_count.status)
+
+        # accumulate mode: number of captures to sum, 0 / 1 = off
+        self.acc_count = CSRStorage(16)
+        acc_count_ = Signal.like(self.acc_count.storage)
+        self.specials += MultiReg(
+            self.acc_count.storage, acc_count_, 'sample'
+        )
+        # captures done since the last arming
+        n_acc = Signal.like(acc_count_)
+        acc_more = Signal()
+        self.comb += acc_more.eq(~circ & (n_acc + 1 < acc_count_))
+
+        # sample clock counter at the trigger of each segment
+        ts = Signal(32)
+        self.sync.sample += ts.eq(ts + 1)
+        self.ts_mem = Memory(32, max_segments)
+        ts_port = self.ts_mem.get_port(
+            write_capable=True, clock_domain="sample"
+        )
+        self.specials += self.ts_mem, ts_port
+        self.comb += [
+            ts_port.adr.eq(seg),
+            ts_port.dat_w.eq(ts)
+        ]
+
         self.submodules.fsm = ClockDomainsRenamer("sample")(FSM())
         self.fsm.act("WAIT_TRIGGER",
-            If(trig, NextState("WAIT_LEVEL"))
+            If(trig,
+                # in circular mode, make sure all samples before the
+                # trigger are written before waiting for it
+                NextValue(n_todo, depth - 1 - post_),
+                NextValue(seg, 0),
+                NextValue(n_acc, 0),
+                If(circ,
+                    NextState("PRE_TRIGGER")
+                ).Else(
+                    NextValue(mem_addr, 0),
+                    NextState("WAIT_LEVEL")
+                )
+            )
+        )
+        self.fsm.act("PRE_TRIGGER",
+            mem_we.eq(1),
+            NextValue(mem_addr, mem_addr_next),
+            NextValue(n_todo, n_todo - 1),
+            If(n_todo <= 1,
+                NextState("WAIT_LEVEL")
+            )
         )
         self.fsm.act("WAIT_LEVEL",
+            If(circ,
+                mem_we.eq(1),
+                NextValue(mem_addr, mem_addr_next)
+            ),
             If(is_trigger,
                 mem_we.eq(1),
-                NextValue(mem_addr, mem_addr + 1),
-                NextState("ACQUIRE")
+                NextValue(mem_addr, mem_addr_next),
+                NextValue(trig_addr, mem_addr),
+                ts_port.we.eq(1),
+                If(circ,
+                    NextValue(n_todo, post_)
+                ).Else(
+                    NextValue(n_todo, seg_len - 1)
+                ),
+                If(circ & (post_ == 0),
+                    NextValue(seg, 1),
+                    NextState("WAIT_TRIGGER")
+                ).Else(
+                    NextState("ACQUIRE")
+                )
             )
         )
         self.fsm.act("ACQUIRE",
             mem_we.eq(1),
-            NextValue(mem_addr, mem_addr + 1),
-            If(mem_addr >= mems[0].depth - 1,
-                NextState("WAIT_TRIGGER"),
-                NextValue(mem_addr, 0)
+            NextValue(mem_addr, mem_addr_next),
+            NextValue(n_todo, n_todo - 1),
+            If(n_todo <= 1,
+                NextValue(seg, seg + 1),
+                If(~circ & (seg < seg_last),
+                    # re-arm for the next segment
+                    NextState("WAIT_LEVEL")
+                ).Elif(acc_more,
+                    # re-arm for the next pass to add up
+                    NextValue(seg, 0),
+                    NextValue(n_acc, n_acc + 1),
+                    NextState("WAIT_LEVEL")
+                ).Else(
+                    NextState("WAIT_TRIGGER")
+                )
             )
         )
         self.sync.sample += self.busy.eq(~self.fsm.ongoing('WAIT_TRIGGER'))
+
+        # Memory writes are delayed by one cycle, such that accumulate mode
+        # can add the old memory content from the read port
+        mem_we_d = Signal()
+        mem_addr_d = Signal.like(mem_addr)
+        acc_add_d = Signal()
+        self.sync.sample += [
+            mem_we_d.eq(mem_we),
+            mem_addr_d.eq(mem_addr),
+            acc_add_d.eq(n_acc > 0)
+        ]
         for mem, data_in in zip(mems, self.data_ins):
             self.specials += mem
             p1 = mem.get_port(write_capable=True, clock_domain="sample")
             self.specials += p1
+            data_d = Signal((mem.width, True))
+            self.sync.sample += data_d.eq(data_in)
             self.comb += [
-                p1.dat_w.eq(data_in),
-                p1.adr.eq(mem_addr),
-                p1.we.eq(mem_we)
+                p1.adr.eq(mem_addr_d),
+                p1.we.eq(mem_we_d)
             ]
+            if mem.width > N_BITS:
+                # an additional read port, costs a copy of the block RAM
+                p2 = mem.get_port(clock_domain="sample")
+                self.specials += p2
+                self.comb += [
+                    p2.adr.eq(mem_addr),
+                    p1.dat_w.eq(Mux(acc_add_d, p2.dat_r + data_d, data_d))
+                ]
+            else:
+                self.comb += p1.dat_w.eq(data_d)
 
 
 def sample_generator(dut):
@@ -137,6 +303,116 @@ def sample_generator(dut):
         yield
 
 
+def run_acquisition(depth=64, period=100, level=50, offset=0, width=14,
+                    **csrs):
+    '''
+    arm once on a sawtooth with `period`, from offset to offset + period - 1,
+    wait for the end of the acquisition and return memory (signed),
+    ts_mem and status CSR contents.
+    csrs: values of CSRStorages, like trig_post=10
+    '''
+    mem = Memory(width, depth)
+    dut = Acquisition([mem], N_BITS=14)
+    res = {}
+
+    def sys_gen():
+        yield dut.trig_level.storage.eq(level)
+        for k, v in csrs.items():
+            yield getattr(dut, k).storage.eq(v)
+        for i in range(10):
+            yield
+        # arm, shortly after a level crossing
+        yield dut.trig_csr.re.eq(1)
+        yield
+        yield dut.trig_csr.re.eq(0)
+        for i in range(10):
+            yield
+        while (yield dut.busy):
+            yield
+        for i in range(10):
+            yield
+        res['trig_addr'] = yield dut.trig_addr.status
+        res['seg_count'] = yield dut.seg_count.status
+        res['mem'] = []
+        for i in range(depth):
+            v = yield mem[i]
+            res['mem'].append(v - (1 << width) if v >> (width - 1) else v)
+        res['ts'] = []
+        for i in range(dut.ts_mem.depth):
+            res['ts'].append((yield dut.ts_mem[i]))
+
+    @passive
+    def sample_gen():
+        t = 0
+        while True:
+            yield dut.data_ins[0].eq((t + 55) % period + offset)
+            t += 1
+            yield
+
+    run_simulation(
+        dut,
+        {"sys": sys_gen(), "sample": sample_gen()},
+        {"sys": 10, "sample": 9}
+    )
+    return res
+
+
+def check_acquisition(circular, post, depth=64, period=100, level=50):
+    '''
+    check that the memory holds the sawtooth contiguously and that the
+    trigger sample is at trig_addr
+    '''
+    res = run_acquisition(
+        depth, period, level, trig_circular=circular, trig_post=post
+    )
+    a = res['trig_addr']
+    # rotate such that the trigger sample is at the end of the pre-trigger
+    # part, like getSamples(rotate=depth - 1 - post) does
+    i_trig = depth - 1 - post if circular else 0
+    buf = [res['mem'][(a - i_trig + k) % depth] for k in range(depth)]
+    expected = [(level + k - i_trig) % period for k in range(depth)]
+    assert buf == expected, (circular, post, a, buf)
+    if not circular:
+        assert a == 0
+    assert res['seg_count'] == 1
+    print('circular={:d} post={:2d}: trig_addr={:2d} OK'.format(
+        circular, post, a
+    ))
+
+
+def check_segments(n, period, depth=64, level=10):
+    '''
+    2**n segments on a sawtooth: each one must start at the trigger and
+    the timestamps must be one period apart
+    '''
+    res = run_acquisition(depth, period, level, trig_segments=n)
+    K = 1 << n
+    L = depth // K
+    expected = [(level + k) % period for k in range(L)] * K
+    assert res['mem'] == expected, (n, res['mem'])
+    assert res['seg_count'] == K
+    ts = res['ts'][:K]
+    assert all(b - a == period for a, b in zip(ts, ts[1:])), ts
+    print('segments={:2d}: dead time {:d} samples OK'.format(
+        K, period - L
+    ))
+
+
+def check_accumulate(N, n=0, depth=64, period=40, level=-60, offset=-80):
+    '''
+    N passes of 2**n segments of a sawtooth with negative values must add
+    up in 32 bit wide memory
+    '''
+    res = run_acquisition(
+        depth, period, level, offset, 32, acc_count=N, trig_segments=n
+    )
+    L = depth >> n
+    seg = [((level - offset + k) % period + offset) * max(N, 1)
+           for k in range(L)]
+    assert res['mem'] == seg * (1 << n), (N, n, res['mem'])
+    print('accumulate={:d} segments={:d}: OK'.format(N, 1 << n))
+
+
 def main():
     dut = Acquisition()
     if "build" in argv:
@@ -158,6 +434,17 @@ def main():
             {"sys": 10, "sample": 9},
             vcd_name=argv[0].replace(".py", ".vcd")
         )
+        check_acquisition(0, 0)
+        for post in (10, 0, 63, 32):
+            check_acquisition(1, post)
+        check_segments(1, period=40)
+        # back to back, no dead time
+        check_segments(2, period=16)
+        # shortest segments, re-armed at every crossing
+        check_segments(5, period=2, level=1)
+        for N in (0, 1, 2, 7):
+            check_accumulate(N)
+        check_accumulate(3, n=2, period=16, level=-70)
 
 
 if __name__ == '__main__':
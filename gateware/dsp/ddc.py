@@ -8,9 +8,9 @@ try:
 from sys import argv
 
 from migen import *
-from litex.soc.interconnect.csr import AutoCSR, CSRStorage
-from migen.genlib.cdc import MultiReg
+from litex.soc.interconnect.csr import AutoCSR
 from .dds import DDS
+from common import csr_helper, commit_helper
 
 
 class VVM_DDC(Module, AutoCSR):
@@ -42,7 +42,7 @@ class VVM_DDC(Module, AutoCSR):
         # host-settable parameters
         # ---------------------------
         # in the sample clock domain
-        self.cic_period = Signal(PCW)  # expected values 33 to 33*128
+        self.cic_period = Signal(PCW, reset=48)  # expected values 33 to 33*128
         self.cic_shift = Signal(4)  # expected values 7 to 15
 
         # ---------------------------
@@ -133,13 +133,13 @@ class VVM_DDC(Module, AutoCSR):
         self.comb += self.result_first.eq(self.result_strobe & ~result_strobe_)
 
     def add_csr(self):
-        self.ddc_deci = CSRStorage(len(self.cic_period), reset=48, name="deci")
-        self.ddc_shift = CSRStorage(len(self.cic_shift), reset=0, name="shift")
-        self.specials += [
-            MultiReg(self.ddc_deci.storage, self.cic_period, 'sample'),
-            MultiReg(self.ddc_shift.storage, self.cic_shift, 'sample')
-        ]
-        self.dds.add_csr()
+        # One `commit` CSR updates decimation, shift and all DDS
+        # shadow registers on the same sample clock edge
+        commit = commit_helper(self)
+        self.commit_pulse = commit
+        csr_helper(self, 'deci', self.cic_period, commit=commit)
+        csr_helper(self, 'shift', self.cic_shift, commit=commit)
+        self.dds.add_csr(commit)
 
 
 def main():
@@ -11,7 +11,7 @@ from litex.soc.interconnect.csr import AutoCSR
 from migen import *
 
 sys.path.append('..')
-from common import csr_helper
+from common import csr_helper, commit_helper
 
 
 class DDS(Module, AutoCSR):
@@ -77,11 +77,17 @@ class DDS(Module, AutoCSR):
 
         self.ftw_ = ftw_
 
-    def add_csr(self):
-        csr_helper(self, 'amp', self.amps, cdc=True, reset=self.AMP_VAL)
-        # Don't need CDC as the FTWs are only latched when update_ftw is pulsed
-        # enable it anyway to stop Vivado from bitching
-        csr_helper(self, 'ftw', self.ftws, cdc=True)
+    def add_csr(self, commit=None):
+        '''
+        commit: shared shadow register commit pulse from commit_helper().
+                If None, the DDS gets its own `commit` CSR.
+        '''
+        if commit is None:
+            commit = commit_helper(self)
+        # amplitudes and FTWs are shadow registers, they need a write to
+        # `commit`. The FTWs are then only used after update_ftw is pulsed
+        csr_helper(self, 'amp', self.amps, commit=commit, reset=self.AMP_VAL)
+        csr_helper(self, 'ftw', self.ftws, commit=commit)
         # DDS_ctrl, action takes place on register write
         # bits:    1 = update_ftw, 0 = reset_phase
         csr_helper(
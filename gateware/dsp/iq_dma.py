@@ -0,0 +1,315 @@
+"""
+    Stream the decimated IQ samples of the DDC into a ring buffer in PS DDR
+
+    The serialized DDC output (I0, Q0, I1, Q1, I2, Q2, I3, Q3) is collected
+    into one frame per decimated sample, crossed into the sys clock domain
+    through an AsyncFIFO and written by an AXI HP port as one 4 beat burst.
+
+    Frame layout in memory, 32 bytes, little endian:
+        int32 I0, Q0, I1, Q1, I2, Q2, I3, Q3
+
+    The ring is `size` bytes at physical address `base`, a multiple of the
+    frame size. The DMA writes at `wr_ptr` (producer pointer, [bytes]) and
+    stops before reaching `rd_ptr` (consumer pointer, written by software).
+    A frame which does not fit into the FIFO any more is dropped and
+    counted in `overflows`. Clearing `enable` resets wr_ptr to 0.
+
+      try:
+        python3 iq_dma.py build / sim
+
+"""
+from sys import argv
+
+from migen import *
+from migen.genlib.fifo import AsyncFIFO
+from migen.genlib.cdc import BusSynchronizer, MultiReg
+from migen.sim import passive
+from litex.soc.interconnect import axi
+from litex.soc.interconnect.csr import AutoCSR, CSRStorage, CSRStatus
+
+
+class IqDma(Module, AutoCSR):
+    def __init__(self, iq_in, strobe_in, first_in, bus=None, N_CH=4,
+                 fifo_depth=64):
+        '''
+        iq_in, strobe_in, first_in:
+            DDC output stream (result_iq, result_strobe, result_first)
+            in the sample clock domain
+
+        bus:
+            AXI HP slave port of the PS in the sys clock domain,
+            like cpu.add_axi_hp_slave(clock_domain="sys")
+        '''
+        if bus is None:
+            bus = axi.AXIInterface(
+                data_width=64, address_width=32, id_width=6, version="axi3"
+            )
+        self.bus = bus
+        W = len(iq_in)
+        n_words = 2 * N_CH
+        n_beats = n_words * 32 // len(bus.w.data)
+        self.FRAME_BYTES = n_words * 4
+
+        self.enable = CSRStorage(1)
+        self.base = CSRStorage(32)
+        self.size = CSRStorage(32)
+        self.rd_ptr = CSRStorage(32)
+        self.wr_ptr = CSRStatus(32)
+        self.overflows = CSRStatus(32)
+
+        ###
+
+        self.submodules.fifo = fifo = ClockDomainsRenamer(
+            {"write": "sample", "read": "sys"}
+        )(AsyncFIFO(n_words * W, fifo_depth))
+
+        # -----------------------------------------------
+        #  sample clock domain: collect one frame
+        # -----------------------------------------------
+        enable_ = Signal()
+        self.specials += MultiReg(self.enable.storage, enable_, 'sample')
+
+        words = [Signal((W, True)) for i in range(n_words)]
+        word_cnt = Signal(max=n_words + 1, reset=n_words)
+        overflows = Signal(32)
+        # all bits of the count have to cross together
+        self.submodules.overflows_sync = BusSynchronizer(
+            len(overflows), "sample", "sys"
+        )
+        self.comb += [
+            self.overflows_sync.i.eq(overflows),
+            self.overflows.status.eq(self.overflows_sync.o)
+        ]
+
+        self.comb += fifo.din.eq(Cat(words))
+        self.sync.sample += [
+            fifo.we.eq(0),
+            If(strobe_in & (word_cnt < n_words),
+                Case(
+                    word_cnt,
+                    {k: w.eq(iq_in) for k, w in enumerate(words)}
+                ),
+                word_cnt.eq(word_cnt + 1)
+            ),
+            # only start collecting on the first word of a frame
+            If(first_in & enable_,
+                words[0].eq(iq_in),
+                word_cnt.eq(1)
+            ),
+            If(strobe_in & (word_cnt == n_words - 1),
+                If(fifo.writable,
+                    fifo.we.eq(1)
+                ).Else(
+                    overflows.eq(overflows + 1)
+                )
+            )
+        ]
+
+        # -----------------------------------------------
+        #  sys clock domain: one AXI burst per frame
+        # -----------------------------------------------
+        wr_ptr = Signal(32)
+        wr_ptr_next = Signal(32)
+        beat = Signal(max=n_beats)
+
+        # IQ words of each data beat, sign extended to 32 bit
+        n = n_words // n_beats
+        ws = [fifo.dout[i * W:(i + 1) * W] for i in range(n_words)]
+        beats = Array(
+            Cat([Cat(w, Replicate(w[-1], 32 - W)) for w in ws[b * n:][:n]])
+            for b in range(n_beats)
+        )
+        self.comb += [
+            self.wr_ptr.status.eq(wr_ptr),
+            If(wr_ptr + self.FRAME_BYTES >= self.size.storage,
+                wr_ptr_next.eq(0)
+            ).Else(
+                wr_ptr_next.eq(wr_ptr + self.FRAME_BYTES)
+            ),
+
+            bus.aw.addr.eq(self.base.storage + wr_ptr),
+            bus.aw.len.eq(n_beats - 1),
+            bus.aw.size.eq(log2_int(len(bus.w.data) // 8)),
+            bus.aw.burst.eq(0b01),  # INCR
+            bus.aw.cache.eq(0b0011),
+            bus.w.strb.eq(2**len(bus.w.strb) - 1),
+            bus.w.last.eq(beat == n_beats - 1),
+            bus.w.data.eq(beats[beat])
+        ]
+
+        self.submodules.fsm = FSM()
+        self.fsm.act("IDLE",
+            If(~self.enable.storage,
+                # discard what is left in the FIFO
+                fifo.re.eq(1),
+                NextValue(wr_ptr, 0)
+            ).Elif(fifo.readable & (wr_ptr_next != self.rd_ptr.storage),
+                NextValue(beat, 0),
+                NextState("ADDRESS")
+            )
+        )
+        self.fsm.act("ADDRESS",
+            bus.aw.valid.eq(1),
+            If(bus.aw.ready,
+                NextState("DATA")
+            )
+        )
+        self.fsm.act("DATA",
+            bus.w.valid.eq(1),
+            If(bus.w.ready,
+                NextValue(beat, beat + 1),
+                If(bus.w.last,
+                    NextState("RESPONSE")
+                )
+            )
+        )
+        self.fsm.act("RESPONSE",
+            bus.b.ready.eq(1),
+            If(bus.b.valid,
+                fifo.re.eq(1),
+                NextValue(wr_ptr, wr_ptr_next),
+                NextState("IDLE")
+            )
+        )
+
+
+def get_iq(i_frame, k):
+    ''' test pattern, positive and negative values '''
+    return (i_frame * 8 + k) * (-1)**k
+
+
+def sample_generator(dut, n_frames, period=24):
+    ''' DDC output stream: 8 words in a row every `period` cycles '''
+    for i in range(n_frames):
+        for k in range(period):
+            yield dut.strobe_in.eq(k < 8)
+            yield dut.first_in.eq(k == 0)
+            yield dut.iq_in.eq(get_iq(i, k) if k < 8 else 0)
+            yield
+
+
+@passive
+def axi_generator(dut, ring):
+    ''' AXI HP port, stores the 32 bit words in `ring` by address '''
+    bus = dut.bus
+    while True:
+        yield bus.aw.ready.eq(1)
+        yield
+        while not (yield bus.aw.valid):
+            yield
+        adr = yield bus.aw.addr
+        yield bus.aw.ready.eq(0)
+        # a slow port
+        for i in range(3):
+            yield
+        yield bus.w.ready.eq(1)
+        while True:
+            yield
+            if (yield bus.w.valid):
+                d = yield bus.w.data
+                ring[adr] = d & 0xFFFFFFFF
+                ring[adr + 4] = d >> 32
+                adr += 8
+                if (yield bus.w.last):
+                    break
+        yield bus.w.ready.eq(0)
+        yield bus.b.valid.eq(1)
+        yield
+        while not (yield bus.b.ready):
+            yield
+        yield bus.b.valid.eq(0)
+
+
+def consumer_generator(dut, ring, frames, n_frames, base, size, n_wait,
+                       res):
+    '''
+    like iq_ring.py: read the frames between rd_ptr and wr_ptr
+    every n_wait cycles
+    '''
+    yield dut.base.storage.eq(base)
+    yield dut.size.storage.eq(size)
+    yield dut.enable.storage.eq(1)
+    rd = 0
+    while len(frames) < n_frames:
+        for i in range(n_wait):
+            yield
+        wr = yield dut.wr_ptr.status
+        while rd != wr:
+            frames.append([ring[base + rd + 4 * k] for k in range(8)])
+            rd = (rd + dut.FRAME_BYTES) % size
+        yield dut.rd_ptr.storage.eq(rd)
+    res['overflows'] = yield dut.overflows.status
+
+
+def check_dma(n_wait, fifo_depth, n_frames=60, vcd_name=None):
+    '''
+    stream frames through a ring of 5 frames, read it every n_wait cycles
+    returns the number of dropped frames
+    '''
+    iq_in = Signal((21, True))
+    strobe_in = Signal()
+    first_in = Signal()
+    dut = IqDma(iq_in, strobe_in, first_in, fifo_depth=fifo_depth)
+    dut.iq_in, dut.strobe_in, dut.first_in = iq_in, strobe_in, first_in
+    ring = {}
+    frames = []
+    res = {}
+    run_simulation(
+        dut,
+        {
+            "sample": sample_generator(dut, 4 * n_frames),
+            "sys": [
+                axi_generator(dut, ring),
+                consumer_generator(
+                    dut, ring, frames, n_frames, 0x1000, 32 * 5, n_wait, res
+                )
+            ]
+        },
+        {"sys": 10, "sample": 9},
+        vcd_name=vcd_name
+    )
+    # complete frames in order, gaps only where frames were dropped
+    frames = [[(v ^ 0x80000000) - 0x80000000 for v in f] for f in frames]
+    i_frames = [f[0] // 8 for f in frames]
+    for i, f in zip(i_frames, frames):
+        assert f == [get_iq(i, k) for k in range(8)], f
+    assert all(b > a for a, b in zip(i_frames, i_frames[1:]))
+    n_dropped = i_frames[-1] - i_frames[0] + 1 - len(frames)
+    assert n_dropped <= res['overflows']
+    print('n_wait={:3d}: {:d} frames OK, {:d} dropped, overflows: {:d}'.format(
+        n_wait, len(frames), n_dropped, res['overflows']
+    ))
+    return n_dropped
+
+
+def main():
+    tName = argv[0].replace('.py', '')
+    if "build" in argv:
+        ''' generate a .v file for simulation with Icarus / general usage '''
+        from migen.fhdl.verilog import convert
+        iq_in = Signal((21, True))
+        strobe_in = Signal()
+        first_in = Signal()
+        dut = IqDma(iq_in, strobe_in, first_in)
+        convert(
+            dut,
+            ios={
+                iq_in, strobe_in, first_in,
+                *[s for ch in (dut.bus.aw, dut.bus.w, dut.bus.b)
+                  for s in ch.flatten()]
+            },
+            display_run=True
+        ).write(tName + '.v')
+        print('wrote', tName + '.v')
+    if "sim" in argv:
+        # consumer keeps up with the DDC
+        assert check_dma(20, 64, vcd_name=tName + '.vcd') == 0
+        # slow consumer and small FIFO, frames must be dropped cleanly
+        assert check_dma(200, 4) > 0
+
+
+if __name__ == '__main__':
+    if len(argv) <= 1:
+        print(__doc__)
+        exit(-1)
+    main()
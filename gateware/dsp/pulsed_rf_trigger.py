@@ -22,7 +22,7 @@ from migen.genlib.cdc import PulseSynchronizer
 from migen.genlib.cdc import MultiReg
 
 sys.path.append('..')
-from common import csr_helper
+from common import csr_helper, commit_helper
 
 
 class PulsedRfTrigger(Module, AutoCSR):
@@ -35,6 +35,9 @@ class PulsedRfTrigger(Module, AutoCSR):
         self.strobe_in = Signal()
         self.strobe_out = Signal()
 
+        # Pulses on the rising edge above threshold, which starts a cycle
+        self.trig_out = Signal()
+
         # 0 - 3: trigger on this channel, > 3: trigger continuously (CW mode)
         self.channel = Signal(3, reset=4)
 
@@ -97,6 +100,7 @@ class PulsedRfTrigger(Module, AutoCSR):
 
         self.fsm.act("WAIT_LEVEL",
             If(mag_edge,
+                self.trig_out.eq(1),
                 NextValue(timer, 0),
                 NextValue(self.trig_count, self.trig_count + 1),
                 NextState("WAIT_PRE"),
@@ -122,11 +126,15 @@ class PulsedRfTrigger(Module, AutoCSR):
         )
 
     def add_csr(self):
-        csr_helper(self, 'channel', self.channel, cdc=True)
-        csr_helper(self, 'threshold', self.threshold, cdc=True)
-        csr_helper(self, 'wait_pre', self.wait_pre, cdc=True)
-        csr_helper(self, 'wait_acq', self.wait_acq, cdc=True)
-        csr_helper(self, 'wait_post', self.wait_post, cdc=True)
+        # Trigger settings are shadow registers, they only take effect
+        # (all at once) after a write to the `commit` CSR
+        commit = commit_helper(self)
+        self.commit_pulse = commit
+        csr_helper(self, 'channel', self.channel, commit=commit)
+        csr_helper(self, 'threshold', self.threshold, commit=commit)
+        csr_helper(self, 'wait_pre', self.wait_pre, commit=commit)
+        csr_helper(self, 'wait_acq', self.wait_acq, commit=commit)
+        csr_helper(self, 'wait_post', self.wait_post, commit=commit)
 
         self.trig_count_csr = CSRStatus(32, name='trig_count')
         self.specials += MultiReg(
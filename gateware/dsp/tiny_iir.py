@@ -54,6 +54,78 @@ class TinyIIR(Module):
         ]
 
 
+class FastSettle(Module):
+    '''
+    Gain schedule for TinyIIR after a restart (retune, new settings)
+
+    Instead of waiting many time constants of the full averaging, the
+    filter starts with shifts = 0 (output = input) and increments shifts
+    each time it had 2**shifts strobes at the current setting, until
+    shifts_target is reached. Like a running mean, the old value is gone
+    after the first strobe and the noise drops about as fast as the
+    averaging allows. The first N_FLUSH + 1 strobes are passed through
+    unaveraged, the CIC needs two decimated samples to flush a retune.
+
+    settled goes high after 2**shifts_target strobes. With enable = 0,
+    shifts stays at shifts_target and settled goes high after
+    2**(shifts_target + N_FIXED) strobes, that's 2**N_FIXED time constants.
+    '''
+    def __init__(self, N_SHIFTS=4, N_FLUSH=2, N_FIXED=3):
+        # Pulse to start the schedule
+        self.restart = Signal()
+        # Pulses after each TinyIIR update (its strobe_out)
+        self.strobe = Signal()
+        self.enable = Signal()
+        self.shifts_target = Signal(N_SHIFTS)
+
+        # goes to TinyIIR.shifts
+        self.shifts = Signal(N_SHIFTS)
+        self.settled = Signal()
+        # strobes since the last restart, saturates
+        self.count = Signal(32)
+
+        ###
+
+        W = (1 << N_SHIFTS) + N_FIXED
+        s = Signal(max=W)
+        s_end = Signal.like(s)
+        # strobes left at shifts = s, 2**s - 1 after a step
+        cnt = Signal(W)
+        msk = Signal(W)
+
+        self.comb += [
+            s_end.eq(self.shifts_target + Mux(self.enable, 0, N_FIXED)),
+            self.settled.eq(s >= s_end),
+            If(self.enable & ~self.settled,
+                self.shifts.eq(s)
+            ).Else(
+                self.shifts.eq(self.shifts_target)
+            )
+        ]
+
+        self.sync += [
+            If(self.restart,
+                s.eq(0),
+                msk.eq(0),
+                cnt.eq(N_FLUSH),
+                self.count.eq(0)
+            ).Elif(self.strobe,
+                If(self.count != 2**32 - 1,
+                    self.count.eq(self.count + 1)
+                ),
+                If(~self.settled,
+                    If(cnt == 0,
+                        s.eq(s + 1),
+                        msk.eq(Cat(1, msk)),
+                        cnt.eq(Cat(1, msk))
+                    ).Else(
+                        cnt.eq(cnt - 1)
+                    )
+                )
+            )
+        ]
+
+
 from random import random
 
 
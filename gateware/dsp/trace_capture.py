@@ -0,0 +1,194 @@
+"""
+    Capture of magnitude / phase traces at the decimated rate
+
+    Stores the PhaseProcessor outputs (before TinyIIR averaging) of
+    every `decimation`-th strobe into one memory per value. Shows how
+    magnitude and phase evolve along a pulse, much longer than the raw
+    sample memories of acquisition.py can cover.
+
+    It goes like this:
+      * Writing `arm` starts waiting for the trigger
+        (a rising edge from PulsedRfTrigger or `force` = 1)
+      * Write `length` entries, then stop
+      * Reading `arm` returns 1 while busy
+
+      try:
+        python3 trace_capture.py build / sim
+
+"""
+import sys
+from sys import argv
+
+from migen import *
+from litex.soc.interconnect.csr import AutoCSR, CSR
+from migen.genlib.cdc import PulseSynchronizer
+from migen.genlib.cdc import MultiReg
+
+sys.path.append('..')
+from common import csr_helper
+
+
+class TraceCapture(Module, AutoCSR):
+    def __init__(self, values_in=None, depth=1024):
+        if values_in is None:
+            values_in = [Signal((6, True)) for i in range(7)]
+        self.values_in = values_in
+
+        # Pulses when values_in are valid
+        self.strobe_in = Signal()
+
+        # Starts the capture when armed
+        self.trigger = Signal()
+
+        # Pulse to wait for the next trigger
+        self.arm = Signal()
+
+        # Start the capture right after arming, without trigger
+        self.force = Signal()
+
+        # Store one out of `decimation` strobes, 0 is treated like 1
+        self.decimation = Signal(16, reset=1)
+
+        # Number of entries to capture
+        self.length = Signal(max=depth + 1, reset=depth)
+
+        self.busy = Signal()
+
+        # One memory for each value, read them through wishbone.SRAM
+        self.mems = [Memory(len(v), depth) for v in values_in]
+
+        ###
+
+        adr = Signal(max=depth)
+        we = Signal()
+        dec_cnt = Signal.like(self.decimation)
+
+        for mem, v in zip(self.mems, values_in):
+            port = mem.get_port(write_capable=True, clock_domain="sample")
+            self.specials += mem, port
+            self.comb += [
+                port.adr.eq(adr),
+                port.dat_w.eq(v),
+                port.we.eq(we)
+            ]
+
+        self.submodules.fsm = ClockDomainsRenamer("sample")(FSM())
+        self.fsm.act("IDLE",
+            If(self.arm,
+                NextState("WAIT_TRIGGER")
+            )
+        )
+        self.fsm.act("WAIT_TRIGGER",
+            If(self.trigger | self.force,
+                NextValue(adr, 0),
+                NextValue(dec_cnt, 0),
+                NextState("CAPTURE")
+            )
+        )
+        self.fsm.act("CAPTURE",
+            If(self.strobe_in,
+                If(dec_cnt == 0,
+                    we.eq(1),
+                    NextValue(adr, adr + 1),
+                    NextValue(dec_cnt, self.decimation - 1),
+                    If((self.decimation == 0) | (self.decimation == 1),
+                        NextValue(dec_cnt, 0)
+                    ),
+                    If(adr >= self.length - 1,
+                        NextState("IDLE")
+                    )
+                ).Else(
+                    NextValue(dec_cnt, dec_cnt - 1)
+                )
+            )
+        )
+        self.comb += self.busy.eq(~self.fsm.ongoing('IDLE'))
+
+    def add_csr(self):
+        # writing arm starts a capture, reading it returns 1 while busy
+        self.arm_csr = CSR(name='arm')
+        self.specials += MultiReg(self.busy, self.arm_csr.w)
+        self.submodules.arm_sync = PulseSynchronizer("sys", "sample")
+        self.comb += [
+            self.arm_sync.i.eq(self.arm_csr.re),
+            self.arm.eq(self.arm_sync.o)
+        ]
+        csr_helper(self, 'force', self.force, cdc=True)
+        csr_helper(self, 'decimation', self.decimation, cdc=True)
+        csr_helper(self, 'length', self.length, cdc=True)
+
+
+def sample_generator(dut, res):
+    ''' ramp on all values, strobe every 3 cycles '''
+    yield dut.decimation.eq(4)
+    yield dut.length.eq(10)
+    t = 0
+
+    def tick(n=1):
+        nonlocal t
+        for i in range(n):
+            yield dut.strobe_in.eq(t % 3 == 0)
+            if t % 3 == 0:
+                for k, v in enumerate(dut.values_in):
+                    yield v.eq((t // 3 + k) % 32)
+            yield
+            t += 1
+
+    yield from tick(10)
+    yield dut.arm.eq(1)
+    yield from tick()
+    yield dut.arm.eq(0)
+    yield from tick(30)
+    # the first strobe after the trigger carries 14
+    yield dut.trigger.eq(1)
+    yield from tick()
+    yield dut.trigger.eq(0)
+    while (yield dut.busy):
+        yield from tick()
+    for mem in dut.mems:
+        res.append([])
+        for i in range(10):
+            res[-1].append((yield mem[i]))
+
+
+def main():
+    tName = argv[0].replace('.py', '')
+    dut = TraceCapture()
+    if "build" in argv:
+        ''' generate a .v file for simulation with Icarus / general usage '''
+        from migen.fhdl.verilog import convert
+        convert(
+            dut,
+            ios={
+                *dut.values_in,
+                dut.strobe_in,
+                dut.trigger,
+                dut.arm,
+                dut.force,
+                dut.decimation,
+                dut.length,
+                dut.busy
+            },
+            display_run=True
+        ).write(tName + '.v')
+        print('wrote', tName + '.v')
+    if "sim" in argv:
+        res = []
+        run_simulation(
+            dut,
+            {"sample": sample_generator(dut, res)},
+            {"sample": 10},
+            vcd_name=tName + '.vcd'
+        )
+        print('wrote', tName + '.vcd')
+        for k, r in enumerate(res):
+            expected = [(14 + 4 * i + k) % 32 for i in range(10)]
+            assert r == expected, (k, r, expected)
+        print('trace check OK')
+
+
+if __name__ == '__main__':
+    if len(argv) <= 1:
+        print(__doc__)
+        exit(-1)
+    main()
@@ -10,15 +10,18 @@ from os.path import join, dirname, abspath, basename
 
 from migen import *
 from migen.genlib.misc import timeline
-from migen.genlib.cdc import BlindTransfer, MultiReg
-from litex.soc.interconnect.csr import AutoCSR, CSRStorage, CSRStatus
+from migen.genlib.cdc import BlindTransfer, BusSynchronizer, MultiReg, \
+    PulseSynchronizer
+from litex.soc.interconnect.csr import AutoCSR, CSR, CSRStorage, CSRStatus
 from litex.soc.cores.freqmeter import FreqMeter
 
 from .dds import DDS
 from .ddc import VVM_DDC
 from .phase_processor import PhaseProcessor
-from .tiny_iir import TinyIIR
+from .tiny_iir import TinyIIR, FastSettle
 from .pulsed_rf_trigger import PulsedRfTrigger
+from .trace_capture import TraceCapture
+from common import csr_helper
 
 
 class VVM_DSP(Module, AutoCSR):
@@ -65,6 +68,9 @@ class VVM_DSP(Module, AutoCSR):
         self.adcs = adcs
         n_ch = len(adcs)
         self.iir_shift = Signal(6)
+        # FastSettle controls: gain schedule on, restart it
+        self.iir_fast = Signal()
+        self.iir_restart = Signal()
 
         # outputs
         self.mags_iir = [
@@ -74,6 +80,9 @@ class VVM_DSP(Module, AutoCSR):
             Signal((self.W_PHASE, True), name='phase') for i in range(n_ch)
         ]
         self.strobe_out = Signal()
+        # averaging settled since the last restart, strobes since then
+        self.iir_settled = Signal()
+        self.iir_count = Signal(32)
 
         ###
 
@@ -131,9 +140,36 @@ class VVM_DSP(Module, AutoCSR):
         self.submodules.pulse = PulsedRfTrigger(self.pp.mags)
         self.comb += [self.pulse.strobe_in.eq(self.pp.strobe_out)]
 
+        # -----------------------------------------------
+        #  trace_capture.py
+        # -----------------------------------------------
+        # mags and relative phases of every strobe, before averaging
+        self.submodules.trace = TraceCapture(self.pp.mags + self.pp.phases[1:])
+        self.comb += [
+            self.trace.strobe_in.eq(self.pp.strobe_out),
+            self.trace.trigger.eq(self.pulse.trig_out)
+        ]
+
         # -----------------------------------------------
         #  IIR lowpass filter for result averaging
         # -----------------------------------------------
+        # After a restart, ramp up the averaging of the REF magnitude
+        # (all strobes) and of the other channels (gated strobes)
+        settles = []
+        for i in range(2):
+            settle = ClockDomainsRenamer('sample')(FastSettle())
+            self.comb += [
+                settle.restart.eq(self.iir_restart),
+                settle.enable.eq(self.iir_fast),
+                settle.shifts_target.eq(self.iir_shift)
+            ]
+            settles.append(settle)
+        self.submodules.settle_ref, self.submodules.settle = settles
+        self.comb += [
+            self.iir_settled.eq(self.settle_ref.settled & self.settle.settled),
+            self.iir_count.eq(self.settle.count)
+        ]
+
         for i, (m, mi) in enumerate(zip(
             self.pp.mags + self.pp.phases,
             self.mags_iir + self.phases_iir
@@ -148,10 +184,14 @@ class VVM_DSP(Module, AutoCSR):
 
             # Watch out for DC errors for shifts > 31
             iir = ClockDomainsRenamer('sample')(TinyIIR(w))
+            settle = self.settle_ref if i == 0 else self.settle
+            if i <= 1:
+                # shifts change after the update of the filters
+                self.comb += settle.strobe.eq(iir.strobe_out)
             self.sync.sample += [
                 iir.x.eq(m),
                 mi.eq(iir.y),
-                iir.shifts.eq(self.iir_shift),
+                iir.shifts.eq(settle.shifts),
                 # channel 0 = REF magnitude is always CW, never triggered!
                 iir.strobe.eq(
                     self.pp.strobe_out if i == 0 else self.pulse.strobe_out
@@ -166,6 +206,7 @@ class VVM_DSP(Module, AutoCSR):
         self.ddc.add_csr()
         self.pp.add_csr()
         self.pulse.add_csr()
+        self.trace.add_csr()
 
         # sys clock domain
         n_ch = len(self.adcs)
@@ -186,6 +227,33 @@ class VVM_DSP(Module, AutoCSR):
         # IIR controls
         self.iir = CSRStorage(len(self.iir_shift))
         self.specials += MultiReg(self.iir.storage, self.iir_shift, 'sample')
+
+        # Averaging settles again after each DDC or pulse commit and
+        # on writing iir_restart (after a phase reset for example)
+        csr_helper(self, 'iir_fast', self.iir_fast, cdc=True)
+        self.iir_restart_csr = CSR(name='iir_restart')
+        self.submodules.iir_restart_sync = PulseSynchronizer("sys", "sample")
+        self.comb += [
+            self.iir_restart_sync.i.eq(self.iir_restart_csr.re),
+            self.iir_restart.eq(
+                self.iir_restart_sync.o |
+                self.ddc.commit_pulse |
+                self.pulse.commit_pulse
+            )
+        ]
+        self.iir_settled_csr = CSRStatus(1, name='iir_settled')
+        self.iir_count_csr = CSRStatus(32, name='iir_count')
+        self.specials += MultiReg(
+            self.iir_settled, self.iir_settled_csr.status
+        )
+        # all bits of the count have to cross together
+        self.submodules.iir_count_sync = BusSynchronizer(
+            len(self.iir_count), "sample", "sys"
+        )
+        self.comb += [
+            self.iir_count_sync.i.eq(self.iir_count),
+            self.iir_count_csr.status.eq(self.iir_count_sync.o)
+        ]
         self.comb += [
             self.cdc.data_i.eq(Cat(self.mags_iir + self.phases_iir)),
             self.cdc.i.eq(self.strobe_out),
@@ -280,11 +348,15 @@ def main():
                 d.ddc.cic_shift,
                 *d.ddc.dds.ftws,
                 d.iir_shift,
+                d.iir_fast,
+                d.iir_restart,
                 d.ddc.dds.update_ftw,
                 *d.pp.mult_factors,
                 # Outputs
                 *d.mags_iir,
-                *d.phases_iir
+                *d.phases_iir,
+                d.iir_settled,
+                d.iir_count
             },
             display_run=False
         ).write(tName + '.v')
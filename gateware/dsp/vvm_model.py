@@ -0,0 +1,624 @@
+'''
+Fixed-point NumPy model of the VVM_DSP signal chain
+
+    adcs -> DDS / mixer -> CIC -> CORDIC -> PhaseProcessor
+         -> PulsedRfTrigger -> TinyIIR -> mag* / phase* CSR values
+
+Takes 4 channels of 14 bit ADC samples and the same register settings as
+the gateware, so the effect of deci, shift, iir, ... can be evaluated
+offline on long records. Processes several MSamples / s.
+
+The migen blocks (PhaseProcessor, PulsedRfTrigger, TinyIIR, FastSettle) are
+modeled cycle accurate and bit exact, `check` compares them against
+run_simulation(). The bedrock verilog blocks (cordicg_b22, mixer,
+cic_multichannel) are modeled from their arithmetic: LO and CORDIC are
+textbook CORDICs of the same widths and may differ by a few LSBs from the
+verilog, vvm_dsp_tb.v remains the reference for them.
+
+try:
+    python3 -m dsp.vvm_model check
+    python3 -m dsp.vvm_model bench
+    python3 -m dsp.vvm_model settle
+'''
+from sys import argv
+from numpy import *
+
+# Widths and constants of VVM_DSP / VVM_DDC
+DW = 14          # ADC samples
+OSCW = 18        # LO
+DAVR = 4         # mixer guard bits
+MIX_W = DW + DAVR
+DI_W = 37        # CIC integrators
+W_CORDIC = 21    # IQ stream, magnitude
+W_PHASE = W_CORDIC + 1
+CC_SHIFT_BASE = 7
+DI_NOISE_BITS = 1
+IIR_N_SHIFTS = 4
+IIR_GUARD = (1 << IIR_N_SHIFTS) - 1
+SETTLE_FLUSH = 2
+SETTLE_FIXED = 3
+
+# DDS default amplitude, compensates the CORDIC gain
+AMP_VAL = int((1 << (OSCW - 1)) / 1.65)
+
+
+def wrap(x, w):
+    ''' two's complement wrap-around of int64 array x to w bits '''
+    return ((x + (1 << (w - 1))) & ((1 << w) - 1)) - (1 << (w - 1))
+
+
+def cordic_gain(n_stg):
+    return prod(sqrt(1 + 2.0**(-2 * arange(n_stg))))
+
+
+def cordic_vector(x, y, n_stg=W_CORDIC, w_phase=W_PHASE):
+    '''
+    rectangular to polar, int64 arrays
+    returns magnitude (times the CORDIC gain)
+    and phase (2**(w_phase - 1) = pi)
+    '''
+    x = array(x, int64)
+    y = array(y, int64)
+    z = zeros_like(x)
+    # bring into the right half plane, a rotation by 180 degree is exact
+    neg = x < 0
+    x[neg] *= -1
+    y[neg] *= -1
+    z[neg] = 1 << (w_phase - 1)
+    for i in range(n_stg):
+        atan_i = int(round(arctan(2.0**-i) / pi * (1 << (w_phase - 1))))
+        d = where(y >= 0, 1, -1)
+        x, y = x + d * (y >> i), y - d * (x >> i)
+        z += d * atan_i
+    return x, wrap(z, w_phase)
+
+
+_lo_tables = {}
+
+
+def get_lo_table(amp=AMP_VAL):
+    '''
+    cos and sin output of the DDS CORDIC
+    for each of the 2**(OSCW + 1) phase accumulator MSB values
+    '''
+    if amp not in _lo_tables:
+        p = arange(1 << (OSCW + 1)) * (2 * pi / (1 << (OSCW + 1)))
+        a = amp * cordic_gain(OSCW + 2)
+        _lo_tables[amp] = (
+            floor(a * cos(p) + 0.5).astype(int64),
+            floor(a * sin(p) + 0.5).astype(int64)
+        )
+    return _lo_tables[amp]
+
+
+def phase_processor(mags, phases, mults):
+    '''
+    mags, phases: (N, 4) CORDIC outputs
+    mults: 3 reference phase multiplication factors
+    returns phases (N, 4): REF phase and P_IN0 * MULT - P_IN_N
+    '''
+    out = array(phases, int64)
+    for i, m in enumerate(mults):
+        out[:, i + 1] = wrap(out[:, 0] * (m & 0xF) - out[:, i + 1], W_PHASE)
+    return mags, out
+
+
+class PulsedRfTriggerModel:
+    '''
+    gates the strobes like PulsedRfTrigger.
+    Times are sample clock cycles, the FSM state carries over calls.
+    '''
+    def __init__(self, channel=4, threshold=0x10110C, wait_pre=7,
+                 wait_acq=1024, wait_post=8):
+        self.channel = channel
+        self.threshold = threshold
+        self.wait_pre = wait_pre
+        self.wait_acq = wait_acq
+        self.wait_post = wait_post
+        self.trig_count = 0
+        self.mag_d = 0
+        # After reset, the FSM is in ACQUIRE: it is the first state
+        # mentioned (by fsm.ongoing()) and gets encoding 0
+        self.acq_start = 0
+        self.acq_end = wait_acq
+        # FSM is in WAIT_LEVEL from this cycle on
+        self.level_from = self.acq_end + wait_post + 2
+
+    def run(self, ts, mags):
+        '''
+        ts: cycles of the strobes, ascending
+        mags: (N, 4) magnitudes at the strobes
+        returns a bool array, True for the strobes passed downstream
+        '''
+        if self.channel > 3:
+            return ones(len(ts), bool)
+        gated = zeros(len(ts), bool)
+        thr = self.threshold
+        for k, (t, mag) in enumerate(zip(ts.tolist(),
+                                         mags[:, self.channel].tolist())):
+            gated[k] = self.acq_start <= t <= self.acq_end
+            edge = self.mag_d < thr <= mag
+            self.mag_d = mag
+            # mag_edge is registered, the FSM sees it one cycle later
+            if edge and t + 1 >= self.level_from:
+                self.trig_count += 1
+                # WAIT_PRE from t + 2 for wait_pre + 1 cycles, and so on
+                self.acq_start = t + 2 + self.wait_pre + 1
+                self.acq_end = self.acq_start + self.wait_acq
+                self.level_from = self.acq_end + self.wait_post + 2
+        return gated
+
+
+def fast_settle(n_done, n, iir, fast=True):
+    '''
+    FastSettle for the n strobes after the first n_done since the restart
+    returns the TinyIIR shifts of each strobe and `settled` after it
+    '''
+    iir &= (1 << IIR_N_SHIFTS) - 1
+    s_end = iir if fast else iir + SETTLE_FIXED
+    # s steps up after 1 + SETTLE_FLUSH, 2, 4, 8, .. strobes
+    j = arange(n_done, n_done + n + 1)
+    s = floor(log2(maximum(j - SETTLE_FLUSH + 1, 1))).astype(int64)
+    s = minimum(s, s_end)
+    shifts = minimum(s[:-1], iir) if fast else full(n, iir)
+    return shifts, s[1:] >= s_end
+
+
+def tiny_iir(xs, shifts, io_w, acc=None):
+    '''
+    TinyIIR on the strobes of each column of xs (N, n_ch)
+    shifts: scalar or one value per strobe
+    acc: accumulators of a previous call
+    returns the outputs after each strobe and the accumulators
+    '''
+    shifts = broadcast_to(
+        asarray(shifts) & ((1 << IIR_N_SHIFTS) - 1), len(xs)
+    ).tolist()
+    acc_w = io_w + IIR_GUARD
+    xs = wrap(array(xs, int64), io_w) << IIR_GUARD
+    if acc is None:
+        acc = zeros(xs.shape[1], int64)
+    acc = [int(a) for a in acc]
+    ys = empty_like(xs)
+    lim = 1 << (acc_w - 1)
+    msk = (1 << acc_w) - 1
+    for k, x_hr in enumerate(xs.tolist()):
+        for c, x in enumerate(x_hr):
+            a = acc[c] + ((x - acc[c]) >> shifts[k])
+            acc[c] = ((a + lim) & msk) - lim
+        ys[k] = acc
+    return ys >> IIR_GUARD, array(acc, int64)
+
+
+class VvmModel:
+    '''
+    the whole chain, parameters named like the CSRs
+
+    process() can be called repeatedly on consecutive blocks of samples,
+    the state of the accumulators, filters and trigger carries over.
+    restart() starts the FastSettle schedule, like a DDC commit.
+    '''
+    def __init__(self, deci=100, shift=2, ftws=(1, 1, 1, 1),
+                 amps=(AMP_VAL,) * 4, mults=(1, 1, 1), iir=10, channel=4,
+                 threshold=0x10110C, wait_pre=7, wait_acq=1024, wait_post=8,
+                 iir_fast=0):
+        self.deci = deci
+        self.shift = shift
+        self.ftws = ftws
+        self.amps = amps
+        self.mults = mults
+        self.iir = iir
+        self.iir_fast = iir_fast
+        self.trigger = PulsedRfTriggerModel(
+            channel, threshold, wait_pre, wait_acq, wait_post
+        )
+        # samples processed so far, DDS phases start at 0
+        self.n = 0
+        # integrator states and last two decimated values, uint64 which
+        # wraps around like the DI_W bit integrators do
+        self.i1 = zeros(8, uint64)
+        self.i2 = zeros(8, uint64)
+        self.dd = zeros((2, 8), uint64)
+        self.acc_ref = None
+        self.acc = None
+        # strobes since the last restart, REF magnitude and gated ones.
+        # Like after power up, settling starts with the first strobes
+        self.n_ref = 0
+        self.n_gated = 0
+
+    def restart(self):
+        self.n_ref = 0
+        self.n_gated = 0
+
+    def ddc(self, adcs):
+        '''
+        adcs: (N, 4) signed ADC samples
+        returns the decimated sample cycles and IQ (M, 8) [I0, Q0, I1, ..]
+        '''
+        # channels in rows, the cumsums run on contiguous memory
+        adcs = asarray(adcs, int64).T
+        N = adcs.shape[1]
+        ns = arange(self.n, self.n + N, dtype=uint64)
+        mix = empty((8, N), int64)
+        for i in range(4):
+            phase = (ns * uint64(self.ftws[i])) & uint64(0xFFFFFFFF)
+            lo_cos, lo_sin = get_lo_table(self.amps[i])
+            idx = (phase >> uint64(32 - OSCW - 1)).astype(intp)
+            multiply(adcs[i], lo_cos[idx], out=mix[2 * i])
+            multiply(adcs[i], lo_sin[idx], out=mix[2 * i + 1])
+        mix >>= DW + OSCW - MIX_W - 1
+
+        # double integrator, sampled every deci cycles. The second
+        # integrator is only needed at the sampling points
+        c1 = cumsum(mix.view(uint64), axis=1)
+        c1 += self.i1[:, None]
+        i0 = (-self.n - 1) % self.deci
+        js = arange(i0, N, self.deci)
+        if len(js) > 0:
+            starts = concatenate([[0], js[:-1] + 1])
+            c2 = cumsum(add.reduceat(c1[:, :js[-1] + 1], starts, 1), 1)
+            c2 += self.i2[:, None]
+        else:
+            c2 = zeros((8, 0), uint64)
+        self.i2 = self.i2 + c1.sum(1)
+        self.i1 = c1[:, -1].copy()
+        ts = js + self.n
+        v = concatenate([self.dd, c2.T])
+        self.dd = v[-2:].copy()
+        self.n += N
+
+        # double difference, then drop the LSBs and saturate
+        d = v[2:] - 2 * v[1:-1] + v[:-2]
+        d = wrap(d.view(int64), DI_W)
+        d >>= CC_SHIFT_BASE + DI_NOISE_BITS + self.shift
+        lim = 1 << (W_CORDIC - 1)
+        return ts, clip(d, -lim, lim - 1)
+
+    def process(self, adcs):
+        '''
+        adcs: (N, 4) signed ADC samples
+        returns a dict of arrays, one row per CSR update
+          mags, phases: (M, 4) CSR values
+          mags_pp, phases_pp: (K, 4) PhaseProcessor outputs of all strobes
+          ts: sample cycle of each CSR update
+          settled: iir_settled CSR after each update
+        '''
+        ts, iq = self.ddc(adcs)
+        mags, phases = cordic_vector(iq[:, 0::2], iq[:, 1::2])
+        mags &= (1 << W_CORDIC) - 1
+        mags, phases = phase_processor(mags, phases, self.mults)
+        gated = self.trigger.run(ts, mags)
+
+        # REF magnitude filter sees all strobes, the others the gated ones
+        n_gated = count_nonzero(gated)
+        sh_ref, settled_ref = fast_settle(
+            self.n_ref, len(mags), self.iir, self.iir_fast
+        )
+        sh, settled = fast_settle(
+            self.n_gated, n_gated, self.iir, self.iir_fast
+        )
+        self.n_ref += len(mags)
+        self.n_gated += n_gated
+        ref, self.acc_ref = tiny_iir(
+            mags[:, :1], sh_ref, W_CORDIC, self.acc_ref
+        )
+        ys_mag, acc_mag = tiny_iir(
+            mags[gated, 1:], sh, W_CORDIC,
+            None if self.acc is None else self.acc[:3]
+        )
+        ys_ph, acc_ph = tiny_iir(
+            phases[gated, 1:], sh, W_PHASE,
+            None if self.acc is None else self.acc[3:]
+        )
+        self.acc = concatenate([acc_mag, acc_ph])
+
+        # the CSRs are updated with the gated strobes
+        mags_csr = concatenate([ref[gated], ys_mag], 1) & ((1 << 21) - 1)
+        phases_csr = concatenate(
+            [phases[gated, :1], ys_ph], 1
+        ) & 0xFFFFFFFF
+        return {
+            'ts': ts[gated],
+            'settled': settled & settled_ref[gated],
+            'mags': mags_csr,
+            'phases': phases_csr,
+            'mags_pp': mags,
+            'phases_pp': phases
+        }
+
+
+# -------------------------------------------------------------------------
+#  Cross check against migen simulation
+# -------------------------------------------------------------------------
+def check_tiny_iir():
+    from migen import run_simulation
+    from .tiny_iir import TinyIIR
+
+    random.seed(0)
+    W = 21
+    xs = random.randint(-(1 << (W - 1)), 1 << (W - 1), 300)
+    xs[100:200] = (1 << (W - 1)) - 1
+    ys_sim = []
+
+    for shifts in (0, 3, 9):
+        dut = TinyIIR(W)
+
+        def tb():
+            yield dut.shifts.eq(shifts)
+            for x in xs:
+                yield dut.x.eq(int(x))
+                yield dut.strobe.eq(1)
+                yield
+                yield dut.strobe.eq(0)
+                yield
+                yield
+                yield
+                ys_sim.append((yield dut.y))
+
+        run_simulation(dut, tb())
+        ys, _ = tiny_iir(xs[:, None], shifts, W)
+        if not array_equal(ys[:, 0], ys_sim[-len(xs):]):
+            raise AssertionError('TinyIIR, shifts = {:d}'.format(shifts))
+    print('TinyIIR: {:d} outputs match'.format(len(ys_sim)))
+
+
+def check_fast_settle():
+    from migen import run_simulation
+    from .tiny_iir import FastSettle
+
+    # enable, shifts_target, strobes after the restart
+    runs = ((1, 5, 70), (1, 0, 5), (0, 2, 50), (1, 9, 300), (0, 0, 20))
+    for fast, iir, n in runs:
+        dut = FastSettle()
+        res = []
+
+        def tb():
+            yield dut.enable.eq(fast)
+            yield dut.shifts_target.eq(iir)
+            # some strobes before the restart must not matter
+            for i in range(3):
+                yield dut.strobe.eq(1)
+                yield
+                yield dut.strobe.eq(0)
+                yield
+            yield dut.restart.eq(1)
+            yield
+            yield dut.restart.eq(0)
+            yield
+            for i in range(n):
+                sh = yield dut.shifts
+                yield dut.strobe.eq(1)
+                yield
+                yield dut.strobe.eq(0)
+                yield
+                res.append((sh, (yield dut.settled)))
+            res.append((yield dut.count))
+
+        run_simulation(dut, tb())
+        shifts, settled = fast_settle(0, n, iir, fast)
+        assert res.pop() == n
+        if not array_equal(res, stack([shifts, settled], 1)):
+            raise AssertionError('FastSettle, {:}'.format((fast, iir)))
+    print('FastSettle: {:d} schedules match'.format(len(runs)))
+
+
+def check_phase_processor():
+    from migen import run_simulation
+    from .phase_processor import PhaseProcessor
+
+    random.seed(1)
+    N = 50
+    mags = random.randint(0, 1 << W_CORDIC, (N, 4))
+    phases = random.randint(-(1 << W_CORDIC), 1 << W_CORDIC, (N, 4))
+    mults = (3, 15, 7)
+    dut = PhaseProcessor()
+    lat_cordic = W_CORDIC + 2
+    T = 60
+    outs = []
+
+    def tb():
+        for i, m in enumerate(mults):
+            yield dut.mult_factors[i].eq(m)
+        for t in range(N * T + 2 * T):
+            k, c = divmod(t, T)
+            yield dut.strobe_in.eq(int(c == 0 and k < N))
+            # CORDIC output stream of the strobe before
+            c -= lat_cordic
+            if 0 <= k < N and 0 <= c < 8:
+                yield dut.mag_in.eq(int(mags[k, c // 2]))
+                yield dut.phase_in.eq(int(phases[k, c // 2]))
+            if (yield dut.strobe_out):
+                out = []
+                for sig in dut.mags + dut.phases:
+                    out.append((yield sig))
+                outs.append(out)
+            yield
+
+    run_simulation(dut, tb())
+    mags_m, phases_m = phase_processor(mags, phases, mults)
+    assert len(outs) == N
+    assert array_equal(outs, concatenate([mags_m, phases_m], 1))
+    print('PhaseProcessor: {:d} outputs match'.format(N))
+
+
+def check_pulsed_rf_trigger():
+    from migen import run_simulation, Signal
+    from .pulsed_rf_trigger import PulsedRfTrigger
+
+    random.seed(2)
+    W = 21
+    N = 400
+    T = 13  # cycles between strobes
+    mags = random.randint(0, 16, (N, 4))
+    # pulses on channel 2
+    for i in random.randint(0, N - 10, 30):
+        mags[i:i + random.randint(1, 10), 2] = 1000
+
+    for ch, pre, acq, post in ((2, 3, 40, 5), (2, 0, 0, 0), (2, 20, 7, 90),
+                               (6, 0, 0, 0)):
+        dut = PulsedRfTrigger([Signal(W) for i in range(4)])
+        strobes = []
+
+        def tb():
+            yield dut.channel.eq(ch)
+            yield dut.threshold.eq(500)
+            yield dut.wait_pre.eq(pre)
+            yield dut.wait_acq.eq(acq)
+            yield dut.wait_post.eq(post)
+            yield
+            for t in range(N * T + 2):
+                k, c = divmod(t, T)
+                if k < N:
+                    for i in range(4):
+                        yield dut.mags_in[i].eq(int(mags[k, i]))
+                yield dut.strobe_in.eq(int(c == 1 and k < N))
+                if (yield dut.strobe_out):
+                    strobes.append(k - (c == 0))
+                yield
+            strobes.append((yield dut.trig_count))
+
+        run_simulation(dut, {'sample': tb()}, {'sample': 10})
+        m = PulsedRfTriggerModel(ch, 500, pre, acq, post)
+        # strobe k is sampled on clock edge k * T + 3, counting from reset
+        gated = m.run(arange(N) * T + 3, mags)
+        assert strobes[-1] == m.trig_count, (strobes[-1], m.trig_count)
+        assert array_equal(strobes[:-1], flatnonzero(gated)), ch
+    print('PulsedRfTrigger: matches')
+
+
+def check_chain():
+    ''' sanity check of the whole model with the vvm_dsp_tb signals '''
+    fs = 117.6e6
+    f_ref = 25e6
+    N = 200000
+    n = arange(N)
+    thetas = (0, 0, 2 / 3 * pi, 4 / 3 * pi)
+    adcs = stack([
+        (((1 << 13) - 1) * sin(2 * pi * f_ref / fs * n + th)).astype(int64)
+        for th in thetas
+    ], 1)
+    ftw = int((f_ref + 10e3) / fs * 2**32)
+    m = VvmModel(deci=100, shift=2, ftws=(ftw,) * 4, mults=(1, 1, 1), iir=2)
+    r = m.process(adcs)
+
+    # the same in blocks, the state must carry over
+    m = VvmModel(deci=100, shift=2, ftws=(ftw,) * 4, mults=(1, 1, 1), iir=2)
+    rs = [m.process(adcs[i:i + 33333]) for i in range(0, N, 33333)]
+    for k in r:
+        assert array_equal(r[k], concatenate([r_[k] for r_ in rs])), k
+
+    # last CSR values in degrees, like vvm_helpers.get_phases()
+    ph = wrap(r['phases'][-1].astype(int64), 32)[1:] / (1 << 21) * 180
+    expected = degrees(array(thetas[1:]))
+    err = (ph - expected + 180) % 360 - 180
+    assert all(abs(err) < 0.1), ph
+    mag = r['mags'][-1] / (1 << 21) * (1 << (2 - 1))
+    print('chain: {:d} CSR updates, mags {:s} dBFS, phases {:s} deg'.format(
+        len(r['mags']), str(around(20 * log10(mag), 2)), str(around(ph, 2))
+    ))
+
+
+def bench():
+    from time import perf_counter
+    random.seed(3)
+    N = 1 << 21
+    adcs = random.randint(-(1 << 13), 1 << 13, (N, 4))
+    for deci, iir in ((100, 10), (1000, 13)):
+        m = VvmModel(deci=deci, iir=iir, ftws=(0x12345678,) * 4)
+        ts = perf_counter()
+        for i in range(0, N, 1 << 18):
+            m.process(adcs[i:i + (1 << 18)])
+        dt = perf_counter() - ts
+        print('deci {:4d}: {:.1f} MSamples / s (x 4 channels)'.format(
+            deci, N / dt / 1e6
+        ))
+
+
+def settle(fs=117.6e6, deci=100, block=1 << 20):
+    '''
+    retune to valid reading latency, fixed vs. fast settling TinyIIR.
+    A settled reading of a -34 dBFS, 25 MHz tone, then a step to 30 MHz,
+    -6 dB and new phases with a DDC retune. The reading is valid once all
+    later CSR values stay within 0.01 dB and 0.05 deg of their final
+    values. Prints for deci = 100:
+
+    iir  mode   valid [strobes]  [ms]   settled [strobes]  [ms]
+     10  fixed            7583   6.45              8192   6.97
+     10  fast              152   0.13              1024   0.87
+     ..
+     13  fixed           60189  51.18             65536  55.73
+     13  fast              151   0.13              8192   6.97
+    '''
+    TOL_DB = 0.01
+    TOL_DEG = 0.05
+    random.seed(4)
+    steps = (
+        (25e6, 0.02, (0, 0, 2 / 3 * pi, 4 / 3 * pi)),
+        (30e6, 0.01, (0, pi / 3, 5 / 6 * pi, -pi / 4))
+    )
+
+    def adcs(n0, N, f, a, thetas):
+        ''' tone with 2 LSB rms of noise '''
+        n = arange(n0, n0 + N)
+        x = stack([a * (1 << 13) * sin(2 * pi * f / fs * n + th)
+                   for th in thetas], 1)
+        x = rint(x + random.normal(0, 2, x.shape)).astype(int64)
+        return clip(x, -(1 << 13), (1 << 13) - 1)
+
+    def run(m, N, f, a, thetas):
+        rs = [m.process(adcs(i, minimum(block, N - i), f, a, thetas))
+              for i in range(0, N, block)]
+        return {k: concatenate([r[k] for r in rs]) for k in rs[0]}
+
+    print('iir  mode   valid [strobes]  [ms]   settled [strobes]  [ms]')
+    for iir in (10, 11, 12, 13):
+        for fast in (0, 1):
+            (f0, a0, th0), (f1, a1, th1) = steps
+            m = VvmModel(
+                deci=deci, iir=iir, iir_fast=1,
+                ftws=(int((f0 + 10e3) / fs * 2**32),) * 4
+            )
+            # pre-settle quickly, then retune like a DDC commit
+            run(m, (2 << iir) * deci, f0, a0, th0)
+            m.iir_fast = fast
+            m.ftws = (int((f1 + 10e3) / fs * 2**32),) * 4
+            m.restart()
+            t0 = m.n
+            r = run(m, (2 << (iir + SETTLE_FIXED)) * deci, f1, a1, th1)
+
+            mags = 20 * log10(r['mags'].astype(float64))
+            phs = wrap(r['phases'].astype(int64), 32)[:, 1:] / (1 << 21) * 180
+            tail = len(mags) * 3 // 4
+            err_mag = abs(mags - mags[tail:].mean(0)).max(1)
+            err_ph = (phs - phs[tail:].mean(0) + 180) % 360 - 180
+            err_ph = abs(err_ph).max(1)
+            bad = flatnonzero((err_mag > TOL_DB) | (err_ph > TOL_DEG))
+            assert bad[-1] < tail, 'noise above the tolerance'
+            k_valid = bad[-1] + 1
+            k_settled = argmax(r['settled'])
+            assert k_settled >= k_valid, 'settled before the reading is valid'
+            print('{:3d}  {:5s}  {:14d}  {:5.2f}  {:16d}  {:5.2f}'.format(
+                iir, ('fixed', 'fast')[fast],
+                k_valid, (r['ts'][k_valid] - t0) / fs * 1e3,
+                k_settled, (r['ts'][k_settled] - t0) / fs * 1e3
+            ))
+
+
+def main():
+    if 'check' in argv:
+        check_tiny_iir()
+        check_fast_settle()
+        check_phase_processor()
+        check_pulsed_rf_trigger()
+        check_chain()
+    if 'bench' in argv:
+        bench()
+    if 'settle' in argv:
+        settle()
+
+
+if __name__ == '__main__':
+    if len(argv) <= 1:
+        print(__doc__)
+        exit(-1)
+    main()
@@ -12,7 +12,7 @@ set_property board_part em.avnet.com:zed:part0:1.4 [current_project]
 create_ip -name processing_system7 -vendor xilinx.com -library ip -version 5.5 -module_name processing_system7_0
 set_property -dict [list CONFIG.preset {ZedBoard}] [get_ips processing_system7_0]
 
-# SPI0: EMIO, SPI1: MIO 10 .. 15, GPIO: EMIO54 .. EMIO85
+# SPI0: EMIO, SPI1: MIO 10 .. 15, GPIO: EMIO54 .. EMIO85, AXI HP0 for IqDma
 # CONFIG.PCW_I2C0_PERIPHERAL_ENABLE {1}
 set_property -dict [list \
 	CONFIG.PCW_QSPI_GRP_SINGLE_SS_ENABLE {1} \
@@ -21,6 +21,7 @@ set_property -dict [list \
 	CONFIG.PCW_SPI1_SPI1_IO {MIO 10 .. 15} \
 	CONFIG.PCW_GPIO_EMIO_GPIO_ENABLE {1} \
 	CONFIG.PCW_GPIO_EMIO_GPIO_IO {32} \
+	CONFIG.PCW_USE_S_AXI_HP0 {1} \
     CONFIG.PCW_MIO_10_SLEW {fast} \
     CONFIG.PCW_MIO_11_SLEW {fast} \
     CONFIG.PCW_MIO_12_SLEW {fast} \
@@ -34,6 +34,7 @@ from common import main, LedBlinker
 from iserdes.ltc_phy import LTCPhy, ltc_pads
 from dsp.acquisition import Acquisition
 from dsp.vvm_dsp import VVM_DSP
+from dsp.iq_dma import IqDma
 
 
 class _CRG(Module):
@@ -112,6 +113,7 @@ class ZedVvm(SoCCore):
         "acq",
         "f_clk100",
         "vvm",
+        "iq_dma",
         "si570"
     ]
 
@@ -228,7 +230,8 @@ class ZedVvm(SoCCore):
         # ----------------------------
         mems = []
         for i, sample_out in enumerate(self.lvds.sample_outs):
-            mem = Memory(14, 4096)
+            # 32 bit wide for accumulate mode, sums of up to 2**18 captures
+            mem = Memory(32, 4096)
             mems.append(mem)
             self.specials += mem
             self.submodules.sample_ram = wishbone.SRAM(mem, read_only=True)
@@ -250,6 +253,16 @@ class ZedVvm(SoCCore):
         self.specials += MultiReg(
             p.request('user_btn_c'), self.acq.trigger, 'sample'
         )
+        # trigger timestamps of the segmented mode
+        self.submodules.acq_ts_ram = wishbone.SRAM(
+            self.acq.ts_mem, read_only=True
+        )
+        self.register_mem(
+            "acq_ts",
+            0x14000000,  # [bytes]
+            self.acq_ts_ram.bus,
+            self.acq.ts_mem.depth * 4  # [bytes]
+        )
 
         # ----------------------------
         #  Vector volt-meter
@@ -258,6 +271,27 @@ class ZedVvm(SoCCore):
         self.submodules.vvm = VVM_DSP(self.lvds.sample_outs)
         self.vvm.add_csr(f_sys, p)
 
+        # Mag / phase traces, mapped back to back for a single bulk read
+        for i, mem in enumerate(self.vvm.trace.mems):
+            ram = wishbone.SRAM(mem, read_only=True)
+            setattr(self.submodules, "trace_ram{}".format(i), ram)
+            self.register_mem(
+                "trace{}".format(i),
+                0x15000000 + i * mem.depth * 4,  # [bytes]
+                ram.bus,
+                mem.depth * 4  # [bytes]
+            )
+
+        # -------------------------------------------------------
+        #  Decimated IQ stream to a ring buffer in PS DDR (AXI HP0)
+        # -------------------------------------------------------
+        self.submodules.iq_dma = IqDma(
+            self.vvm.ddc.result_iq,
+            self.vvm.ddc.result_strobe,
+            self.vvm.ddc.result_first,
+            self.cpu.add_axi_hp_slave(clock_domain="sys")
+        )
+
         # -------------------------------------------------------
         #  OLED display / PS GPIOs / Si570
         # -------------------------------------------------------
@@ -154,12 +154,16 @@ class SPI:
         self.c.write_reg(self.w, self._x)
 
     def rxtx(self, tx_val, nBits):
-        rx_val = 0
+        # the bits are only used at the end, in a batch() of
+        # CsrLibLegacyAdapter, the transfer is then sent in one go
+        rx_bits = []
         self._pin(cs=1, oe=1)
         for i in range(nBits):
             self._pin(clk=0, mosi=(tx_val >> (nBits - i - 1)) & 1)
             self._pin(clk=1)
-            rx_val <<= 1
-            rx_val |= self.c.read_reg(self.r) & 1
+            rx_bits.append(self.c.read_reg(self.r))
         self._pin(cs=0, oe=0, clk=0)
+        rx_val = 0
+        for b in rx_bits:
+            rx_val = (rx_val << 1) | (b & 1)
         return rx_val
@@ -0,0 +1,270 @@
+'''
+Append-only log of timestamped numpy records, in compressed chunks
+
+A log is a directory:
+
+    meta.json           numpy dtype of the records
+    seg_000001.dat      segment: compressed chunks of records
+    seg_000001.idx      index: one IDX_DTYPE row per chunk of the segment
+    seg_000002.dat      ...
+
+Records are collected into chunks, which are zlib compressed and appended
+to the current segment. Then the index row is appended. A new segment is
+started when the current one exceeds seg_size. The oldest segments are
+deleted to keep the log below max_size. A crash loses at most the chunk
+in memory.
+
+The first field of the records must be the timestamp `t` [s]. Reading a
+time range only decompresses the chunks overlapping it, the segments are
+accessed through mmap.
+'''
+import json
+import mmap
+import os
+import zlib
+from glob import glob
+from os.path import join, getsize
+from numpy import dtype, zeros, frombuffer, fromfile, concatenate, \
+    searchsorted
+
+IDX_DTYPE = dtype([
+    ('offset', '<u8'),   # of the chunk in the segment [bytes]
+    ('length', '<u4'),   # compressed [bytes]
+    ('n', '<u4'),        # number of records
+    ('t_first', '<f8'),
+    ('t_last', '<f8')
+])
+
+
+class ChunkLogWriter:
+    def __init__(self, path, rec_dtype, chunk_len=1024, seg_size=16 << 20,
+                 max_size=512 << 20, level=6):
+        '''
+        path: directory of the log, created if needed
+        rec_dtype: numpy dtype of a record, first field `t`
+        chunk_len: records per chunk
+        seg_size: start a new segment after this many [bytes]
+        max_size: delete the oldest segments above this many [bytes]
+        level: zlib compression level
+        '''
+        self.path = path
+        self.dtype = dtype(rec_dtype)
+        if self.dtype.names[0] != 't':
+            raise ValueError('first field must be the timestamp t')
+        self.seg_size = seg_size
+        self.max_size = max_size
+        self.level = level
+
+        os.makedirs(path, exist_ok=True)
+        fName = join(path, 'meta.json')
+        if os.path.isfile(fName):
+            if read_dtype(path) != self.dtype:
+                raise ValueError('record dtype differs from ' + fName)
+        else:
+            with open(fName, 'w') as f:
+                json.dump({'dtype': self.dtype.descr}, f)
+
+        self.buf = zeros(chunk_len, self.dtype)
+        self.n = 0
+        self.seg = None
+        segs = get_segments(path)
+        self.i_seg = segs[-1] + 1 if len(segs) > 0 else 1
+
+    def _open_segment(self):
+        name = join(self.path, 'seg_{:06d}'.format(self.i_seg))
+        self.f_dat = open(name + '.dat', 'ab')
+        self.f_idx = open(name + '.idx', 'ab')
+        self.seg = self.i_seg
+        self.i_seg += 1
+
+    def _close_segment(self):
+        if self.seg is None:
+            return
+        self.f_dat.close()
+        self.f_idx.close()
+        self.seg = None
+
+    def append(self, rec):
+        ''' rec: tuple of the record fields '''
+        self.buf[self.n] = rec
+        self.n += 1
+        if self.n >= len(self.buf):
+            self.flush()
+
+    def flush(self):
+        ''' write the records collected so far as one chunk '''
+        if self.n == 0:
+            return
+        recs = self.buf[:self.n]
+        bs = zlib.compress(recs.tobytes(), self.level)
+        if self.seg is None:
+            self._open_segment()
+        idx = zeros(1, IDX_DTYPE)
+        idx[0] = (
+            self.f_dat.tell(), len(bs), self.n, recs['t'][0], recs['t'][-1]
+        )
+        self.f_dat.write(bs)
+        self.f_dat.flush()
+        self.f_idx.write(idx.tobytes())
+        self.f_idx.flush()
+        self.n = 0
+
+        if self.f_dat.tell() >= self.seg_size:
+            self._close_segment()
+            self.enforce_budget()
+
+    def enforce_budget(self):
+        ''' delete the oldest closed segments while above max_size '''
+        segs = get_segments(self.path)
+        sizes = [get_segment_size(self.path, s) for s in segs]
+        total = sum(sizes)
+        for s, size in zip(segs, sizes):
+            if total <= self.max_size or s == self.seg:
+                break
+            for ext in ('.dat', '.idx'):
+                os.remove(join(self.path, 'seg_{:06d}{:s}'.format(s, ext)))
+            total -= size
+
+    def close(self):
+        self.flush()
+        self._close_segment()
+
+
+def read_dtype(path):
+    ''' numpy dtype of the records of a log '''
+    with open(join(path, 'meta.json')) as f:
+        return dtype([tuple(d) for d in json.load(f)['dtype']])
+
+
+def get_segments(path):
+    ''' sorted list of the segment numbers in a log '''
+    return sorted(
+        int(os.path.basename(f)[4:10]) for f in glob(join(path, 'seg_*.idx'))
+    )
+
+
+def get_segment_size(path, seg):
+    name = join(path, 'seg_{:06d}'.format(seg))
+    return getsize(name + '.dat') + getsize(name + '.idx')
+
+
+class ChunkLogReader:
+    def __init__(self, path):
+        self.path = path
+        self.dtype = read_dtype(path)
+        self.segs = []
+        idxs = []
+        for s in get_segments(path):
+            idx = fromfile(
+                join(path, 'seg_{:06d}.idx'.format(s)), IDX_DTYPE
+            )
+            self.segs += [s] * len(idx)
+            idxs.append(idx)
+        self.idx = concatenate(idxs) if len(idxs) > 0 else zeros(0, IDX_DTYPE)
+        self.mms = {}
+
+    def __len__(self):
+        ''' number of records '''
+        return int(self.idx['n'].sum())
+
+    def get_range(self):
+        ''' (t_first, t_last) of the whole log '''
+        if len(self.idx) == 0:
+            return None
+        return self.idx['t_first'][0], self.idx['t_last'][-1]
+
+    def _get_mmap(self, seg):
+        if seg not in self.mms:
+            with open(join(self.path, 'seg_{:06d}.dat'.format(seg))) as f:
+                self.mms[seg] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        return self.mms[seg]
+
+    def read_chunk(self, i):
+        ''' decompress chunk number i '''
+        off, length = int(self.idx['offset'][i]), int(self.idx['length'][i])
+        mm = self._get_mmap(self.segs[i])
+        return frombuffer(zlib.decompress(mm[off:off + length]), self.dtype)
+
+    def read(self, t0=None, t1=None):
+        '''
+        records with t0 <= t <= t1
+        only the chunks overlapping the time range are decompressed
+        '''
+        if t0 is None:
+            t0 = -float('inf')
+        if t1 is None:
+            t1 = float('inf')
+        # timestamps are ascending, chunks too
+        i0 = searchsorted(self.idx['t_last'], t0, 'left')
+        i1 = searchsorted(self.idx['t_first'], t1, 'right')
+        if i1 <= i0:
+            return zeros(0, self.dtype)
+        recs = concatenate([self.read_chunk(i) for i in range(i0, i1)])
+        return recs[(recs['t'] >= t0) & (recs['t'] <= t1)]
+
+    def close(self):
+        for mm in self.mms.values():
+            mm.close()
+        self.mms.clear()
+
+
+def main():
+    ''' self check and benchmark on a temporary directory '''
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+    from numpy import arange, sin, float32
+
+    rec_dtype = [('t', '<f8'), ('mags', '<f4', 4), ('phases', '<f4', 3)]
+    N = 200000
+    with TemporaryDirectory() as path:
+        w = ChunkLogWriter(path, rec_dtype, seg_size=1 << 20,
+                           max_size=1 << 30)
+        ts = perf_counter()
+        for i in range(N):
+            t = 1000 + i * 0.01
+            w.append((t, [sin(t)] * 4, [i % 360] * 3))
+        w.close()
+        dt = perf_counter() - ts
+        n_bytes = sum(
+            get_segment_size(path, s) for s in get_segments(path)
+        )
+        print('write: {:.0f} records / s, {:.1f} bytes / record, '
+              '{:d} segments'.format(
+                  N / dt, n_bytes / N, len(get_segments(path))
+              ))
+
+        r = ChunkLogReader(path)
+        assert len(r) == N
+        assert r.get_range() == (1000, 1000 + (N - 1) * 0.01)
+        ts = perf_counter()
+        recs = r.read(1500, 1510)
+        dt = perf_counter() - ts
+        assert len(recs) == 1001 and recs['t'][0] == 1500
+        assert (recs['phases'][:, 0] == (arange(50000, 51001) % 360)).all()
+        assert recs['mags'].dtype == float32
+        print('read 10 s out of {:.0f} s: {:.2f} ms'.format(
+            N * 0.01, dt * 1e3
+        ))
+        r.close()
+
+        # disk budget
+        w = ChunkLogWriter(path, rec_dtype, seg_size=1 << 20,
+                           max_size=3 << 19)
+        w.enforce_budget()
+        w.close()
+        r = ChunkLogReader(path)
+        n_bytes = sum(
+            get_segment_size(path, s) for s in get_segments(path)
+        )
+        assert n_bytes <= 3 << 19 and r.read()['t'][-1] == r.get_range()[1]
+        print('after enforcing the budget: {:.0f} s left'.format(
+            r.get_range()[1] - r.get_range()[0]
+        ))
+        r.close()
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
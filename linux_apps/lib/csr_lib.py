@@ -1,8 +1,12 @@
 
 import mmap
+from time import sleep, perf_counter
+from contextlib import contextmanager
 from numpy import frombuffer, uint32, array
 import json
 from difflib import get_close_matches
+from .csr_script import CsrScript, ScriptClient
+from .csr_stream import CsrSubscription
 
 
 class CsrLib:
@@ -94,6 +98,29 @@ class CsrLib:
             N = mem['size'] // 4
         return self.read(mem['base'], N)
 
+    @contextmanager
+    def batch(self):
+        '''
+        same interface as CsrLibLegacyAdapter.batch().
+        Local accesses are cheap, they are executed right away.
+        '''
+        yield self
+
+    def wait(self, t):
+        ''' sleep t [s], queued in a batch() on CsrLibLegacyAdapter '''
+        sleep(t)
+
+    def poll_reg(self, name, val, mask=0xFFFFFFFF, timeout=0.1):
+        '''
+        wait until read_reg(name) & mask == val
+        returns the last value read
+        '''
+        t_end = perf_counter() + timeout
+        while True:
+            x = self.read_reg(name)
+            if x & mask == val & mask or perf_counter() > t_end:
+                return x
+
     def get_ident(self):
         addr = self.j['csr_bases']['identifier_mem']
         s = ""
@@ -112,11 +139,108 @@ class CsrLibLegacyAdapter:
     '''
     def __init__(self, remote_client):
         self.rc = remote_client
+        # collects the register accesses inside of batch()
+        self.script = None
+        # connection to run the scripts on, opened on first use
+        self.script_client = None
+
+    def _get_script(self, t=0):
+        '''
+        returns a CsrScript with room for one more access,
+        which may wait t [s]
+        '''
+        if self.script.results is None and self.script.is_full(t=t):
+            self.script.flush()
+        if self.script.results is not None:
+            self.script = CsrScript(self._run_script)
+        return self.script
+
+    def _get_addr(self, name):
+        reg = getattr(self.rc.regs, name)
+        if reg.length > 1:
+            raise ValueError('{:s} is wider than 1 word'.format(name))
+        return reg.addr
+
+    def _run_script(self, words, n_res):
+        '''
+        send a transaction script to litex_server_light
+        returns n_res result words
+        '''
+        if self.script_client is None:
+            if hasattr(self.rc, 'host'):
+                # litex RemoteClient
+                self.script_client = ScriptClient(self.rc.host, self.rc.port)
+            else:
+                # litex CommUDP
+                self.script_client = ScriptClient(
+                    self.rc.server, self.rc.port, udp=True
+                )
+        return self.script_client.run(words, n_res)
+
+    @contextmanager
+    def batch(self):
+        '''
+        the register accesses inside the with block are collected
+        into transaction scripts, which litex_server_light runs in one
+        round-trip each.
+
+        read_reg() and poll_reg() return a DeferredRead, which behaves like
+        an int. Using its value sends the script collected so far.
+        Use wait() instead of time.sleep() inside the block.
+        '''
+        if self.script is not None:
+            # nested
+            yield self
+            return
+        self.script = CsrScript(self._run_script)
+        try:
+            yield self
+            self.script.flush()
+        finally:
+            self.script = None
+
+    def wait(self, t):
+        ''' sleep t [s] '''
+        if self.script is None:
+            sleep(t)
+        else:
+            self._get_script(t).wait(t)
+
+    def poll_reg(self, name, val, mask=0xFFFFFFFF, timeout=5e-3):
+        '''
+        wait until read_reg(name) & mask == val
+        returns the last value read
+        timeout is limited to csr_script.MAX_TIME, as the server
+        does not answer other clients meanwhile
+        '''
+        with self.batch():
+            return self._get_script(timeout).poll(
+                self._get_addr(name), val, mask, timeout
+            )
+
+    def subscribe(self, names, period=0.01, on_change=False):
+        '''
+        returns a CsrSubscription, which receives the values of the
+        registers `names` every `period` [s] from litex_server_light
+        '''
+        host = getattr(self.rc, 'host', getattr(self.rc, 'server', None))
+        return CsrSubscription(
+            [self._get_addr(name) for name in names],
+            period,
+            on_change,
+            host,
+            self.rc.port
+        )
 
     def read_reg(self, name):
+        if self.script is not None:
+            return self._get_script().read(self._get_addr(name))
         return getattr(self.rc.regs, name).read()
 
     def write_reg(self, name, value):
+        if self.script is not None:
+            self._get_script().write(self._get_addr(name), value)
+            return
         getattr(self.rc.regs, name).write(value)
 
     def read_mem(self, name, N=None):
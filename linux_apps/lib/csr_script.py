@@ -0,0 +1,481 @@
+'''
+Transaction scripts: short CSR access programs which run next to the
+hardware, to save a network round-trip for every single register access.
+
+A script is a list of 32 bit words. CsrScript builds them, run_script()
+executes them. litex_server_light runs scripts it receives as a write to
+SCRIPT_ADDR and replies with the results to the reads of SCRIPT_ADDR in
+the same record.
+
+The layout of the results is known when building the script, each
+OP_READ and OP_POLL gives one word, a loop gives the words of its body
+for each iteration, followed by the number of iterations done. After a
+break, the remaining words of the loop are 0. The first word is the
+status.
+
+A script runs in the hardware thread of litex_server_light and holds up
+all other clients meanwhile. run_script() refuses scripts which could
+take long: more than MAX_STEPS operations with all loop iterations, more
+than MAX_TIME of OP_WAIT and OP_POLL timeouts, or more than MAX_WORDS
+result words.
+
+This module must stay dependency free, litex_server_light links to it.
+'''
+import socket
+import struct
+import time
+
+# Not a valid address on the zedboard, writes to it carry a script
+SCRIPT_ADDR = 0xFFFFFFF0
+
+# Etherbone limit of words per record
+MAX_WORDS = 255
+
+# operations a script may execute, counting every loop iteration
+MAX_STEPS = 4096
+
+# sum of OP_WAIT times and OP_POLL timeouts a script may take [us]
+MAX_TIME = 10000
+
+# etherbone packet header for 32 bit addresses and data
+_PACKET_HEADER = struct.pack('>HBB4x', 0x4e6f, 0x10, 0x44)
+
+# opcode, number of arguments
+OP_WRITE = 1     # addr, value
+OP_READ = 2      # addr
+OP_RMW = 3       # addr, mask, value: set the bits of mask to value
+OP_POLL = 4      # addr, mask, value, timeout [us]: wait for value & mask
+OP_WAIT = 5      # time [us]
+OP_LOOP = 6      # n: repeat everything up to the matching OP_END n times
+OP_END = 7
+OP_BREAK_NE = 8  # addr, mask, value: leave the loop if value & mask differ
+
+N_ARGS = {
+    OP_WRITE: 2, OP_READ: 1, OP_RMW: 3, OP_POLL: 4, OP_WAIT: 1, OP_LOOP: 1,
+    OP_END: 0, OP_BREAK_NE: 3
+}
+
+# status word flags
+STATUS_TIMEOUT = 1  # an OP_POLL timed out
+STATUS_ERROR = 2    # invalid or too long script, nothing was executed
+
+
+def parse_script(words):
+    '''
+    returns the script as a tree of (op, args) and (OP_LOOP, n, body)
+    raises ValueError for invalid scripts
+    '''
+    stack = [[]]
+    i = 0
+    while i < len(words):
+        op = words[i]
+        if op not in N_ARGS:
+            raise ValueError('invalid opcode {:d}'.format(op))
+        args = words[i + 1:i + 1 + N_ARGS[op]]
+        if len(args) < N_ARGS[op]:
+            raise ValueError('missing arguments')
+        i += 1 + N_ARGS[op]
+        if op == OP_LOOP:
+            node = (OP_LOOP, args[0], [])
+            stack[-1].append(node)
+            stack.append(node[2])
+        elif op == OP_END:
+            if len(stack) < 2:
+                raise ValueError('OP_END without OP_LOOP')
+            stack.pop()
+        else:
+            if op == OP_BREAK_NE and len(stack) < 2:
+                raise ValueError('OP_BREAK_NE outside of a loop')
+            stack[-1].append((op, args))
+    if len(stack) > 1:
+        raise ValueError('OP_LOOP without OP_END')
+    return stack[0]
+
+
+def n_results(tree):
+    ''' number of result words of a parsed script, without status '''
+    n = 0
+    for node in tree:
+        if node[0] == OP_LOOP:
+            n += node[1] * n_results(node[2]) + 1
+        elif node[0] in (OP_READ, OP_POLL):
+            n += 1
+    return n
+
+
+def n_steps(tree):
+    '''
+    worst case of a parsed script:
+    returns the number of operations and the OP_WAIT + OP_POLL time [us]
+    '''
+    n, t = 0, 0
+    for node in tree:
+        if node[0] == OP_LOOP:
+            n_body, t_body = n_steps(node[2])
+            n += node[1] * (n_body + 1) + 1
+            t += node[1] * t_body
+        else:
+            n += 1
+            if node[0] == OP_WAIT:
+                t += node[1][0]
+            elif node[0] == OP_POLL:
+                t += node[1][3]
+    return n, t
+
+
+class _Break(Exception):
+    pass
+
+
+def _run(tree, read, write, res):
+    ''' returns the status flags '''
+    status = 0
+    for node in tree:
+        op = node[0]
+        if op == OP_LOOP:
+            n, body = node[1], node[2]
+            n_body = n_results(body)
+            i = 0
+            while i < n:
+                n_res = len(res)
+                try:
+                    status |= _run(body, read, write, res)
+                except _Break:
+                    # pad the rest of this iteration
+                    res += [0] * (n_body - (len(res) - n_res))
+                    break
+                i += 1
+            res += [0] * (n_body * (n - i - (i < n)))
+            res.append(i)
+            continue
+
+        args = node[1]
+        if op == OP_WRITE:
+            write(args[0], args[1])
+        elif op == OP_READ:
+            res.append(read(args[0]))
+        elif op == OP_RMW:
+            addr, mask, val = args
+            write(addr, (read(addr) & ~mask) | (val & mask))
+        elif op == OP_POLL:
+            addr, mask, val, timeout = args
+            t_end = time.perf_counter() + timeout * 1e-6
+            while True:
+                x = read(addr)
+                if x & mask == val & mask:
+                    break
+                if time.perf_counter() > t_end:
+                    status |= STATUS_TIMEOUT
+                    break
+            res.append(x)
+        elif op == OP_WAIT:
+            time.sleep(args[0] * 1e-6)
+        elif op == OP_BREAK_NE:
+            addr, mask, val = args
+            if read(addr) & mask != val & mask:
+                raise _Break()
+    return status
+
+
+def run_script(words, read, write):
+    '''
+    execute a script
+    read(addr) returns one word, write(addr, value) writes one word.
+    returns [status, results ...]
+    '''
+    if len(words) > MAX_WORDS:
+        return [STATUS_ERROR]
+    try:
+        tree = parse_script(words)
+    except ValueError:
+        return [STATUS_ERROR]
+    n, t = n_steps(tree)
+    if n > MAX_STEPS or t > MAX_TIME or n_results(tree) + 1 > MAX_WORDS:
+        return [STATUS_ERROR]
+    res = []
+    status = _run(tree, read, write, res)
+    return [status] + res
+
+
+class DeferredRead:
+    '''
+    result of a read in a script which has not run yet.
+    Behaves like an int, using it runs the script.
+    '''
+    def __init__(self, script, index):
+        self.script = script
+        self.index = index
+
+    @property
+    def value(self):
+        if self.script.results is None:
+            self.script.flush()
+        return self.script.results[self.index]
+
+    def __int__(self):
+        return self.value
+
+    __index__ = __int__
+
+    def __repr__(self):
+        if self.script.results is None:
+            return '<DeferredRead>'
+        return repr(self.value)
+
+
+# forward the int operators to the value
+for _name in (
+    'and', 'rand', 'or', 'ror', 'xor', 'rxor', 'lshift', 'rlshift',
+    'rshift', 'rrshift', 'add', 'radd', 'sub', 'rsub', 'mul', 'rmul',
+    'floordiv', 'truediv', 'mod', 'neg', 'invert', 'abs', 'bool', 'float',
+    'eq', 'ne', 'lt', 'le', 'gt', 'ge', 'hash', 'format', 'str'
+):
+    def _forward(self, *args, _name='__{:s}__'.format(_name)):
+        args = [a.value if isinstance(a, DeferredRead) else a for a in args]
+        return getattr(self.value, _name)(*args)
+    setattr(DeferredRead, _forward.__kwdefaults__['_name'], _forward)
+
+
+class CsrScript:
+    '''
+    builds a script. Reads return DeferredRead objects.
+
+    run:
+        function executing a list of script words, returning the
+        result words. Called by flush() and when a DeferredRead is used.
+    '''
+    def __init__(self, run):
+        self.run = run
+        self.words = []
+        self.n_res = 0
+        # OP_WAIT + OP_POLL time [us]
+        self.t = 0
+        # stack of [words index, results index, time] of open loops
+        self.loops = []
+        self.results = None
+
+    def _add(self, op, *args):
+        if self.results is not None:
+            raise RuntimeError('script already ran')
+        self.words += [op] + [a & 0xFFFFFFFF for a in args]
+
+    def is_full(self, n_words=5, n_res=1, t=0):
+        '''
+        True if there is no room for n_words more words and results,
+        or for t [s] more waiting
+        '''
+        return len(self.words) + n_words > MAX_WORDS or \
+            self.n_res + 1 + n_res > MAX_WORDS or \
+            self.t + int(t * 1e6) > MAX_TIME
+
+    def write(self, addr, val):
+        self._add(OP_WRITE, addr, val)
+
+    def read(self, addr):
+        return self._result(OP_READ, addr)
+
+    def rmw(self, addr, mask, val):
+        self._add(OP_RMW, addr, mask, val)
+
+    def poll(self, addr, val, mask=0xFFFFFFFF, timeout=5e-3):
+        '''
+        wait until read(addr) & mask == val, returns the last value.
+        All timeouts and waits of a script add up to at most MAX_TIME.
+        '''
+        self.t += int(timeout * 1e6)
+        return self._result(OP_POLL, addr, mask, val, int(timeout * 1e6))
+
+    def wait(self, t):
+        ''' sleep t [s] '''
+        self.t += int(t * 1e6)
+        self._add(OP_WAIT, int(t * 1e6))
+
+    def break_ne(self, addr, val, mask=0xFFFFFFFF):
+        ''' leave the innermost loop if read(addr) & mask != val '''
+        if len(self.loops) == 0:
+            raise RuntimeError('break_ne() outside of loop()')
+        self._add(OP_BREAK_NE, addr, mask, val)
+
+    def loop(self, n):
+        '''
+        context manager, repeats what is added inside n times.
+        Reads inside a loop are only available from get_results().
+        '''
+        script = self
+
+        class Loop:
+            def __enter__(self):
+                script.loops.append(
+                    (len(script.words), script.n_res, script.t)
+                )
+                script._add(OP_LOOP, n)
+
+            def __exit__(self, *args):
+                script._add(OP_END)
+                i_w, i_res, t = script.loops.pop()
+                n_body = script.n_res - i_res
+                script.n_res = i_res + n * n_body + 1
+                script.t = t + n * (script.t - t)
+        return Loop()
+
+    def _result(self, op, *args):
+        self._add(op, *args)
+        self.n_res += 1
+        if len(self.loops) > 0:
+            return None
+        return DeferredRead(self, self.n_res)
+
+    def flush(self):
+        ''' run the script, returns the status word '''
+        if len(self.loops) > 0:
+            raise RuntimeError('flush() inside of loop()')
+        if self.results is not None:
+            return self.results[0]
+        n, t = n_steps(parse_script(self.words))
+        if len(self.words) > MAX_WORDS or self.n_res + 1 > MAX_WORDS or \
+                n > MAX_STEPS or t > MAX_TIME:
+            raise ValueError('script too long')
+        self.results = self.run(self.words, self.n_res + 1)
+        if self.results[0] & STATUS_ERROR:
+            raise RuntimeError('invalid script')
+        return self.results[0]
+
+    def get_results(self):
+        ''' all result words after the status '''
+        self.flush()
+        return self.results[1:]
+
+
+class ScriptClient:
+    def __init__(self, host='localhost', port=1234, udp=False, timeout=5.0):
+        '''
+        runs scripts on a litex_server_light, on a connection of its own.
+        Pass its run() to CsrScript.
+
+        udp:
+            send etherbone datagrams to litex_server_light --udp
+        '''
+        if udp:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.connect((host, port))
+        else:
+            self.socket = socket.create_connection((host, port))
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.settimeout(timeout)
+        self.udp = udp
+
+    def _recv(self, n):
+        bs = bytearray()
+        while len(bs) < n:
+            chunk = self.socket.recv(n - len(bs))
+            if len(chunk) == 0:
+                raise ConnectionError('connection closed')
+            bs += chunk
+        return bs
+
+    def _receive(self):
+        ''' returns the data words of the next record '''
+        n_header = len(_PACKET_HEADER) + 4
+        if self.udp:
+            bs = self.socket.recv(0x10000)
+        else:
+            bs = self._recv(n_header)
+            bs += self._recv(4 * (bs[-2] + 1))
+        wcount = bs[n_header - 2]
+        words = struct.unpack_from('>{:d}I'.format(wcount + 1), bs, n_header)
+        return list(words[1:])
+
+    def run(self, words, n_res):
+        ''' send a script, returns its n_res result words '''
+        self.socket.sendall(
+            _PACKET_HEADER +
+            struct.pack('>BBBB', 0, 0x0F, len(words), n_res) +
+            struct.pack('>{:d}I'.format(len(words) + n_res + 2),
+                        SCRIPT_ADDR, *words, 0, *[SCRIPT_ADDR] * n_res)
+        )
+        return self._receive()
+
+    def close(self):
+        self.socket.close()
+
+
+def main():
+    ''' self check against a simulated memory '''
+    mem = {}
+
+    def read(addr):
+        return mem.get(addr, 0)
+
+    def write(addr, val):
+        mem[addr] = val
+
+    def run(words, n):
+        res = run_script(words, read, write)
+        assert len(res) == n, (len(res), n)
+        return res
+
+    print("csr_script self check: ", end="")
+    s = CsrScript(run)
+    s.write(0x10, 5)
+    r0 = s.read(0x10)
+    s.rmw(0x10, 0xF0, 0x30)
+    with s.loop(10):
+        s.break_ne(0x20, 0, mask=0x4)
+        s.read(0x20)
+    s.wait(1e-3)
+    r1 = s.poll(0x10, 0x35)
+    r2 = s.poll(0x10, 0x0, timeout=1e-3)
+    assert r0 == 5 and r1 == 0x35 and r2 == 0x35
+    assert s.flush() == STATUS_TIMEOUT
+    # 10 iterations of 1 read, 1 iteration count, 3 reads outside
+    assert len(s.get_results()) == 14
+
+    # loop with data dependent break
+    mem.clear()
+    s = CsrScript(run)
+    with s.loop(8):
+        s.break_ne(0x0, 0)
+        s.read(0x4)
+    s.write(0x0, 1)
+    with s.loop(4):
+        s.break_ne(0x0, 0)
+        s.read(0x4)
+    assert s.get_results() == [0] * 8 + [8] + [0] * 4 + [0]
+
+    assert run_script([OP_END], read, write) == [STATUS_ERROR]
+    assert run_script([OP_READ], read, write) == [STATUS_ERROR]
+
+    # scripts which would block the server for long
+    mem.clear()
+    for words in (
+        [OP_LOOP, 0xFFFFFFFF, OP_END],
+        [OP_LOOP, 1000, OP_LOOP, 1000, OP_WRITE, 0, 1, OP_END, OP_END],
+        [OP_LOOP, 300, OP_READ, 0, OP_END],
+        [OP_WAIT, MAX_TIME + 1],
+        [OP_LOOP, 10, OP_POLL, 0, 1, 1, MAX_TIME // 10 + 1, OP_END],
+        [OP_WRITE, 0, 1] * 86
+    ):
+        assert run_script(words, read, write) == [STATUS_ERROR], words
+    assert mem == {}
+    s = CsrScript(run)
+    with s.loop(MAX_STEPS):
+        s.write(0x0, 1)
+    try:
+        s.flush()
+        assert False
+    except ValueError:
+        pass
+
+    # the int operators of DeferredRead
+    s = CsrScript(run)
+    s.write(0x8, 0x12)
+    d = s.read(0x8)
+    assert d & 0xF == 2 and d >> 4 == 1 and d == 0x12 and 1 + d == 0x13
+    assert '{:02x}'.format(d) == '12' and [0, 1][d - 0x11] == 1
+    s = CsrScript(run)
+    assert s.read(0x8) + s.read(0x8) == 0x24
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+Register subscriptions: litex_server_light samples a set of addresses
+periodically and pushes timestamped frames to the client, instead of the
+client polling them.
+
+On a new tcp connection, the client sends one etherbone record writing
+[period [us], flags, addr0, addr1, ...] to SUBSCRIBE_ADDR and reading
+SUBSCRIBE_ADDR once. The reply carries the number of addresses accepted.
+From then on, the server sends one record per frame, writing
+[time [us] high word, low word, value0, value1, ...] to STREAM_ADDR.
+The subscription ends when the connection is closed.
+
+With FLAG_ON_CHANGE, a frame is only sent when one of the values changed.
+
+This module must stay dependency free, litex_server_light links to it.
+'''
+import socket
+import struct
+
+SUBSCRIBE_ADDR = 0xFFFFFFF4
+STREAM_ADDR = 0xFFFFFFF8
+
+FLAG_ON_CHANGE = 1
+
+# etherbone record limit minus period and flags
+MAX_ADDRS = 253
+
+# etherbone packet header for 32 bit addresses and data
+_PACKET_HEADER = struct.pack('>HBB4x', 0x4e6f, 0x10, 0x44)
+
+
+def encode_frame(t, vals):
+    ''' returns the data words of a frame, t is the time [s] '''
+    t_us = int(t * 1e6)
+    return [t_us >> 32, t_us & 0xFFFFFFFF] + list(vals)
+
+
+def decode_frame(datas):
+    ''' returns (time [s], [value0, value1, ...]) '''
+    return ((datas[0] << 32) | datas[1]) / 1e6, datas[2:]
+
+
+class CsrSubscription:
+    def __init__(self, addrs, period=0.01, on_change=False,
+                 host='localhost', port=1234):
+        '''
+        subscribe to up to MAX_ADDRS 32 bit registers on a
+        litex_server_light, on a connection of its own.
+
+        period:
+            sampling period [s]
+
+        on_change:
+            only receive frames when a value changed
+        '''
+        if len(addrs) > MAX_ADDRS:
+            raise ValueError('too many addresses')
+        self.addrs = list(addrs)
+        self.socket = socket.create_connection((host, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        flags = FLAG_ON_CHANGE if on_change else 0
+        words = [int(period * 1e6), flags] + self.addrs
+        self.socket.sendall(
+            _PACKET_HEADER +
+            struct.pack('>BBBB', 0, 0x0F, len(words), 1) +
+            struct.pack('>{:d}I'.format(len(words) + 3),
+                        SUBSCRIBE_ADDR, *words, 0, SUBSCRIBE_ADDR)
+        )
+        _, datas = self._receive()
+        if datas != [len(self.addrs)]:
+            self.close()
+            raise RuntimeError('subscription rejected')
+
+    def _recv(self, n):
+        bs = bytearray()
+        while len(bs) < n:
+            chunk = self.socket.recv(n - len(bs))
+            if len(chunk) == 0:
+                raise ConnectionError('connection closed')
+            bs += chunk
+        return bs
+
+    def _receive(self):
+        ''' returns base address and data words of the next record '''
+        bs = self._recv(len(_PACKET_HEADER) + 4)
+        wcount = bs[-2]
+        words = struct.unpack(
+            '>{:d}I'.format(wcount + 1), self._recv(4 * (wcount + 1))
+        )
+        return words[0], list(words[1:])
+
+    def get(self):
+        ''' blocks until the next frame, returns (time [s], values) '''
+        while True:
+            base_addr, datas = self._receive()
+            if base_addr == STREAM_ADDR:
+                return decode_frame(datas)
+
+    def __iter__(self):
+        while True:
+            yield self.get()
+
+    def close(self):
+        self.socket.close()
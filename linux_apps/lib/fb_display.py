@@ -0,0 +1,154 @@
+'''
+Draw on a linux framebuffer device without SDL
+
+The screen is composed in a 8 bit grayscale numpy array. On update(), only
+the changed rows are converted to the pixel format of the framebuffer and
+written to its mmap.
+'''
+import mmap
+import stat
+from os import stat as os_stat
+from os.path import basename
+from numpy import zeros, frombuffer, arange, uint8, uint16
+
+
+def read_sysfs(fb_dev, name):
+    ''' integer attribute of a framebuffer device, like bits_per_pixel '''
+    fName = '/sys/class/graphics/{}/{}'.format(basename(fb_dev), name)
+    with open(fName) as f:
+        return int(f.read())
+
+
+class FbDisplay:
+    def __init__(self, fb_dev='/dev/fb1', W=256, H=64, bpp=None):
+        '''
+        fb_dev:
+            path to the framebuffer device like /dev/fb1.
+            A regular file is used as file-backed framebuffer for testing
+            and is created if it does not exist.
+
+        W, H:
+            screen size [pixels]
+
+        bpp:
+            bits per pixel of the framebuffer: 16 (RGB565), 8 or 4 (gray).
+            If None, it is read from sysfs (16 for a file-backed one).
+        '''
+        self.W = W
+        self.H = H
+
+        try:
+            is_dev = stat.S_ISCHR(os_stat(fb_dev).st_mode)
+        except FileNotFoundError:
+            is_dev = False
+
+        if bpp is None:
+            bpp = 16
+            if is_dev:
+                bpp = read_sysfs(fb_dev, 'bits_per_pixel')
+        if bpp not in (4, 8, 16):
+            raise ValueError('unsupported bits per pixel: {}'.format(bpp))
+        self.bpp = bpp
+
+        # bytes per row of pixels, the driver may pad the rows
+        self.W_bytes = W * bpp // 8
+        self.stride = self.W_bytes
+        if is_dev:
+            self.stride = read_sysfs(fb_dev, 'stride')
+        if self.stride < self.W_bytes:
+            raise ValueError('framebuffer rows are shorter than W')
+        size = self.stride * H
+
+        if is_dev:
+            self.f = open(fb_dev, 'r+b')
+        else:
+            self.f = open(fb_dev, 'a+b')
+            self.f.truncate(size)
+        self.mm = mmap.mmap(self.f.fileno(), size)
+        self.fb = frombuffer(self.mm, uint8).reshape(H, self.stride)
+
+        # 8 bit gray to RGB565 lookup table
+        g = arange(256, dtype=uint16)
+        self.lut565 = ((g >> 3) << 11) | ((g >> 2) << 5) | (g >> 3)
+
+        # the screen content
+        self.buf = zeros((H, W), uint8)
+        # rows which need to be written on the next update()
+        self.dirty = zeros(H, bool)
+
+    def close(self):
+        del self.fb
+        self.mm.close()
+        self.f.close()
+
+    def get_rect(self):
+        return (0, 0, self.W, self.H)
+
+    def get_width(self):
+        return self.W
+
+    def get_height(self):
+        return self.H
+
+    @staticmethod
+    def from_rgb(bs, w, h):
+        '''
+        convert w x h pixels of 24 bit RGB data to a glyph for blit()
+        like from pygame.image.tostring(surface, 'RGB')
+        '''
+        return frombuffer(bs, uint8).reshape(h, w, 3)[:, :, 0].copy()
+
+    def _clip(self, x, y, w, h):
+        ''' returns slices of buf and the source array '''
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, self.W), min(y + h, self.H)
+        if x1 <= x0 or y1 <= y0:
+            return None, None
+        return (
+            (slice(y0, y1), slice(x0, x1)),
+            (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        )
+
+    def fill(self, c, rect=None):
+        ''' c = (r, g, b), only r is used as gray value '''
+        if rect is None:
+            rect = self.get_rect()
+        dst, _ = self._clip(*rect)
+        if dst is None:
+            return
+        self.buf[dst] = c[0]
+        self.dirty[dst[0]] = True
+
+    def blit(self, g, pos):
+        ''' copy 2D uint8 array g to the screen at pos = (x, y) '''
+        dst, src = self._clip(pos[0], pos[1], g.shape[1], g.shape[0])
+        if dst is None:
+            return
+        self.buf[dst] = g[src]
+        self.dirty[dst[0]] = True
+
+    def pack(self, rows):
+        ''' convert rows of 8 bit gray to the framebuffer pixel format '''
+        if self.bpp == 16:
+            return self.lut565[rows].view(uint8)
+        if self.bpp == 4:
+            # 2 pixels per byte, first one in the high nibble
+            return (rows[:, ::2] & 0xF0) | (rows[:, 1::2] >> 4)
+        return rows
+
+    def update(self, rects=None):
+        '''
+        write changed rows to the framebuffer
+        rects is ignored, the rows touched by fill() and blit() are tracked
+        '''
+        # write consecutive runs of dirty rows in one go
+        y = 0
+        while y < self.H:
+            if not self.dirty[y]:
+                y += 1
+                continue
+            y0 = y
+            while y < self.H and self.dirty[y]:
+                y += 1
+            self.fb[y0:y, :self.W_bytes] = self.pack(self.buf[y0:y])
+        self.dirty[:] = False
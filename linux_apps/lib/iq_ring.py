@@ -0,0 +1,174 @@
+'''
+Consumer of the IQ ring buffer of gateware/dsp/iq_dma.py
+
+The DMA writes one frame per decimated DDC sample into a ring in PS DDR
+and advances the producer pointer iq_dma_wr_ptr [bytes]. A frame holds
+I and Q of the REF, A, B, C channels as int32. IqRing maps the ring as
+numpy memmap, copies out the frames up to the producer pointer and hands
+their space back to the DMA by writing the consumer pointer
+iq_dma_rd_ptr. The ring holds at most size / 32 - 1 frames, the DMA drops
+frames while it is full (iq_dma_overflows).
+
+The ring must be reserved from the linux kernel, like the top 16 MB of
+the 512 MB of the zedboard with `mem=496M` on the kernel command line.
+/dev/mem maps it uncached then, no cache maintenance is needed.
+
+    with CsrLib(0x40000000, 'csr.json') as c:
+        r = IqRing(c, 0x1F000000, 16 << 20)
+        r.start()
+        while True:
+            iq = r.read()  # (n, 4) complex64
+'''
+from numpy import memmap, int32, complex64, empty, concatenate
+
+FRAME_BYTES = 32
+
+
+class IqRing:
+    def __init__(self, c, base, size, dev='/dev/mem', prefix='iq_dma_'):
+        '''
+        c: CsrLib or an object with the same read_reg / write_reg
+        base: physical address of the ring [bytes]
+        size: of the ring [bytes], a multiple of FRAME_BYTES
+        dev: file to map, the offset into it is `base`
+        '''
+        if size % FRAME_BYTES != 0:
+            raise ValueError('size must be a multiple of FRAME_BYTES')
+        self.c = c
+        self.base = base
+        self.size = size
+        self.prefix = prefix
+        self.n = size // FRAME_BYTES
+        self.frames = memmap(
+            dev, int32, 'r', offset=base, shape=(self.n, 4, 2)
+        )
+        # consumer pointer [frames]
+        self.rd = 0
+
+    def start(self):
+        ''' reset both pointers and start the DMA '''
+        w = self.c.write_reg
+        w(self.prefix + 'enable', 0)
+        w(self.prefix + 'base', self.base)
+        w(self.prefix + 'size', self.size)
+        w(self.prefix + 'rd_ptr', 0)
+        self.rd = 0
+        w(self.prefix + 'enable', 1)
+
+    def stop(self):
+        self.c.write_reg(self.prefix + 'enable', 0)
+
+    def get_overflows(self):
+        ''' number of frames dropped by the DMA since power up '''
+        return self.c.read_reg(self.prefix + 'overflows')
+
+    def available(self):
+        ''' number of frames waiting to be read '''
+        wr = self.c.read_reg(self.prefix + 'wr_ptr') // FRAME_BYTES
+        return (wr - self.rd) % self.n
+
+    def read(self, n=None):
+        '''
+        up to n frames (all waiting ones if None), oldest first,
+        as (n, 4) complex64 array. Their space is released to the DMA.
+        '''
+        n_ = self.available()
+        if n is not None:
+            n_ = min(n, n_)
+        # copy out before releasing, the part after the wrap is in front
+        i1 = min(self.rd + n_, self.n)
+        raw = concatenate((
+            self.frames[self.rd:i1], self.frames[:n_ - (i1 - self.rd)]
+        ))
+        self.rd = (self.rd + n_) % self.n
+        self.c.write_reg(self.prefix + 'rd_ptr', self.rd * FRAME_BYTES)
+        iq = empty((n_, 4), complex64)
+        iq.real = raw[:, :, 0]
+        iq.imag = raw[:, :, 1]
+        return iq
+
+
+class _DictRegs:
+    ''' stands in for CsrLib in the self check '''
+    def __init__(self):
+        self.regs = {}
+
+    def read_reg(self, name):
+        return self.regs.get(name, 0)
+
+    def write_reg(self, name, value):
+        self.regs[name] = value
+
+
+def main():
+    '''
+    self check and benchmark on a file-backed ring, with a thread
+    following the pointer rules of iq_dma.py as producer
+    '''
+    import threading
+    from tempfile import NamedTemporaryFile
+    from time import perf_counter
+    from numpy import arange
+
+    N_FRAMES = 200000
+    base = 4096
+    size = 4096 * FRAME_BYTES
+    c = _DictRegs()
+
+    def producer(fName, n_frames):
+        ring = memmap(
+            fName, int32, 'r+', offset=base, shape=(size // FRAME_BYTES, 8)
+        )
+        n = len(ring)
+        wr = 0
+        i = 0
+        while i < n_frames:
+            rd = c.read_reg('iq_dma_rd_ptr') // FRAME_BYTES
+            # write up to the frame before rd_ptr, in bulk
+            n_ = min((rd - wr - 1) % n, n - wr, n_frames - i)
+            if n_ == 0:
+                continue
+            ring[wr:wr + n_] = (arange(i, i + n_)[:, None] * 8 +
+                                arange(8)) * ([1, -1] * 4)
+            i += n_
+            wr = (wr + n_) % n
+            c.write_reg('iq_dma_wr_ptr', wr * FRAME_BYTES)
+
+    with NamedTemporaryFile() as f:
+        f.truncate(base + size)
+        r = IqRing(c, base, size, dev=f.name)
+        r.start()
+        assert c.read_reg('iq_dma_enable') == 1 and r.available() == 0
+
+        th = threading.Thread(target=producer, args=(f.name, N_FRAMES))
+        th.start()
+        i = 0
+        while i < N_FRAMES:
+            iq = r.read()
+            if len(iq) == 0:
+                continue
+            ii = arange(i, i + len(iq))[:, None] * 8 + arange(0, 8, 2)
+            assert (iq.real == ii).all() and (iq.imag == -ii - 1).all(), i
+            i += len(iq)
+        th.join()
+        assert r.available() == 0
+        print('{:d} frames in order'.format(N_FRAMES))
+
+        # throughput of read() on a full ring
+        ts = perf_counter()
+        for i in range(1000):
+            c.write_reg('iq_dma_wr_ptr', (r.rd - 1) % r.n * FRAME_BYTES)
+            r.read()
+        dt = perf_counter() - ts
+        print('read(): {:.1f} MFrames / s'.format(1000 * (r.n - 1) / dt / 1e6))
+
+        # size limited read across the wrap around
+        c.write_reg('iq_dma_wr_ptr', 5 * FRAME_BYTES)
+        r.rd = r.n - 3
+        assert r.available() == 8 and len(r.read(6)) == 6
+        assert r.rd == 3 and r.available() == 2
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,9 @@
 import logging
+import json
+import time
+import threading
+from queue import Queue, Empty
+from collections import defaultdict, deque, OrderedDict
 import paho.mqtt.client as mqtt
 
 log = logging.getLogger('mqtt_pvs')
@@ -38,15 +43,43 @@ class MqttPvs:
                 'vvm_iir':      [None, 0, 13, True],
                 'vvm_bla':      [None, 0, 13, lambda x: int(x / 123.4)]
             }
+
+    commit_regs:
+        list of `commit` CSR names of shadow register groups, like
+        ['vvm_pulse_commit']. After writing a PV to the FPGA, the commit CSR
+        sharing its name prefix (vvm_pulse_) is written to make it effective.
+        A batch is committed only once, after all its registers are written.
+
+    max_queue:
+        maximum number of different topics waiting in the outbound
+        PublishQueue `pq`, which should be used for all publishing
+
+    batch updates:
+        publishing a json object like {"vvm_iir": 7, "vvm_ddc_deci": 200}
+        to <prefix>batch sets several PVs at once. The whole batch is range
+        checked first and rejected if any value is invalid. Accepted batches
+        are queued and only written by apply_batches(), which the main loop
+        calls between measurement cycles. An acknowledgment is published to
+        <prefix>batch_ack like this:
+            {"applied": {"vvm_iir": 7.0, ...}, "latency": 0.021}
+        or on rejection:
+            {"applied": {}, "error": "vvm_iir out of range"}
     '''
-    def __init__(self, args, prefix, pvs, c=None):
+    def __init__(
+        self, args, prefix, pvs, c=None, commit_regs=None, max_queue=64
+    ):
         self.isInit = False
         self.c = c
         self.prefix = prefix
         self.pvs = pvs
+        self.commit_regs = commit_regs or []
+
+        # Validated batches waiting for apply_batches(): (timestamp, dict)
+        self.batch_q = Queue()
 
         self.mq = mqtt.Client('vvm_daemon', True)
         self.mq.enable_logger(log)
+        self.pq = PublishQueue(self.mq, max_queue)
 
         for k, v in self.pvs.items():
             val = v[0]
@@ -59,6 +92,8 @@ class MqttPvs:
             # Subscribe to the mqtt topic of <prefix>/<parameter name>
             self.mq.message_callback_add(self.prefix + k, self.on_pv_msg)
 
+        self.mq.message_callback_add(self.prefix + 'batch', self.on_batch_msg)
+
         self.mq.on_connect = self.on_connect
         self.mq.connect_async(args.mqtt_server, args.mqtt_port, 60)
         self.mq.loop_start()
@@ -84,17 +119,78 @@ class MqttPvs:
             return
         self.set_par(k, val)
 
-    def set_par(self, par_name, val):
+    def on_batch_msg(self, client, user, m):
+        ''' validate a json batch of settings and queue it '''
+        ts = time.time()
+        try:
+            batch = json.loads(m.payload)
+            if type(batch) is not dict:
+                raise ValueError('not a json object')
+            batch = {k: float(v) for k, v in batch.items()}
+        except (TypeError, ValueError) as e:
+            log.warning("batch rejected: %s", e)
+            self.publish_ack({}, error=str(e))
+            return
+
+        for k, val in batch.items():
+            err = self.check_par(k, val)
+            if err is not None:
+                log.warning("batch rejected: %s", err)
+                self.publish_ack({}, error=err)
+                return
+
+        self.batch_q.put((ts, batch))
+
+    def apply_batches(self):
+        '''
+        write all queued batches to local members and FPGA registers.
+        To be called from the measurement loop between cycles, such that
+        readings are never taken with a half-applied batch.
+        '''
+        while True:
+            try:
+                ts, batch = self.batch_q.get_nowait()
+            except Empty:
+                return
+            for k, val in batch.items():
+                self.set_par(k, val, False)
+            self.commit(batch.keys())
+            self.publish_ack(batch, latency=time.time() - ts)
+
+    def publish_ack(self, applied, **kwargs):
+        kwargs['applied'] = applied
+        # not replaced by the next acknowledgment, unlike values
+        self.pq.publish(
+            self.prefix + 'batch_ack', json.dumps(kwargs), keep=True
+        )
+
+    def check_par(self, par_name, val):
+        ''' returns an error message or None if val can be written '''
         # Find name in pv dict
         if par_name not in self.pvs:
-            log.warning("%s is not a known parameter", par_name)
-            return
+            return "{} is not a known parameter".format(par_name)
         pv = self.pvs[par_name]
 
         # Range check
         if not pv[1] <= val <= pv[2]:
-            log.warning("%s cannot be set to %s: out of range", par_name, val)
+            return "{} cannot be set to {}: out of range".format(par_name, val)
+        return None
+
+    def commit(self, par_names):
+        ''' write the commit CSRs of all shadow registers in par_names '''
+        if self.c is None:
+            return
+        for reg in self.commit_regs:
+            pre = reg[:-len('commit')]
+            if any(k.startswith(pre) for k in par_names):
+                self.c.write_reg(reg, 1)
+
+    def set_par(self, par_name, val, commit=True):
+        err = self.check_par(par_name, val)
+        if err is not None:
+            log.warning(err)
             return
+        pv = self.pvs[par_name]
 
         # Write value to local member
         setattr(self, par_name, val)
@@ -110,7 +206,165 @@ class MqttPvs:
 
             # Write to hardware
             self.c.write_reg(par_name, rawval)
+            if commit:
+                self.commit([par_name])
 
             log.info("%s = %s (FPGA: %s)", par_name, val, rawval)
             return
         log.info("%s = %s", par_name, val)
+
+
+class ChangePublisher:
+    '''
+    Publish-on-change for result topics, to save broker bandwidth
+
+    a value (or a list of values) is only published when any of its elements
+    differs from the last published one by more than the deadband, or when
+    the topic has been silent for longer than the maximum interval.
+
+    mq:
+        paho mqtt client or PublishQueue to publish with
+
+    prefix:
+        prepended to the topic name when publishing
+
+    pvs:
+        MqttPvs instance. Deadband and maximum interval [s] of topic NAME
+        are read from its members `db_NAME` and `dt_NAME` on every call,
+        hence they are mqtt settable. Both default to 0 if not defined,
+        which means publish on every call.
+    '''
+    def __init__(self, mq, prefix, pvs):
+        self.mq = mq
+        self.prefix = prefix
+        self.pvs = pvs
+
+        # topic name: (timestamp, values) of last publish
+        self.last = {}
+
+        # topic name: number of messages
+        self.n_sent = defaultdict(int)
+        self.n_suppressed = defaultdict(int)
+
+    def publish(self, name, vals, ts=None):
+        '''
+        publish vals (number or list of numbers, separated by ,)
+        to <prefix><name> if it changed enough. Returns True if published
+        '''
+        if ts is None:
+            ts = time.time()
+        is_list = not isinstance(vals, (int, float))
+        vals = list(vals) if is_list else [vals]
+
+        db = getattr(self.pvs, 'db_' + name, 0)
+        dt = getattr(self.pvs, 'dt_' + name, 0)
+        if name in self.last:
+            ts_, vals_ = self.last[name]
+            is_changed = any(abs(a - b) > db for a, b in zip(vals, vals_))
+            if not is_changed and ts - ts_ < dt:
+                self.n_suppressed[name] += 1
+                return False
+
+        self.last[name] = (ts, vals)
+        self.mq.publish(
+            self.prefix + name,
+            ','.join([str(v) for v in vals]) if is_list else vals[0]
+        )
+        self.n_sent[name] += 1
+        return True
+
+    def get_counts(self):
+        ''' returns total number of (sent, suppressed) messages '''
+        return sum(self.n_sent.values()), sum(self.n_suppressed.values())
+
+
+class PublishQueue:
+    '''
+    Bounded outbound queue in front of the paho client
+
+    paho queues everything which is published, without limit. When the broker
+    is slow or gone, memory grows and old measurements arrive late in bursts.
+    Here, each topic has at most one pending message: publishing to a topic
+    which is still waiting replaces its payload (latest value wins) and the
+    old one is counted as dropped. If more than `maxlen` topics are pending,
+    the oldest one is dropped.
+
+    Messages published with keep=True (like acknowledgments) are never
+    replaced. They are only dropped, oldest first, when more than
+    `max_keep` of them pile up while the broker is gone.
+
+    A background thread hands messages to paho while it is connected,
+    with at most `max_inflight` of them not yet written to the socket.
+    '''
+    def __init__(self, mq, maxlen=64, max_inflight=8, max_keep=256):
+        self.mq = mq
+        self.maxlen = maxlen
+        self.max_inflight = max_inflight
+        self.max_keep = max_keep
+
+        # topic: (payload, qos, retain)
+        self.q = OrderedDict()
+        # (topic, payload, qos, retain)
+        self.q_keep = deque()
+        # MQTTMessageInfo of messages handed to paho
+        self.inflight = deque()
+
+        self.n_sent = 0
+        self.n_dropped = 0
+
+        self.cv = threading.Condition()
+        t = threading.Thread(target=self._send_thread, daemon=True)
+        t.start()
+
+    def publish(self, topic, payload=None, qos=0, retain=False, keep=False):
+        ''' same arguments as paho publish(), never blocks '''
+        with self.cv:
+            if keep:
+                if len(self.q_keep) >= self.max_keep:
+                    self.q_keep.popleft()
+                    self.n_dropped += 1
+                self.q_keep.append((topic, payload, qos, retain))
+            else:
+                if topic in self.q:
+                    self.n_dropped += 1
+                elif len(self.q) >= self.maxlen:
+                    self.q.popitem(last=False)
+                    self.n_dropped += 1
+                self.q[topic] = (payload, qos, retain)
+            self.cv.notify()
+
+    def get_depth(self):
+        ''' number of messages waiting to be handed to paho '''
+        with self.cv:
+            return len(self.q) + len(self.q_keep)
+
+    def _is_ready(self):
+        ''' True if paho can take another message '''
+        if not self.mq.is_connected():
+            # paho forgets its outgoing packets on a re-connect
+            self.inflight.clear()
+            return False
+        # qos > 0 messages can finish out of order
+        self.inflight = deque(
+            info for info in self.inflight if not info.is_published()
+        )
+        return len(self.inflight) < self.max_inflight
+
+    def _send_thread(self):
+        while True:
+            with self.cv:
+                while not (self.q_keep or self.q) or not self._is_ready():
+                    self.cv.wait(0.1)
+                if self.q_keep:
+                    msg = self.q_keep.popleft()
+                else:
+                    topic, (payload, qos, retain) = self.q.popitem(last=False)
+                    msg = (topic, payload, qos, retain)
+            info = self.mq.publish(*msg)
+            with self.cv:
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.inflight.append(info)
+                    self.n_sent += 1
+                else:
+                    # paho did not queue it and will never publish it
+                    self.n_dropped += 1
@@ -2,8 +2,9 @@
 Helper functions specific to the VVM hardware
 '''
 import logging
-from numpy import int32, load, argmin, zeros, log10
-from time import sleep
+from numpy import int32, load, argmin, zeros, log10, stack, asarray, \
+    atleast_1d, arange, exp, pi, outer, angle, degrees, conj, ones, \
+    hanning, hamming, blackman, roll
 from struct import pack, unpack
 
 from .bitbang import SPI, I2C
@@ -129,16 +130,25 @@ def checkClockRegions(c):
 
 
 def initLTC(c, check_align=False):
+    '''
+    on CsrLibLegacyAdapter, the register accesses are batched into a few
+    transaction scripts for litex_server_light
+    '''
+    with c.batch():
+        _initLTC(c, check_align)
+
+
+def _initLTC(c, check_align):
     log.info("Resetting LTC2175")
     ltc_spi = LTC_SPI(c, "spi_r", "spi_w")
 
     # Reset the ADC chip, this seems to glitch the DCO clock!
     ltc_spi.set_ltc_reg(0, 0x80)
-    sleep(2e-3)
+    c.wait(2e-3)
 
     # Reset EVERY register on sys and sample clock domain and re-init ISERDES
     c.write_reg('ctrl_reset', 1)
-    sleep(2e-3)
+    c.wait(2e-3)
 
     # Make ADC output 0x00000001 value samples and align ISERDES
     ltc_spi.setTp(1)
@@ -184,9 +194,77 @@ def twos_comps(val, bits):
     return val_
 
 
-def getSamples(c, CH, N=None):
-    samples = c.read_mem('sample{:}'.format(CH), N)
-    return twos_comps(samples, 14) / 2**13
+def getSamples(c, CH, N=None, rotate=None, n_acc=1):
+    '''
+    rotate: for circular mode acquisitions (acq_trig_circular = 1).
+    The whole memory is read and rotated such that the trigger sample
+    ends up at index `rotate`, then truncated to N samples.
+
+    n_acc: for accumulate mode acquisitions (acq_acc_count = n_acc),
+    the sum is divided by it.
+    '''
+    if rotate is None:
+        samples = c.read_mem('sample{:}'.format(CH), N)
+    else:
+        samples = c.read_mem('sample{:}'.format(CH))
+        samples = roll(samples, rotate - c.read_reg('acq_trig_addr'))[:N]
+    # sign extended to 32 bit by the gateware
+    return samples.astype(int32) / 2**13 / max(n_acc, 1)
+
+
+def getAllSamples(c, N=None, n_ch=4, rotate=None, n_acc=1):
+    ''' samples of all channels of one acquisition, (n_ch, N) '''
+    return stack([
+        getSamples(c, ch, N, rotate, n_acc) for ch in range(n_ch)
+    ])
+
+
+def getSegments(c, n_seg, n_ch=4):
+    '''
+    samples and trigger timestamps of a segmented acquisition
+    (acq_trig_segments = log2(n_seg))
+
+    returns
+      samples: (n_ch, n_seg, N / n_seg) array, one bulk read per channel
+      ts: sample clock counter at each trigger, (n_seg, ) uint32.
+          Differences divided by fs are the trigger spacings [s]
+    '''
+    samples = getAllSamples(c, n_ch=n_ch)
+    ts = c.read_mem('acq_ts', n_seg)
+    return samples.reshape((n_ch, n_seg, -1)), ts
+
+
+WINDOWS = {
+    'hann': hanning, 'hamming': hamming, 'blackman': blackman, 'boxcar': ones
+}
+
+# DFT kernels of dft_bank() by (N, fs, frequencies, window)
+_dft_kernels = {}
+
+
+def dft_bank(samples, f_bbs, fs, window='hann'):
+    '''
+    windowed DFT of all channels at arbitrary frequencies, not restricted
+    to the FFT bins. There is no scalloping loss for tones at f_bbs.
+    Like one Goertzel filter per frequency, but done as a single matrix
+    product over all channels, with a cached kernel.
+
+    samples: (n_ch, N) array
+    f_bbs: baseband frequencies [Hz], below fs / 2
+    returns the complex amplitudes (n_ch, len(f_bbs)),
+    abs() gives the peak amplitude of a tone
+    '''
+    samples = asarray(samples)
+    N = samples.shape[-1]
+    key = (N, fs, tuple(f_bbs), window)
+    if key not in _dft_kernels:
+        if len(_dft_kernels) > 16:
+            _dft_kernels.clear()
+        w = WINDOWS[window](N)
+        _dft_kernels[key] = (w * (2 / w.sum()))[:, None] * exp(
+            -2j * pi / fs * outer(arange(N), f_bbs)
+        )
+    return samples @ _dft_kernels[key]
 
 
 def getNyquist(f, fs):
@@ -246,6 +324,17 @@ def get_phases(c):
     return phs
 
 
+def getTrace(c, vvm_ddc_shift, N=None):
+    '''
+    mag / phase trace of the last vvm_trace capture, one bulk read per
+    value. Returns mags (4, N) [dbFs] and phases (3, N) against REF [degree]
+    '''
+    vals = stack([c.read_mem('trace{:}'.format(i), N) for i in range(7)])
+    mags = vals[:4] / (1 << 21) * (1 << (vvm_ddc_shift - 1))
+    phases = twos_comps(vals[4:], 22) / (1 << 21) * 180
+    return 20 * log10(mags), phases
+
+
 class CalHelper:
     ''' calibration for magnitude and phase readings '''
     def __init__(self, cal_file, vvm_ddc_shift=None, c=None, fs=None):
@@ -284,6 +373,62 @@ class CalHelper:
             raw[i] += self.get_cals(f_)[0][i]
         return raw
 
+    def get_tones(self, samples, f, f_ref=None):
+        '''
+        calibrated magnitudes and phases of several tones, measured in
+        software on one acquisition of all channels (getAllSamples())
+
+        f: RF frequencies of the tones [Hz]
+
+        f_ref: None to measure phases against REF at the same frequency.
+               Otherwise against M times the REF phase at f_ref, with
+               M = round(f / f_ref), like the vvm_pp_mult factors do.
+
+        returns mags (len(f), 4) [dBm] and phases (len(f), 3) [deg]
+        '''
+        f = atleast_1d(asarray(f, float))
+        f_all = f if f_ref is None else list(f) + [f_ref]
+        f_bbs, invs = zip(*[getNyquist(f_, self.fs) for f_ in f_all])
+        X = dft_bank(samples, f_bbs, self.fs)
+        # undo the inverted spectrum of odd nyquist bands: RF phases
+        for i, inv in enumerate(invs):
+            if inv:
+                X[:, i] = conj(X[:, i])
+
+        if f_ref is None:
+            ref = X[0]
+            Ms = 1
+        else:
+            ref = X[0, -1]
+            X = X[:, :-1]
+            Ms = (f / f_ref).round()
+
+        cals = [self.get_cals(f_) for f_ in f]
+        mags = 20 * log10(abs(X.T)) + [c[0] for c in cals]
+        phases = degrees(angle(X[1:] * exp(-1j * Ms * angle(ref)))).T
+        phases += [c[1] for c in cals]
+        return mags, (phases + 180) % 360 - 180
+
+    def get_trace(self, f, vvm_ddc_shift=None, N=None):
+        '''
+        calibrated version of getTrace()
+        f: measurement frequencies of the 4 channels [Hz]
+        returns mags (4, N) [dBm] and phases (3, N) [deg]
+        '''
+        if vvm_ddc_shift is None:
+            vvm_ddc_shift = self.vvm_ddc_shift
+        mags, phases = getTrace(self.c, vvm_ddc_shift, N)
+        for i, f_ in enumerate(f):
+            power_cal, phase_cal = self.get_cals(f_)
+            mags[i] += power_cal[i]
+            if i == 0:
+                continue
+            f_bb, isInverted = getNyquist(f_, self.fs)
+            if isInverted:
+                phases[i - 1] *= -1
+            phases[i - 1] += phase_cal[i - 1]
+        return mags, phases
+
     def get_phases(self, f, Ms=None):
         '''
         f is the measurement frequency [Hz]
@@ -299,5 +444,100 @@ class CalHelper:
             f_bb, isInverted = getNyquist(f_, self.fs)
             if isInverted:
                 raw[i] *= -1
-            raw[i] += self.get_cals(f_)[0][i]
+            raw[i] += self.get_cals(f_)[1][i]
         return raw
+
+
+class _DictRegs:
+    ''' stands in for CsrLib in the self check '''
+    def __init__(self, regs):
+        self.regs = regs
+
+    def read_reg(self, name):
+        return self.regs[name]
+
+
+def check_cal_helper(fs=117.6e6):
+    ''' CalHelper.get_mags() / get_phases() with one f per channel '''
+    from tempfile import NamedTemporaryFile
+    from numpy import savez, array, allclose
+
+    with NamedTemporaryFile(suffix='.npz') as f:
+        savez(
+            f, f_test=array([1e7, 1e9]),
+            power_cal_db=array([[1, 2, 3, 4], [5, 6, 7, 8]]),
+            phase_cal_deg=array([[10, 20, 30], [40, 50, 60]])
+        )
+        f.flush()
+        cal = CalHelper(f.name, 2, fs=fs)
+    # 0 dBFS and 0 degree raw readings
+    regs = {'vvm_mag{:d}'.format(i): 1 << 20 for i in range(4)}
+    regs.update({'vvm_phase{:d}'.format(i): 0 for i in range(1, 4)})
+    cal.c = _DictRegs(regs)
+
+    # like vvm_daemon.py: REF, A close to 1e7 and B, C close to 1e9
+    f = [2e7, 3e7, 0.9e9, 1.1e9]
+    assert allclose(cal.get_mags(f), [1, 2, 7, 8])
+    assert allclose(cal.get_phases(f[1:]), [10, 50, 60])
+
+
+def main():
+    ''' self check of CalHelper, get_tones() on synthetic samples '''
+    from tempfile import NamedTemporaryFile
+    from time import perf_counter
+    from numpy import savez, cos, round, array, allclose, random
+
+    fs = 117.6e6
+    N = 4096
+    f_ref = 499.6e6
+    n_h = 32
+    hs = arange(1, n_h + 1)
+    amps = 0.5 / hs
+    random.seed(0)
+    ths = random.uniform(-pi, pi, (4, n_h))
+    n = arange(N)
+    samples = zeros((4, N))
+    for ch in range(4):
+        for h, a, th in zip(hs, amps, ths[ch]):
+            samples[ch] += a * cos(2 * pi * h * f_ref / fs * n + th)
+    # 14 bit ADC
+    samples = round(samples * (1 << 13)) / (1 << 13)
+
+    with NamedTemporaryFile(suffix='.npz') as f:
+        savez(
+            f, f_test=array([1e7, 1e9]), power_cal_db=zeros((2, 4)),
+            phase_cal_deg=zeros((2, 3))
+        )
+        f.flush()
+        cal = CalHelper(f.name, fs=fs)
+
+    ts = perf_counter()
+    mags, phases = cal.get_tones(samples, hs * f_ref, f_ref)
+    dt = perf_counter() - ts
+    print('{:d} tones x 4 channels in {:.1f} ms'.format(n_h, dt * 1e3))
+    ts = perf_counter()
+    mags, phases = cal.get_tones(samples, hs * f_ref, f_ref)
+    dt = perf_counter() - ts
+    print('again, with cached kernel: {:.1f} ms'.format(dt * 1e3))
+
+    # against the REF phase of the fundamental
+    expected = degrees(ths[1:] - hs * ths[0, 0]).T
+    err_ph = (phases - expected + 180) % 360 - 180
+    err_mag = mags - 20 * log10(amps)[:, None]
+    print('max. error: {:.3f} dB, {:.3f} deg'.format(
+        abs(err_mag).max(), abs(err_ph).max()
+    ))
+    assert abs(err_mag).max() < 0.05 and abs(err_ph).max() < 0.5
+
+    # against REF at the same frequency
+    mags, phases = cal.get_tones(samples, hs * f_ref)
+    expected = degrees(ths[1:] - ths[0]).T
+    err_ph = (phases - expected + 180) % 360 - 180
+    assert allclose(err_ph, 0, atol=0.5)
+
+    check_cal_helper(fs)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
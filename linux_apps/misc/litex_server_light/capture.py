@@ -0,0 +1,67 @@
+'''
+Binary log of the etherbone traffic of a RemoteServer
+
+The file starts with MAGIC, followed by one entry per request:
+
+    ENTRY header, request packet bytes, reply packet bytes
+
+t_rx is the time the request was received [s] since the start of the
+capture, t_service how long it took the hardware thread to handle it [s].
+Requests without reply have an empty reply.
+'''
+import struct
+import time
+from collections import namedtuple
+
+MAGIC = b'EBCAP1\n'
+
+# t_rx, t_service, client, flags, request length, reply length
+ENTRY = struct.Struct('<dfHBII')
+
+FLAG_UDP = 1
+
+Entry = namedtuple(
+    'Entry', ['t_rx', 't_service', 'client', 'flags', 'request', 'reply']
+)
+
+
+class CaptureWriter:
+    def __init__(self, fName):
+        self.f = open(fName, 'wb')
+        self.f.write(MAGIC)
+        self.t0 = time.perf_counter()
+        # small integer ids for the clients
+        self.clients = {}
+
+    def write(self, client, flags, t_rx, t_service, request, reply=None):
+        '''
+        client: any hashable identifying the connection
+        t_rx: time.perf_counter() when the request came in
+        '''
+        if client not in self.clients:
+            self.clients[client] = len(self.clients) & 0xFFFF
+        reply = b'' if reply is None else bytes(reply)
+        self.f.write(ENTRY.pack(
+            t_rx - self.t0, t_service, self.clients[client], flags,
+            len(request), len(reply)
+        ))
+        self.f.write(request)
+        self.f.write(reply)
+
+    def close(self):
+        self.f.close()
+
+
+def read_capture(fName):
+    ''' yields the Entry tuples of a capture file '''
+    with open(fName, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a capture file: ' + fName)
+        while True:
+            bs = f.read(ENTRY.size)
+            if len(bs) < ENTRY.size:
+                return
+            t_rx, t_service, client, flags, n_req, n_rep = ENTRY.unpack(bs)
+            yield Entry(
+                t_rx, t_service, client, flags, f.read(n_req), f.read(n_rep)
+            )
@@ -2,6 +2,7 @@ import os
 import pwd
 import grp
 import mmap
+import struct
 
 
 def drop_privileges(uid_name='nobody', gid_name='nogroup'):
@@ -26,20 +27,29 @@ def drop_privileges(uid_name='nobody', gid_name='nogroup'):
 
 
 class CommDevmem:
-    def __init__(self, adr_offset=None, debug=False):
+    def __init__(self, adr_offset=None, debug=False, dev="/dev/mem"):
+        '''
+        dev: /dev/mem or a regular file, which is mapped in its full size
+             from adr_offset on. To test without hardware.
+        '''
         self.debug = debug
         if adr_offset is None:
             adr_offset = 0
         self.adr_offset = adr_offset
+        self.dev = dev
 
     def open(self):
         if hasattr(self, "sysfs"):
             return
-        self.sysfs = open("/dev/mem", "r+b")
-        drop_privileges()
+        self.sysfs = open(self.dev, "r+b")
+        size = 0x38000000
+        if os.path.isfile(self.dev):
+            size = os.path.getsize(self.dev) - self.adr_offset
+        else:
+            drop_privileges()
         self.sysfs.flush()
         self.mmap = mmap.mmap(
-            self.sysfs.fileno(), 0x38000000, offset=self.adr_offset
+            self.sysfs.fileno(), size, offset=self.adr_offset
         )
 
     def close(self):
@@ -51,24 +61,29 @@ class CommDevmem:
         del self.sysfs
 
     def read(self, addr, length=None):
-        data = []
+        '''
+        read one word (length=None) or a list of `length` consecutive words.
+        A burst is copied out of the mmap in one go.
+        '''
         length_int = 1 if length is None else length
         if addr % 4 > 0:
             print("warning: un-aligned memory access", hex(addr))
-        self.mmap.seek(addr)
-        for i in range(length_int):
-            value = int.from_bytes(self.mmap.read(4), byteorder="little")
-            if self.debug:
+        data = struct.unpack_from(
+            "<{:d}I".format(length_int), self.mmap, addr
+        )
+        if self.debug:
+            for i, value in enumerate(data):
                 print("read {:08x} @ {:08x}".format(value, addr + 4 * i))
-            if length is None:
-                return value
-            data.append(value)
-        return data
+        if length is None:
+            return data[0]
+        return list(data)
 
     def write(self, addr, data):
+        ''' write one word or a list of words to consecutive addresses '''
         data = data if isinstance(data, list) else [data]
-        self.mmap.seek(addr)
-        for i, value in enumerate(data):
-            self.mmap.write(value.to_bytes(4, byteorder="little"))
-            if self.debug:
+        self.mmap[addr:addr + 4 * len(data)] = struct.pack(
+            "<{:d}I".format(len(data)), *data
+        )
+        if self.debug:
+            for i, value in enumerate(data):
                 print("write {:08x} @ {:08x}".format(value, addr + 4 * i))
@@ -0,0 +1 @@
+../../lib/csr_script.py
\ No newline at end of file
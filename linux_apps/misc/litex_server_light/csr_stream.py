@@ -0,0 +1 @@
+../../lib/csr_stream.py
\ No newline at end of file
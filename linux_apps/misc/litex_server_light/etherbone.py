@@ -1,3 +1,13 @@
+'''
+Etherbone packet codec
+
+Works on bytes with struct, in a single pass over the packet. Addresses and
+data words of a record are converted with one struct call each.
+
+try:
+    python3 etherbone.py
+to run a round-trip check, a receive check and a throughput benchmark
+'''
 import math
 import struct
 
@@ -9,52 +19,6 @@ class HeaderField:
         self.width = width
 
 
-class Header:
-    def __init__(self, fields, length, swap_field_bytes=True):
-        self.fields = fields
-        self.length = length
-        self.swap_field_bytes = swap_field_bytes
-
-    def get_layout(self):
-        layout = []
-        for k, v in sorted(self.fields.items()):
-            layout.append((k, v.width))
-        return layout
-
-    def get_field(self, obj, name, width):
-        if "_lsb" in name:
-            field = getattr(obj, name.replace("_lsb", ""))[:width]
-        elif "_msb" in name:
-            field = getattr(obj, name.replace("_msb", ""))[width:2*width]
-        else:
-            field = getattr(obj, name)
-        if len(field) != width:
-            raise ValueError("Width mismatch on " + name + " field")
-        return field
-
-    def encode(self, obj, signal):
-        r = []
-        for k, v in sorted(self.fields.items()):
-            start = v.byte*8 + v.offset
-            end = start + v.width
-            field = self.get_field(obj, k, v.width)
-            if self.swap_field_bytes:
-                field = reverse_bytes(field)
-            r.append(signal[start:end].eq(field))
-        return r
-
-    def decode(self, signal, obj):
-        r = []
-        for k, v in sorted(self.fields.items()):
-            start = v.byte*8 + v.offset
-            end = start + v.width
-            field = self.get_field(obj, k, v.width)
-            if self.swap_field_bytes:
-                r.append(field.eq(reverse_bytes(signal[start:end])))
-            else:
-                r.append(field.eq(signal[start:end]))
-        return r
-
 etherbone_magic = 0x4e6f
 etherbone_version = 1
 etherbone_packet_header_length = 8
@@ -69,9 +33,6 @@ etherbone_packet_header_fields = {
     "addr_size":        HeaderField(3,  4, 4), # 1=8bits, 2=16bits, 4=32bits, 8=64bits
     "port_size":        HeaderField(3,  0, 4), # Same as above
 }
-etherbone_packet_header = Header(etherbone_packet_header_fields,
-                                 etherbone_packet_header_length,
-                                 swap_field_bytes=True)
 
 # When reading/writing to a FIFO, you don't increase
 # the address after each write.
@@ -90,31 +51,67 @@ etherbone_record_header_fields = {
 
     "rcount":           HeaderField(3,  0, 8), # Reads
 }
-etherbone_record_header = Header(etherbone_record_header_fields,
-                                 etherbone_record_header_length,
-                                 swap_field_bytes=True)
 
 
-def split_bytes(v, n, endianness="big"):
+def compile_fields(fields, length):
+    '''
+    returns a list of (name, shift, mask) to get / set the fields in a
+    header, when the header is taken as one big-endian integer
+    '''
     r = []
-    return v.to_bytes(n, byteorder=endianness)
+    for k, v in sorted(fields.items()):
+        n_bytes = math.ceil(v.width / 8)
+        shift = 8 * (length - v.byte - n_bytes) + v.offset
+        r.append((k, shift, (1 << v.width) - 1))
+    return r
+
+
+packet_header = compile_fields(
+    etherbone_packet_header_fields, etherbone_packet_header_length
+)
+record_header = compile_fields(
+    etherbone_record_header_fields, etherbone_record_header_length
+)
+
 
+def decode_header(obj, fields, bs):
+    ''' set the fields of obj from the header bytes bs '''
+    v = int.from_bytes(bs, "big")
+    for k, shift, mask in fields:
+        setattr(obj, k, (v >> shift) & mask)
 
-def merge_bytes(b, endianness="big"):
-    return int.from_bytes(b, endianness)
 
+def encode_header(obj, fields, length):
+    ''' returns the header bytes from the fields of obj '''
+    v = 0
+    for k, shift, mask in fields:
+        v |= (getattr(obj, k) & mask) << shift
+    return v.to_bytes(length, "big")
 
-def get_field_data(field, datas):
-    v = merge_bytes(datas[field.byte:field.byte+math.ceil(field.width/8)])
-    return (v >> field.offset) & (2**field.width-1)
 
+def pack_words(words):
+    ''' list of 32 bit integers to big-endian bytes '''
+    return struct.pack(">{:d}I".format(len(words)), *words)
 
-class Packet(list):
-    def __init__(self, init=[]):
+
+def unpack_words(bs, offset, n):
+    ''' n big-endian 32 bit words at bs[offset:] to a list of integers '''
+    return list(struct.unpack_from(">{:d}I".format(n), bs, offset))
+
+
+class Packet:
+    def __init__(self, init=b''):
         self.ongoing = False
         self.done = False
-        for data in init:
-            self.append(data)
+        # the encoded bytes
+        self.data = bytes(init)
+        self.encoded = len(self.data) > 0
+
+    def __bytes__(self):
+        return self.data
+
+    def __len__(self):
+        return len(self.data)
 
 
 class EtherboneWrite:
@@ -134,46 +131,34 @@ class EtherboneRead:
 
 
 class EtherboneWrites(Packet):
-    def __init__(self, init=[], base_addr=0, datas=[]):
+    def __init__(self, init=b'', base_addr=0, datas=[]):
         Packet.__init__(self, init)
         self.base_addr = base_addr
-        self.writes = []
-        self.encoded = init != []
-        for data in datas:
-            self.add(EtherboneWrite(data))
+        self.datas = list(datas)
+
+    @property
+    def writes(self):
+        return [EtherboneWrite(d) for d in self.datas]
 
     def add(self, write):
-        self.writes.append(write)
+        self.datas.append(write.data)
 
     def get_datas(self):
-        datas = []
-        for write in self.writes:
-            datas.append(write.data)
-        return datas
+        return self.datas
 
     def encode(self):
         if self.encoded:
             raise ValueError
-        for byte in split_bytes(self.base_addr, 4):
-            self.append(byte)
-        for write in self.writes:
-            for byte in split_bytes(write.data, 4):
-                self.append(byte)
+        self.data = pack_words([self.base_addr] + self.datas)
         self.encoded = True
 
     def decode(self):
         if not self.encoded:
             raise ValueError
-        base_addr = []
-        for i in range(4):
-            base_addr.append(self.pop(0))
-        self.base_addr = merge_bytes(base_addr)
-        self.writes = []
-        while len(self) != 0:
-            write = []
-            for i in range(4):
-                write.append(self.pop(0))
-            self.writes.append(EtherboneWrite(merge_bytes(write)))
+        words = unpack_words(self.data, 0, len(self.data) // 4)
+        self.base_addr = words[0]
+        self.datas = words[1:]
+        self.data = b''
         self.encoded = False
 
     def __repr__(self):
@@ -186,46 +171,34 @@ class EtherboneWrites(Packet):
 
 
 class EtherboneReads(Packet):
-    def __init__(self, init=[], base_ret_addr=0, addrs=[]):
+    def __init__(self, init=b'', base_ret_addr=0, addrs=[]):
         Packet.__init__(self, init)
         self.base_ret_addr = base_ret_addr
-        self.reads = []
-        self.encoded = init != []
-        for addr in addrs:
-            self.add(EtherboneRead(addr))
+        self.addrs = list(addrs)
+
+    @property
+    def reads(self):
+        return [EtherboneRead(a) for a in self.addrs]
 
     def add(self, read):
-        self.reads.append(read)
+        self.addrs.append(read.addr)
 
     def get_addrs(self):
-        addrs = []
-        for read in self.reads:
-            addrs.append(read.addr)
-        return addrs
+        return self.addrs
 
     def encode(self):
         if self.encoded:
             raise ValueError
-        for byte in split_bytes(self.base_ret_addr, 4):
-            self.append(byte)
-        for read in self.reads:
-            for byte in split_bytes(read.addr, 4):
-                self.append(byte)
+        self.data = pack_words([self.base_ret_addr] + self.addrs)
         self.encoded = True
 
     def decode(self):
         if not self.encoded:
             raise ValueError
-        base_ret_addr = []
-        for i in range(4):
-            base_ret_addr.append(self.pop(0))
-        self.base_ret_addr = merge_bytes(base_ret_addr)
-        self.reads = []
-        while len(self) != 0:
-            read = []
-            for i in range(4):
-                read.append(self.pop(0))
-            self.reads.append(EtherboneRead(merge_bytes(read)))
+        words = unpack_words(self.data, 0, len(self.data) // 4)
+        self.base_ret_addr = words[0]
+        self.addrs = words[1:]
+        self.data = b''
         self.encoded = False
 
     def __repr__(self):
@@ -238,7 +211,7 @@ class EtherboneReads(Packet):
 
 
 class EtherboneRecord(Packet):
-    def __init__(self, init=[]):
+    def __init__(self, init=b''):
         Packet.__init__(self, init)
         self.writes = None
         self.reads = None
@@ -251,80 +224,66 @@ class EtherboneRecord(Packet):
         self.byte_enable = 0xf
         self.wcount = 0
         self.rcount = 0
-        self.encoded = init != []
 
+    def decode_from(self, bs, offset=0):
+        '''
+        decode the record starting at bs[offset]
+        returns the offset of the first byte after the record
+        '''
+        decode_header(
+            self,
+            record_header,
+            bs[offset:offset + etherbone_record_header_length]
+        )
+        offset += etherbone_record_header_length
 
-    def get_writes(self):
-        if self.wcount == 0:
-            return None
-        else:
-            writes = []
-            for i in range((self.wcount+1)*4):
-                writes.append(self.pop(0))
-            return EtherboneWrites(writes)
+        self.writes = None
+        if self.wcount > 0:
+            words = unpack_words(bs, offset, self.wcount + 1)
+            offset += 4 * (self.wcount + 1)
+            self.writes = EtherboneWrites(base_addr=words[0], datas=words[1:])
 
-    def get_reads(self):
-        if self.rcount == 0:
-            return None
-        else:
-            reads = []
-            for i in range((self.rcount+1)*4):
-                reads.append(self.pop(0))
-            return EtherboneReads(reads)
+        self.reads = None
+        if self.rcount > 0:
+            words = unpack_words(bs, offset, self.rcount + 1)
+            offset += 4 * (self.rcount + 1)
+            self.reads = EtherboneReads(base_ret_addr=words[0], addrs=words[1:])
+
+        self.encoded = False
+        return offset
 
     def decode(self):
         if not self.encoded:
             raise ValueError
-        header = []
-        for byte in self[:etherbone_record_header.length]:
-            header.append(self.pop(0))
-        for k, v in sorted(etherbone_record_header.fields.items()):
-            setattr(self, k, get_field_data(v, header))
-        self.writes = self.get_writes()
-        if self.writes is not None:
-            self.writes.decode()
-        self.reads = self.get_reads()
-        if self.reads is not None:
-            self.reads.decode()
-        self.encoded = False
-
-    def set_writes(self, writes):
-        self.wcount = len(writes.writes)
-        writes.encode()
-        for byte in writes:
-            self.append(byte)
-
-    def set_reads(self, reads):
-        self.rcount = len(reads.reads)
-        reads.encode()
-        for byte in reads:
-            self.append(byte)
+        offset = self.decode_from(self.data)
+        # keep what is left over, like the next record
+        self.data = self.data[offset:]
 
     def encode(self):
         if self.encoded:
             raise ValueError
+        payload = []
         if self.writes is not None:
-            self.set_writes(self.writes)
+            self.wcount = len(self.writes.datas)
+            self.writes.encode()
+            payload.append(self.writes.data)
         if self.reads is not None:
-            self.set_reads(self.reads)
-        header = 0
-        for k, v in sorted(etherbone_record_header.fields.items()):
-            value = merge_bytes(split_bytes(getattr(self, k),
-                                            math.ceil(v.width/8)),
-                                            "little")
-            header += (value << v.offset+(v.byte*8))
-        for d in split_bytes(header, etherbone_record_header.length):
-            self.insert(0, d)
+            self.rcount = len(self.reads.addrs)
+            self.reads.encode()
+            payload.append(self.reads.data)
+        header = encode_header(
+            self, record_header, etherbone_record_header_length
+        )
+        self.data = header + b''.join(payload)
         self.encoded = True
 
     def __repr__(self, n=0):
         r = "Record {}\n".format(n)
         r += "--------\n"
         if self.encoded:
-            for d in self:
-                r += "{:02x}".format(d)
+            r += self.data.hex()
         else:
-            for k in sorted(etherbone_record_header.fields.keys()):
+            for k in sorted(etherbone_record_header_fields.keys()):
                 r += k + " : 0x{:0x}\n".format(getattr(self, k))
             if self.wcount != 0:
                 r += self.writes.__repr__()
@@ -334,9 +293,8 @@ class EtherboneRecord(Packet):
 
 
 class EtherbonePacket(Packet):
-    def __init__(self, init=[]):
+    def __init__(self, init=b''):
         Packet.__init__(self, init)
-        self.encoded = init != []
         self.records = []
 
         self.magic = etherbone_magic
@@ -347,54 +305,45 @@ class EtherbonePacket(Packet):
         self.pr = 0
         self.pf = 0
 
-    def get_records(self):
+    def get_records(self, offset=etherbone_packet_header_length):
         records = []
-        done = False
-        payload = self
-        while len(payload) != 0:
-            record = EtherboneRecord(payload)
-            record.decode()
+        while offset < len(self.data):
+            record = EtherboneRecord()
+            offset = record.decode_from(self.data, offset)
             records.append(record)
-            payload = record[:]
         return records
 
     def decode(self):
         if not self.encoded:
             raise ValueError
-        header = []
-        for byte in self[:etherbone_packet_header.length]:
-            header.append(self.pop(0))
-        for k, v in sorted(etherbone_packet_header.fields.items()):
-            setattr(self, k, get_field_data(v, header))
+        decode_header(
+            self,
+            packet_header,
+            self.data[:etherbone_packet_header_length]
+        )
         self.records = self.get_records()
+        self.data = b''
         self.encoded = False
 
-    def set_records(self, records):
-        for record in records:
-            record.encode()
-            for byte in record:
-                self.append(byte)
-
     def encode(self):
         if self.encoded:
             raise ValueError
-        self.set_records(self.records)
-        header = 0
-        for k, v in sorted(etherbone_packet_header.fields.items()):
-            value = merge_bytes(split_bytes(getattr(self, k), math.ceil(v.width/8)), "little")
-            header += (value << v.offset+(v.byte*8))
-        for d in split_bytes(header, etherbone_packet_header.length):
-            self.insert(0, d)
+        bs = [encode_header(
+            self, packet_header, etherbone_packet_header_length
+        )]
+        for record in self.records:
+            record.encode()
+            bs.append(record.data)
+        self.data = b''.join(bs)
         self.encoded = True
 
     def __repr__(self):
         r = "Packet\n"
         r += "--------\n"
         if self.encoded:
-            for d in self:
-                r += "{:02x}".format(d)
+            r += self.data.hex()
         else:
-            for k in sorted(etherbone_packet_header.fields.keys()):
+            for k in sorted(etherbone_packet_header_fields.keys()):
                 r += k + " : 0x{:0x}\n".format(getattr(self, k))
             for i, record in enumerate(self.records):
                 r += record.__repr__(i)
@@ -405,22 +354,134 @@ class EtherboneIPC:
     def send_packet(self, socket, packet):
         socket.sendall(bytes(packet))
 
+    @staticmethod
+    def get_packet_length(bs):
+        '''
+        length of the packet at the start of the tcp stream bs,
+        which carries exactly one record.
+        Returns None if not enough bytes are there to tell.
+        '''
+        header_length = \
+            etherbone_packet_header_length + etherbone_record_header_length
+        if len(bs) < header_length:
+            return None
+        wcount, rcount = struct.unpack_from(">BB", bs, header_length - 2)
+        # base address + data words for writes and for reads
+        n_words = wcount + (wcount > 0) + rcount + (rcount > 0)
+        return header_length + 4 * n_words
+
     def receive_packet(self, socket):
         header_length = etherbone_packet_header_length + etherbone_record_header_length
         packet = bytes()
-        while len(packet) < header_length:
-            chunk = socket.recv(header_length - len(packet))
-            if len(chunk) == 0:
-                return 0
-            else:
-                packet += chunk
-        wcount, rcount = struct.unpack(">BB", packet[header_length-2:])
-        counts = wcount + rcount
-        packet_size = header_length + 4*(counts + 1)
+        packet_size = header_length
         while len(packet) < packet_size:
             chunk = socket.recv(packet_size - len(packet))
             if len(chunk) == 0:
                 return 0
             else:
                 packet += chunk
+            # the header itself can arrive in pieces
+            n = self.get_packet_length(packet)
+            if n is not None:
+                packet_size = n
         return packet
+
+
+# Packets as encoded by the previous, list based codec
+GOLDEN = [
+    # (base_addr, datas), (base_ret_addr, addrs) for each record
+    ([((0x1000, [0xdeadbeef]), None)],
+     '4e6f104400000000000f010000001000deadbeef'),
+    ([(None, (0, [0x40000004, 0x40000008]))],
+     '4e6f104400000000000f0002000000004000000440000008'),
+    ([((0x20, [1, 2, 3]), (0x55, [0x100]))],
+     '4e6f104400000000000f030100000020000000010000000200000003'
+     '0000005500000100'),
+    ([((0x20, [1]), None), (None, (0, [4, 8, 12]))],
+     '4e6f104400000000000f01000000002000000001000f0003000000000000000400'
+     '0000080000000c'),
+]
+
+
+def make_packet(recs):
+    p = EtherbonePacket()
+    for w, r in recs:
+        record = EtherboneRecord()
+        if w is not None:
+            record.writes = EtherboneWrites(base_addr=w[0], datas=w[1])
+        if r is not None:
+            record.reads = EtherboneReads(base_ret_addr=r[0], addrs=r[1])
+        p.records.append(record)
+    p.encode()
+    return p
+
+
+def main():
+    from time import perf_counter
+
+    print("round-trip check against golden packets: ", end="")
+    for recs, hx in GOLDEN:
+        bs = bytes(make_packet(recs))
+        assert bs.hex() == hx, bs.hex()
+        p = EtherbonePacket(bs)
+        p.decode()
+        assert p.magic == etherbone_magic and p.version == etherbone_version
+        assert len(p.records) == len(recs)
+        for record, (w, r) in zip(p.records, recs):
+            if w is None:
+                assert record.writes is None
+            else:
+                assert record.writes.base_addr == w[0]
+                assert record.writes.get_datas() == w[1]
+            if r is None:
+                assert record.reads is None
+            else:
+                assert record.reads.base_ret_addr == r[0]
+                assert record.reads.get_addrs() == r[1]
+    print("OK")
+
+    print("receive_packet() of a packet split inside the header: ", end="")
+    import socket
+    import threading
+    from time import sleep
+    bs = bytes(make_packet(GOLDEN[2][0]))
+    a, b = socket.socketpair()
+
+    def send_slowly():
+        for i in range(len(bs)):
+            a.sendall(bs[i:i + 1])
+            sleep(1e-3)
+
+    t = threading.Thread(target=send_slowly)
+    t.start()
+    assert EtherboneIPC().receive_packet(b) == bs
+    t.join()
+    a.close()
+    assert EtherboneIPC().receive_packet(b) == 0
+    b.close()
+    print("OK")
+
+    # Largest read record, like big_read() of the sample memories
+    recs = [(None, (0, list(range(0, 255 * 4, 4))))]
+    bs = bytes(make_packet(recs))
+    N = 2000
+
+    ts = perf_counter()
+    for i in range(N):
+        make_packet(recs)
+    dt = (perf_counter() - ts) / N
+    print("encode: {:6.1f} us / packet, {:5.1f} MB/s".format(
+        dt * 1e6, len(bs) / dt / 1e6
+    ))
+
+    ts = perf_counter()
+    for i in range(N):
+        EtherbonePacket(bs).decode()
+    dt = (perf_counter() - ts) / N
+    print("decode: {:6.1f} us / packet, {:5.1f} MB/s".format(
+        dt * 1e6, len(bs) / dt / 1e6
+    ))
+
+
+if __name__ == "__main__":
+    main()
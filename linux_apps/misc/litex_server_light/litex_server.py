@@ -2,17 +2,113 @@
 import argparse
 import time
 import socket
+import selectors
 import threading
+import queue
 from etherbone import EtherbonePacket, EtherboneRecord, EtherboneWrites
-from etherbone import EtherboneIPC
+from etherbone import EtherboneIPC, etherbone_magic
+from csr_script import SCRIPT_ADDR, run_script
+from capture import CaptureWriter, FLAG_UDP
+from csr_stream import SUBSCRIBE_ADDR, STREAM_ADDR, FLAG_ON_CHANGE, \
+    encode_frame
+
+
+def get_runs(addrs):
+    '''
+    split a list of word addresses into runs of consecutive ones
+    returns [[start_address, n_words], ...]
+    '''
+    runs = []
+    for addr in addrs:
+        if len(runs) > 0 and addr == runs[-1][0] + 4 * runs[-1][1]:
+            runs[-1][1] += 1
+        else:
+            runs.append([addr, 1])
+    return runs
+
+
+class Subscription:
+    ''' registers which are pushed to a tcp client (see csr_stream.py) '''
+    # shortest sampling period [s]
+    MIN_PERIOD = 1e-4
+
+    def __init__(self, client_socket, period, flags, addrs):
+        self.socket = client_socket
+        self.period = max(period, self.MIN_PERIOD)
+        self.on_change = (flags & FLAG_ON_CHANGE) > 0
+        self.runs = get_runs(addrs)
+        self.t_next = time.perf_counter()
+        self.vals = None
+        # rest of a frame the socket did not take yet
+        self.pending = b""
+        # frames dropped because the client did not keep up
+        self.n_dropped = 0
+
+    def send_pending(self):
+        ''' send without blocking, raises OSError on a broken connection '''
+        while len(self.pending) > 0:
+            try:
+                n = self.socket.send(self.pending, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            self.pending = self.pending[n:]
+
+    def push(self, frame):
+        '''
+        send a frame without blocking the hardware thread. It is dropped
+        while the socket has not taken the previous one completely.
+        returns True if the frame was sent or is pending
+        '''
+        self.send_pending()
+        if len(self.pending) > 0:
+            self.n_dropped += 1
+            return False
+        self.pending = bytes(frame)
+        self.send_pending()
+        return True
+
+    def flush(self):
+        ''' blocking, before replying on the same connection '''
+        self.socket.sendall(self.pending)
+        self.pending = b""
 
 
 class RemoteServer(EtherboneIPC):
-    def __init__(self, comm, bind_ip, bind_port=1234):
+    '''
+    One io thread multiplexes all client connections with a selector and
+    cuts the tcp streams into packets. Several packets per connection may
+    be in flight. They are queued, in order, for the hardware thread which
+    is the only one accessing `comm` and sends the replies.
+
+    With udp=True, plain etherbone datagrams are served on the same port
+    number as well. A datagram may carry several records or be a probe.
+    There are no sequence numbers in etherbone, a lost reply is handled
+    by the client sending the datagram again. This is safe for reads,
+    which have no side effect on the memory and are simply executed again.
+
+    A record writing to SCRIPT_ADDR carries a transaction script, which is
+    run locally. Its results are returned to the reads of the same record.
+
+    A record writing to SUBSCRIBE_ADDR turns a tcp connection into a
+    stream of register values, sampled by the hardware thread. Frames are
+    sent without blocking, they are dropped (and counted) while a client
+    does not keep up, so it cannot stall the other clients.
+    '''
+    def __init__(self, comm, bind_ip, bind_port=1234, udp=False,
+                 capture=None):
         self.comm = comm
         self.bind_ip = bind_ip
         self.bind_port = bind_port
-        self.lock = False
+        self.udp = udp
+        # file name to log all requests and replies to, see capture.py
+        self.capture = capture
+        # (socket, packet bytes, udp address, t_rx) for the hardware thread
+        # packet bytes = None: tcp client disconnected
+        # udp address = None: packet came from a tcp client
+        # t_rx = perf_counter() when the packet was received
+        self.q = queue.Queue()
+        # only accessed by the hardware thread
+        self.subs = []
 
     def open(self):
         if hasattr(self, "socket"):
@@ -25,74 +121,271 @@ class RemoteServer(EtherboneIPC):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket_flags, 1)
         self.socket.bind((self.bind_ip, self.bind_port))
+        self.bind_port = self.socket.getsockname()[1]
         print("tcp port: {:d}".format(self.bind_port))
-        self.socket.listen(1)
+        self.socket.listen(16)
+        if self.udp:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket_flags, 1)
+            self.udp_socket.bind((self.bind_ip, self.bind_port))
+            print("udp port: {:d}".format(self.bind_port))
+        if self.capture is not None:
+            self.cw = CaptureWriter(self.capture)
         self.comm.open()
 
     def close(self):
         self.comm.close()
+        if self.capture is not None:
+            self.cw.close()
         if not hasattr(self, "socket"):
             return
         self.socket.close()
         del self.socket
+        if self.udp:
+            self.udp_socket.close()
+            del self.udp_socket
 
-    def _serve_thread(self):
-        while True:
-            client_socket, addr = self.socket.accept()
-            print("Connected with " + addr[0] + ":" + str(addr[1]))
-            try:
-                while True:
-                    try:
-                        packet = self.receive_packet(client_socket)
-                        if packet == 0:
-                            break
-                    except Exception:
-                        break
-                    packet = EtherbonePacket(packet)
-                    packet.decode()
+    def handle_packet(self, packet, client_socket=None):
+        '''
+        execute all records of an encoded packet in order
+        returns the encoded reply packet or None if there is nothing to reply
 
-                    record = packet.records.pop()
+        client_socket: the tcp connection, None for udp
+        '''
+        packet = EtherbonePacket(packet)
+        packet.decode()
+        if packet.magic != etherbone_magic:
+            print("warning: dropped packet with wrong magic")
+            return None
 
-                    # wait for lock
-                    while self.lock:
-                        time.sleep(0.01)
+        if packet.pf:
+            # probe: reply with the header only
+            packet = EtherbonePacket()
+            packet.pr = 1
+            packet.encode()
+            return packet
 
-                    # set lock
-                    self.lock = True
+        replies = []
+        for record in packet.records:
+            if record.writes is not None and \
+                    record.writes.base_addr == SCRIPT_ADDR:
+                replies += self.handle_script(record)
+                continue
 
-                    # handle writes:
-                    if record.writes is not None:
-                        self.comm.write(
-                            record.writes.base_addr, record.writes.get_datas()
-                        )
+            if record.writes is not None and \
+                    record.writes.base_addr == SUBSCRIBE_ADDR:
+                replies += self.handle_subscribe(record, client_socket)
+                continue
 
-                    # handle reads
-                    if record.reads is not None:
-                        reads = []
-                        for addr in record.reads.get_addrs():
-                            reads.append(self.comm.read(addr))
+            # handle writes:
+            if record.writes is not None:
+                datas = record.writes.get_datas()
+                if record.wff:
+                    # FIFO, all words go to the same address
+                    for data in datas:
+                        self.comm.write(record.writes.base_addr, data)
+                else:
+                    # burst write to consecutive addresses
+                    self.comm.write(record.writes.base_addr, datas)
 
-                        record = EtherboneRecord()
-                        record.writes = EtherboneWrites(datas=reads)
-                        record.wcount = len(record.writes)
+            # handle reads, one burst per run of consecutive addresses
+            if record.reads is not None:
+                reads = []
+                for addr, n in get_runs(record.reads.get_addrs()):
+                    reads += self.comm.read(addr, n)
 
-                        packet = EtherbonePacket()
-                        packet.records = [record]
-                        packet.encode()
-                        self.send_packet(client_socket, packet)
+                reply = EtherboneRecord()
+                reply.writes = EtherboneWrites(
+                    base_addr=record.reads.base_ret_addr, datas=reads
+                )
+                replies.append(reply)
 
-                    # release lock
-                    self.lock = False
+        if len(replies) == 0:
+            return None
+        packet = EtherbonePacket()
+        packet.records = replies
+        packet.encode()
+        return packet
 
-            finally:
+    def handle_script(self, record):
+        '''
+        run the transaction script written to SCRIPT_ADDR,
+        the results go to the reads of the same record (see csr_script.py)
+        returns a list of reply records
+        '''
+        res = run_script(
+            record.writes.get_datas(), self.comm.read, self.comm.write
+        )
+        if record.reads is None:
+            return []
+        n = len(record.reads.get_addrs())
+        res = (res + [0] * n)[:n]
+        reply = EtherboneRecord()
+        reply.writes = EtherboneWrites(
+            base_addr=record.reads.base_ret_addr, datas=res
+        )
+        return [reply]
+
+    def handle_subscribe(self, record, client_socket):
+        '''
+        add a subscription of the connection, replies with the number of
+        subscribed addresses, 0 if rejected
+        '''
+        datas = record.writes.get_datas()
+        n = 0
+        if client_socket is not None and len(datas) > 2:
+            self.subs.append(Subscription(
+                client_socket, datas[0] / 1e6, datas[1], datas[2:]
+            ))
+            n = len(datas) - 2
+        if record.reads is None:
+            return []
+        reply = EtherboneRecord()
+        reply.writes = EtherboneWrites(
+            base_addr=record.reads.base_ret_addr, datas=[n]
+        )
+        return [reply]
+
+    def serve_subscriptions(self):
+        '''
+        sample the subscriptions which are due and push their frames
+        returns the time [s] until the next one is due, None if there are none
+        '''
+        t_wait = None
+        for sub in list(self.subs):
+            t = time.perf_counter()
+            if t >= sub.t_next:
+                # keep a steady rate, unless we fell behind
+                sub.t_next += sub.period
+                if sub.t_next < t:
+                    sub.t_next = t + sub.period
+
+                vals = []
+                for addr, n in sub.runs:
+                    vals += self.comm.read(addr, n)
+                if not sub.on_change or vals != sub.vals:
+                    record = EtherboneRecord()
+                    record.writes = EtherboneWrites(
+                        base_addr=STREAM_ADDR,
+                        datas=encode_frame(time.time(), vals)
+                    )
+                    packet = EtherbonePacket()
+                    packet.records = [record]
+                    packet.encode()
+                    try:
+                        # a dropped change is sent with the next frame
+                        if sub.push(packet):
+                            sub.vals = vals
+                    except OSError:
+                        self.subs.remove(sub)
+                        continue
+            dt = max(sub.t_next - time.perf_counter(), 0)
+            if t_wait is None or dt < t_wait:
+                t_wait = dt
+        return t_wait
+
+    def _io_thread(self):
+        sel = selectors.DefaultSelector()
+        sel.register(self.socket, selectors.EVENT_READ, "tcp")
+        if self.udp:
+            sel.register(self.udp_socket, selectors.EVENT_READ, "udp")
+        # received bytes which are not a complete packet yet
+        bufs = {}
+        while True:
+            for key, _ in sel.select():
+                s = key.fileobj
+                if key.data == "tcp":
+                    client_socket, addr = s.accept()
+                    print("Connected with " + addr[0] + ":" + str(addr[1]))
+                    client_socket.setsockopt(
+                        socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+                    )
+                    sel.register(client_socket, selectors.EVENT_READ)
+                    bufs[client_socket] = bytearray()
+                    continue
+
+                if key.data == "udp":
+                    try:
+                        packet, addr = s.recvfrom(0x10000)
+                    except OSError:
+                        continue
+                    self.q.put((s, packet, addr, time.perf_counter()))
+                    continue
+
+                try:
+                    chunk = s.recv(0x10000)
+                except OSError:
+                    chunk = b""
+                if len(chunk) == 0:
+                    sel.unregister(s)
+                    del bufs[s]
+                    self.q.put((s, None, None, None))
+                    continue
+
+                buf = bufs[s]
+                buf += chunk
+                while True:
+                    n = self.get_packet_length(buf)
+                    if n is None or len(buf) < n:
+                        break
+                    self.q.put(
+                        (s, bytes(buf[:n]), None, time.perf_counter())
+                    )
+                    del buf[:n]
+
+    def _hw_thread(self):
+        t_wait = None
+        while True:
+            try:
+                client_socket, packet, addr, t_rx = self.q.get(
+                    timeout=t_wait
+                )
+            except queue.Empty:
+                t_wait = self.serve_subscriptions()
+                continue
+            if packet is None:
                 print("Disconnect")
+                for sub in self.subs:
+                    if sub.socket is client_socket and sub.n_dropped > 0:
+                        print("subscription dropped {:d} frames".format(
+                            sub.n_dropped
+                        ))
+                self.subs = [
+                    sub for sub in self.subs if sub.socket is not client_socket
+                ]
                 client_socket.close()
+                t_wait = self.serve_subscriptions()
+                continue
+            try:
+                t_start = time.perf_counter()
+                reply = self.handle_packet(
+                    packet, client_socket if addr is None else None
+                )
+                if self.capture is not None:
+                    self.cw.write(
+                        client_socket if addr is None else addr,
+                        0 if addr is None else FLAG_UDP,
+                        t_rx,
+                        time.perf_counter() - t_start,
+                        packet,
+                        reply
+                    )
+                if reply is not None and addr is None:
+                    for sub in self.subs:
+                        if sub.socket is client_socket:
+                            sub.flush()
+                    self.send_packet(client_socket, reply)
+                elif reply is not None:
+                    client_socket.sendto(bytes(reply), addr)
+            except Exception as e:
+                print("error:", repr(e))
+            t_wait = self.serve_subscriptions()
 
-    def start(self, nthreads):
-        for i in range(nthreads):
-            self.serve_thread = threading.Thread(target=self._serve_thread)
-            self.serve_thread.setDaemon(True)
-            self.serve_thread.start()
+    def start(self):
+        for target in (self._io_thread, self._hw_thread):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
 
 
 def main():
@@ -104,9 +397,20 @@ def main():
     parser.add_argument("--bind-port", default=1234,
                         help="Host bind port")
 
+    parser.add_argument("--udp", action="store_true",
+                        help="Serve etherbone over udp on the same port too")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="Log all requests and replies to FILE, "
+                             "for replay.py")
+
     # Devmem arguments
     parser.add_argument("--devmem", action="store_true",
                         help="Select /dev/mem interface")
+    parser.add_argument(
+        "--devmem-file",
+        default="/dev/mem",
+        help="Use a regular file instead of /dev/mem for testing"
+    )
     parser.add_argument(
         "--devmem-offset",
         default=0x40000000,
@@ -123,16 +427,21 @@ def main():
             end="",
             flush=True
         )
-        comm = CommDevmem(args.devmem_offset)
+        comm = CommDevmem(args.devmem_offset, dev=args.devmem_file)
     else:
         parser.print_help()
         exit()
 
-    server = RemoteServer(comm, args.bind_ip, int(args.bind_port))
+    server = RemoteServer(
+        comm, args.bind_ip, int(args.bind_port), args.udp, args.capture
+    )
     server.open()
-    server.start(4)
-    while True:
-        time.sleep(1000)
+    server.start()
+    try:
+        while True:
+            time.sleep(1000)
+    finally:
+        server.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+'''
+Load test for litex_server_light without hardware
+
+Starts a RemoteServer on a file-backed CommDevmem and hammers it with
+concurrent clients. Each client talks etherbone over its own tcp
+connection, like litex's RemoteClient, and checks the data it reads back.
+Prints throughput and latency percentiles.
+
+    ./load_test.py --clients 16 --n 2000
+
+With --udp, the clients use etherbone datagrams instead. Compare the
+per-register latency of both with a single client:
+
+    ./load_test.py --clients 1 --n 5000
+    ./load_test.py --clients 1 --n 5000 --udp
+
+With --subscribe, a client subscribes to 7 registers, which another client
+keeps changing, while the load test runs. Prints the frame rate and the
+jitter of the frame interval:
+
+    ./load_test.py --subscribe 0.005
+    ./load_test.py --subscribe 0.001 --on-change
+
+With --stalled, a subscriber stops reading its frames while the load test
+runs. The server drops its frames instead of stalling the other clients:
+
+    ./load_test.py --stalled
+
+With --script, CsrLibLegacyAdapter.batch() runs transaction scripts on the
+server while the load test runs, over tcp like with a litex RemoteClient
+or over udp like with CommUDP:
+
+    ./load_test.py --script
+    ./load_test.py --script --udp
+
+With --capture, the traffic is logged for replay.py.
+'''
+import argparse
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from comm_devmem import CommDevmem
+from etherbone import EtherbonePacket, EtherboneRecord, EtherboneIPC
+from etherbone import EtherboneWrites, EtherboneReads
+from litex_server import RemoteServer
+from csr_stream import CsrSubscription, MAX_ADDRS
+from types import SimpleNamespace
+
+# size of the file-backed memory [bytes]
+MEM_SIZE = 0x100000
+
+
+class TestClient(EtherboneIPC):
+    def __init__(self, host, port):
+        self.socket = socket.create_connection((host, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        self.socket.close()
+
+    def exchange(self, packet, has_reply):
+        ''' send a packet, returns the reply bytes or None '''
+        self.send_packet(self.socket, packet)
+        if not has_reply:
+            return None
+        return self.receive_packet(self.socket)
+
+    def transaction(self, writes=None, reads=None):
+        record = EtherboneRecord()
+        if writes is not None:
+            record.writes = EtherboneWrites(
+                base_addr=writes[0], datas=writes[1]
+            )
+        if reads is not None:
+            record.reads = EtherboneReads(addrs=reads)
+        packet = EtherbonePacket()
+        packet.records = [record]
+        packet.encode()
+        reply = self.exchange(packet, reads is not None)
+        if reply is None:
+            return None
+        packet = EtherbonePacket(reply)
+        packet.decode()
+        return packet.records[0].writes.get_datas()
+
+    def read(self, addr, length=1):
+        return self.transaction(
+            reads=[addr + 4 * i for i in range(length)]
+        )
+
+    def write(self, addr, datas):
+        self.transaction(writes=(addr, datas))
+
+
+class UdpTestClient(TestClient):
+    def __init__(self, host, port, timeout=0.1, retries=5):
+        self.addr = (host, port)
+        self.retries = retries
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(timeout)
+        self.probe()
+
+    def probe(self):
+        packet = EtherbonePacket()
+        packet.pf = 1
+        packet.encode()
+        packet = EtherbonePacket(self.exchange(packet, True))
+        packet.decode()
+        if not packet.pr:
+            raise RuntimeError('no probe reply')
+
+    def exchange(self, packet, has_reply):
+        '''
+        packets expecting a reply are sent again when it got lost, which is
+        only safe for reads. Write-only packets are sent once.
+        '''
+        bs = bytes(packet)
+        for i in range(self.retries if has_reply else 1):
+            self.socket.sendto(bs, self.addr)
+            if not has_reply:
+                return None
+            try:
+                return self.socket.recv(0x10000)
+            except socket.timeout:
+                pass
+        raise TimeoutError('no reply from {}:{}'.format(*self.addr))
+
+
+def percentile(vals, p):
+    ''' vals must be sorted '''
+    return vals[min(int(len(vals) * p / 100), len(vals) - 1)]
+
+
+def run_client(i, args, lats, errors):
+    '''
+    each client owns a 4 kB page of memory which it writes and reads back,
+    so it can check the results without locking
+    '''
+    c = (UdpTestClient if args.udp else TestClient)('127.0.0.1', args.port)
+    base = i * 0x1000
+    mem = [0] * 0x400
+    # at most 255 words per record
+    for ind in range(0, len(mem), 0x80):
+        c.write(base + 4 * ind, mem[ind:ind + 0x80])
+    rnd = random.Random(i)
+    for j in range(args.n):
+        ind = rnd.randrange(0x400 - args.burst)
+        ts = time.perf_counter()
+        op = rnd.random()
+        if op < 0.3:
+            val = rnd.getrandbits(32)
+            c.write(base + 4 * ind, [val])
+            # flush the write with a read, like a CSR read-modify-write
+            res = c.read(base + 4 * ind)
+            mem[ind] = val
+            exp = [val]
+        elif op < 0.9:
+            res = c.read(base + 4 * ind)
+            exp = mem[ind:ind + 1]
+        else:
+            res = c.read(base + 4 * ind, args.burst)
+            exp = mem[ind:ind + args.burst]
+        lats.append(time.perf_counter() - ts)
+        if res != exp:
+            errors.append((i, j))
+    c.close()
+
+
+def run_subscriber(args, done, res):
+    '''
+    the last page of memory holds 7 registers, the first one is a counter
+    incremented by a writer client. Frames are collected until done is set.
+    '''
+    base = MEM_SIZE - 0x1000
+    c = TestClient('127.0.0.1', args.port)
+
+    def writer():
+        cnt = 0
+        while not done.is_set():
+            cnt += 1
+            c.write(base, [cnt])
+            time.sleep(args.subscribe / 3)
+
+    sub = CsrSubscription(
+        [base + 4 * i for i in range(7)],
+        args.subscribe,
+        args.on_change,
+        '127.0.0.1',
+        args.port
+    )
+    t = threading.Thread(target=writer)
+    t.start()
+    frames = []
+    while not done.is_set():
+        frames.append(sub.get())
+    t.join()
+    sub.close()
+    c.close()
+    res += frames
+
+
+def run_script_client(args, res):
+    '''
+    CsrLibLegacyAdapter.batch() on the second last page of memory.
+    It stands in for a litex RemoteClient or CommUDP of 4 registers.
+    '''
+    sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
+    from lib.csr_lib import CsrLibLegacyAdapter
+
+    base = MEM_SIZE - 0x2000
+    names = ['reg{:d}'.format(i) for i in range(4)]
+    rc = SimpleNamespace(port=args.port, regs=SimpleNamespace(**{
+        n: SimpleNamespace(addr=base + 4 * i, length=1)
+        for i, n in enumerate(names)
+    }))
+    if args.udp:
+        rc.server = '127.0.0.1'
+    else:
+        rc.host = '127.0.0.1'
+    c = CsrLibLegacyAdapter(rc)
+    for i in range(args.n // 10):
+        vals = []
+        # more accesses than fit into one script
+        with c.batch():
+            for k in range(100):
+                c.write_reg(names[k % 4], i + k)
+                vals.append(c.read_reg(names[k % 4]))
+            last = c.poll_reg(names[3], i + 99)
+        if [int(v) for v in vals] != list(range(i, i + 100)) or \
+                last != i + 99:
+            res['errors'] += 1
+        res['n'] += 1
+    c.script_client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', default=8, type=int,
+                        help='number of concurrent clients')
+    parser.add_argument('--n', default=1000, type=int,
+                        help='transactions per client')
+    parser.add_argument('--burst', default=64, type=int,
+                        help='words per burst read')
+    parser.add_argument('--port', default=0, type=int,
+                        help='tcp port, 0 = any free one')
+    parser.add_argument('--udp', action='store_true',
+                        help='use etherbone over udp instead of tcp')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='log the traffic to FILE, see replay.py')
+    parser.add_argument('--subscribe', type=float, metavar='PERIOD',
+                        help='also run a subscription, sampling period [s]')
+    parser.add_argument('--on-change', action='store_true',
+                        help='subscription only sends changed values')
+    parser.add_argument('--stalled', action='store_true',
+                        help='also run a subscriber which does not read')
+    parser.add_argument('--script', action='store_true',
+                        help='also run batches of transaction scripts')
+    args = parser.parse_args()
+
+    if args.burst > 255:
+        parser.error('at most 255 words per burst')
+    if (args.clients + 2) * 0x1000 > MEM_SIZE:
+        parser.error('too many clients')
+
+    fd, fName = tempfile.mkstemp()
+    os.ftruncate(fd, MEM_SIZE)
+    os.close(fd)
+    server = RemoteServer(
+        CommDevmem(dev=fName), '127.0.0.1', args.port, args.udp, args.capture
+    )
+    try:
+        server.open()
+    finally:
+        # the mapping stays valid
+        os.remove(fName)
+    server.start()
+    args.port = server.bind_port
+
+    lats = []
+    errors = []
+    frames = []
+    done = threading.Event()
+    if args.subscribe:
+        t_sub = threading.Thread(
+            target=run_subscriber, args=(args, done, frames)
+        )
+        t_sub.start()
+        time.sleep(0.1)
+    if args.stalled:
+        # about 10 MB / s of frames, more than the socket buffers hold
+        stalled = CsrSubscription(
+            [4 * i for i in range(MAX_ADDRS)], 1e-4, False, '127.0.0.1',
+            args.port
+        )
+        time.sleep(0.5)
+    ts = time.perf_counter()
+    ths = [
+        threading.Thread(target=run_client, args=(i, args, lats, errors))
+        for i in range(args.clients)
+    ]
+    scripts = {'n': 0, 'errors': 0}
+    if args.script:
+        ths.append(threading.Thread(
+            target=run_script_client, args=(args, scripts)
+        ))
+    for t in ths:
+        t.start()
+    for t in ths:
+        t.join()
+    dt = time.perf_counter() - ts
+    if args.subscribe:
+        done.set()
+        t_sub.join()
+
+    if args.stalled:
+        n_dropped = sum(sub.n_dropped for sub in server.subs)
+        stalled.close()
+        print('stalled subscriber: {:d} frames dropped'.format(n_dropped))
+        if n_dropped == 0:
+            errors.append('stalled')
+
+    if args.capture:
+        server.close()
+
+    lats.sort()
+    print('{:s}, {:d} clients, {:d} transactions in {:.2f} s: {:.0f} / s'
+          .format('udp' if args.udp else 'tcp', args.clients, len(lats), dt,
+                  len(lats) / dt))
+    print('latency [ms]: p50 {:.3f}, p90 {:.3f}, p99 {:.3f}, max {:.3f}'
+          .format(*[percentile(lats, p) * 1e3 for p in (50, 90, 99, 100)]))
+    if args.subscribe:
+        ts = [f[0] for f in frames]
+        dts = sorted(b - a for a, b in zip(ts, ts[1:]))
+        print('subscription: {:d} frames, {:.0f} / s'.format(
+            len(frames), (len(ts) - 1) / (ts[-1] - ts[0])
+        ))
+        print('interval [ms]: min {:.3f}, p50 {:.3f}, p99 {:.3f}, max {:.3f}'
+              .format(dts[0] * 1e3, *[percentile(dts, p) * 1e3
+                                      for p in (50, 99, 100)]))
+        cnts = [f[1][0] for f in frames]
+        if cnts != sorted(cnts) or \
+                (args.on_change and len(set(cnts)) != len(cnts)):
+            errors.append('subscription')
+    if args.script:
+        print('scripts: {:d} batches of 100 writes + reads, {:d} wrong'
+              .format(scripts['n'], scripts['errors']))
+        if scripts['n'] == 0 or scripts['errors'] > 0:
+            errors.append('script')
+    if len(errors) > 0:
+        print('{:d} wrong read backs!'.format(len(errors)))
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
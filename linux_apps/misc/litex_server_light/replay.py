@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'''
+Replay a capture of litex_server.py --capture against a server
+
+Each client of the capture gets its own connection again and sends its
+requests at the original time (--speed 1), faster (--speed 10) or as
+fast as possible (--speed 0). Prints throughput and latency percentiles.
+
+Without --port, an in-process RemoteServer on a file-backed CommDevmem
+is used, large enough for all addresses in the capture. This allows to
+regression test codec and server changes without the board:
+
+    sudo python3 litex_server.py --devmem --capture vvm_app.cap
+    (run vvm_app.py, scope_app.py, ...)
+    ./replay.py vvm_app.cap --speed 0
+'''
+import argparse
+import os
+import tempfile
+import threading
+import time
+from comm_devmem import CommDevmem
+from etherbone import EtherbonePacket
+from litex_server import RemoteServer
+from load_test import TestClient, UdpTestClient, percentile
+from capture import read_capture, FLAG_UDP
+from csr_stream import SUBSCRIBE_ADDR
+
+
+def get_max_addr(packet):
+    ''' highest address accessed by a request '''
+    m = 0
+    for record in packet.records:
+        if record.writes is not None:
+            m = max(m, record.writes.base_addr + 4 * len(record.writes.datas))
+        if record.reads is not None and len(record.reads.addrs) > 0:
+            m = max(m, max(record.reads.addrs) + 4)
+    return m
+
+
+def load(fName):
+    '''
+    returns {client: [Entry, ...]} and the highest address accessed.
+    Subscriptions are skipped, their frames are not part of the capture.
+    '''
+    clients = {}
+    max_addr = 0
+    for e in read_capture(fName):
+        p = EtherbonePacket(e.request)
+        p.decode()
+        if any(r.writes is not None and r.writes.base_addr == SUBSCRIBE_ADDR
+               for r in p.records):
+            continue
+        if not p.pf:
+            max_addr = max(max_addr, get_max_addr(p))
+        clients.setdefault((e.client, e.flags), []).append(e)
+    return clients, max_addr
+
+
+def run_client(entries, args, t0, lats, diffs):
+    if entries[0].flags & FLAG_UDP:
+        c = UdpTestClient(args.host, args.port)
+    else:
+        c = TestClient(args.host, args.port)
+    for e in entries:
+        if args.speed > 0:
+            dt = t0 + e.t_rx / args.speed - time.perf_counter()
+            if dt > 0:
+                time.sleep(dt)
+        ts = time.perf_counter()
+        reply = c.exchange(e.request, len(e.reply) > 0)
+        lats.append(time.perf_counter() - ts)
+        if reply is not None and bytes(reply) != e.reply:
+            diffs.append(e)
+    c.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('capture', help='file from litex_server.py --capture')
+    parser.add_argument('--speed', default=1.0, type=float,
+                        help='1 = original timing, 0 = as fast as possible')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='server to replay against, with --port')
+    parser.add_argument('--port', type=int,
+                        help='replay against a running server')
+    args = parser.parse_args()
+
+    clients, max_addr = load(args.capture)
+    n = sum(len(es) for es in clients.values())
+    if n == 0:
+        print('nothing to replay')
+        return
+    t_svc = sorted(e.t_service for es in clients.values() for e in es)
+    print('{:d} requests from {:d} clients, captured service time [ms]: '
+          'p50 {:.3f}, p99 {:.3f}'.format(
+              n, len(clients),
+              percentile(t_svc, 50) * 1e3, percentile(t_svc, 99) * 1e3
+          ))
+
+    if args.port is None:
+        fd, fName = tempfile.mkstemp()
+        # sparse file, rounded up to full pages
+        os.ftruncate(fd, (max_addr | 0xFFF) + 1)
+        os.close(fd)
+        server = RemoteServer(CommDevmem(dev=fName), args.host, 0, udp=True)
+        try:
+            server.open()
+        finally:
+            os.remove(fName)
+        server.start()
+        args.port = server.bind_port
+
+    lats = []
+    diffs = []
+    t0 = time.perf_counter()
+    ths = [
+        threading.Thread(target=run_client, args=(es, args, t0, lats, diffs))
+        for es in clients.values()
+    ]
+    for t in ths:
+        t.start()
+    for t in ths:
+        t.join()
+    dt = time.perf_counter() - t0
+
+    lats.sort()
+    print('replayed in {:.2f} s: {:.0f} requests / s'.format(dt, n / dt))
+    print('latency [ms]: p50 {:.3f}, p90 {:.3f}, p99 {:.3f}, max {:.3f}'
+          .format(*[percentile(lats, p) * 1e3 for p in (50, 90, 99, 100)]))
+    # expected when the memory content differs from the captured session
+    print('{:d} replies differ from the capture'.format(len(diffs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -110,6 +110,7 @@ class VvmApp:
             if i > 0:
                 c.write_reg('vvm_pp_mult' + str(i), mult)
         print("f_ref at {:6f} MHz".format(self.f_ref_bb / 1e6))
+        c.write_reg('vvm_ddc_commit', 1)  # latch all FTW shadow regs
         c.write_reg('vvm_ddc_dds_ctrl', 0x02)  # FTW update
 
     def handle_input(self):
@@ -184,6 +185,7 @@ def main():
         # to avoid saturation with large deci factors
         # This will change the scaling!
         c.write_reg('vvm_ddc_shift', args.ddcshift)
+        c.write_reg('vvm_ddc_commit', 1)
 
         # IIR result averaging filter smoothing factor (0 - 15)
         c.write_reg('vvm_iir', args.iir)
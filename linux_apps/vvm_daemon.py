@@ -8,9 +8,38 @@ MQTT client to expose VVM measurements and controls
 vvm/settings/<arg_name>
     Most of the command line arguments can be set over mqtt
 
+vvm/settings/db_<result> vvm/settings/dt_<result>
+    Publish-on-change for the mags, raw_mags, phases, f_ref and f_ref_bb
+    results. A result is only published when one of its values changed by
+    more than db_<result> (deadband in units of the result) or when it was
+    not published for more than dt_<result> [s]. Default 0, 0 = always
+
+vvm/settings/batch {"vvm_pulse_channel": 1, "vvm_iir": 7}
+    Set several of the above at once from a json object. The batch is
+    validated as a whole and applied between two measurement cycles
+
+vvm/settings/batch_ack {"applied": {"vvm_iir": 7.0, ...}, "latency": 0.02}
+    Published after a batch has been applied (or rejected, with "error")
+    latency = seconds from reception to application
+
 vvm/settings/phase_reset
     Any pub resets the DDS phase-accumulators in the digital down-converter
 
+vvm/settings/vvm_iir_fast 1
+    After a retune, phase reset or trigger setting change, start the
+    result averaging without smoothing and ramp it up to vvm_iir
+    (gain scheduled IIR). Settles in 2**vvm_iir DDC outputs instead of
+    2**(vvm_iir + 3) for the fixed IIR
+
+vvm/settings/trace 1
+    Capture magnitude / phase traces (vvm_trace) and publish them.
+    Each trace starts at a pulse trigger, in CW mode right after the last
+
+vvm/settings/vvm_trace_decimation 10
+vvm/settings/vvm_trace_length 1024
+    Store one out of vvm_trace_decimation DDC outputs in the trace, stop
+    after vvm_trace_length of them
+
 vvm/settings/f_tune_set
     Set the digital down-converter center frequency to message value in [Hz]
     Write `auto` to tune on the frequency counter value (f_ref_bb)
@@ -30,14 +59,38 @@ vvm/results/f_ref 124910921.52
 vvm/results/f_tune 7310928.576
     Center frequency of the digital down-converter (base-band) [Hz]
 
+vvm/results/settled 1
+vvm/results/iir_count 8192
+    Published when the result averaging becomes settled (1) or restarts
+    (0), with the number of DDC outputs it has seen since the restart.
+    mags, raw_mags and phases are still published while not settled, but
+    average over fewer outputs. In pulsed mode only triggered outputs
+    count, so settling can take minutes at low repetition rates
+
+vvm/results/trace <binary>
+    Last magnitude / phase trace as float32 array (7, vvm_trace_length)
+    with rows REF, A, B, C magnitudes [dBm], A, B, C phases [deg]
+
+vvm/results/trace_dt 8.5e-06
+    Time between two entries of the trace [s]
+
+vvm/results/pub_sent 1234
+vvm/results/pub_suppressed 5678
+    Number of result messages sent / suppressed by publish-on-change
+
+vvm/results/pub_queue 0
+vvm/results/pub_dropped 12
+    Messages waiting in the outbound queue / dropped (replaced by a newer
+    value of the same topic) because the broker could not keep up
+
 '''
 import logging
 import signal
 import time
-from numpy import array
+from numpy import array, vstack, float32
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
-from lib.mqtt_pvs import MqttPvs
+from lib.mqtt_pvs import MqttPvs, ChangePublisher
 from lib.csr_lib import CsrLib
 from lib.vvm_helpers import initLTC, initSi570, meas_f_ref, \
     CalHelper, getRealFreq
@@ -58,6 +111,7 @@ class VvmApp:
             'fps':          [None, 0.01, 120],
             'nyquist_band': [None, 0, 13],
             'vvm_iir':      [None, 0, 13, True],
+            'vvm_iir_fast': [None, 0, 1, True],
             'vvm_ddc_shift':[None, 1, 64, True],
             'vvm_ddc_deci': [None, 10, 500, True],
 
@@ -71,9 +125,29 @@ class VvmApp:
             'vvm_pulse_threshold': [None, 0, (2**21 - 1), True],
             'vvm_pulse_wait_pre':  [None, 0, 10.0, lambda x: int(x * args.fs)],
             'vvm_pulse_wait_acq':  [None, 0, 10.0, lambda x: int(x * args.fs)],
-            'vvm_pulse_wait_post': [None, 0, 10.0, lambda x: int(x * args.fs)]
-        }, c)
+            'vvm_pulse_wait_post': [None, 0, 10.0, lambda x: int(x * args.fs)],
+
+            # Mag / phase trace capture
+            'trace':                [None, 0, 1, False],
+            'vvm_trace_decimation': [None, 1, 2**16 - 1, True],
+            'vvm_trace_length':     [None, 1, 1024, True],
+
+            # Publish-on-change deadbands and max. silent intervals [s]
+            'db_mags':      [0.0, 0, 100],
+            'dt_mags':      [0.0, 0, 3600],
+            'db_raw_mags':  [0.0, 0, 2**21],
+            'dt_raw_mags':  [0.0, 0, 3600],
+            'db_phases':    [0.0, 0, 360],
+            'dt_phases':    [0.0, 0, 3600],
+            'db_f_ref':     [0.0, 0, 1e9],
+            'dt_f_ref':     [0.0, 0, 3600],
+            'db_f_ref_bb':  [0.0, 0, 1e9],
+            'dt_f_ref_bb':  [0.0, 0, 3600]
+        }, c, ['vvm_pulse_commit', 'vvm_ddc_commit'])
         self.mq = self.pvs.mq
+        # bounded outbound queue, use it for all publishing
+        self.pq = self.pvs.pq
+        self.cp = ChangePublisher(self.pq, 'vvm/results/', self.pvs)
 
         # Trigger auto / manually tuning when publishing to settings/f_tune_set
         # the current tuning value can be read from results/f_tune
@@ -83,6 +157,9 @@ class VvmApp:
 
         self.mq.message_callback_add(prefix + 'phase_reset', self.pr)
 
+        # True while a trace capture is pending
+        self.trace_armed = False
+
         # Print some CSRs for debugging
         log.info('ddc_ftw %s', hex(c.read_reg('vvm_ddc_dds_ftw0')))
         log.info('f_sample %s', args.fs)
@@ -100,6 +177,7 @@ class VvmApp:
     def pr(self, *args):
             ''' Reset DDS phase accumulators of down-converter '''
             self.c.write_reg('vvm_ddc_dds_ctrl', 0x01)
+            self.c.write_reg('vvm_iir_restart', 1)
 
     def loop_forever(self):
         # Just came out of reset, give freq. counter some time to accumulate
@@ -107,8 +185,12 @@ class VvmApp:
 
         cycle = 0
         trig_count_ = 0
+        settled_ = None
         last_ts = 0
         while True:
+            # Apply queued setting batches on the cycle boundary
+            self.pvs.apply_batches()
+
             ts = time.time()
 
             # do some housekeeping things every second
@@ -122,10 +204,19 @@ class VvmApp:
                 )
 
                 # Aliased frequency of REF input measured by frequency counter
-                self.mq.publish('vvm/results/f_ref_bb', self.f_ref_bb)
+                self.cp.publish('f_ref_bb', self.f_ref_bb, ts)
 
                 # Absolute frequency of REF input, needs user selected f-band
-                self.mq.publish('vvm/results/f_ref', f_ref)
+                self.cp.publish('f_ref', f_ref, ts)
+
+                # Publish-on-change statistics
+                n_sent, n_suppressed = self.cp.get_counts()
+                self.pq.publish('vvm/results/pub_sent', n_sent)
+                self.pq.publish('vvm/results/pub_suppressed', n_suppressed)
+
+                # Outbound queue statistics
+                self.pq.publish('vvm/results/pub_queue', self.pq.get_depth())
+                self.pq.publish('vvm/results/pub_dropped', self.pq.n_dropped)
 
             if cycle == 0:
                 self.tune(self.f_ref_bb)
@@ -133,6 +224,16 @@ class VvmApp:
                 # Reset DDS phase accumulators once at startup after setting Ms
                 self.pr()
 
+            # Results are not held back while the averaging settles, as that
+            # can take long in pulsed mode. Clients can watch `settled`
+            settled = self.c.read_reg('vvm_iir_settled')
+            if settled != settled_:
+                settled_ = settled
+                self.pq.publish('vvm/results/settled', settled)
+                self.pq.publish(
+                    'vvm/results/iir_count', self.c.read_reg('vvm_iir_count')
+                )
+
             update_meas = False
             if self.pvs.vvm_pulse_channel > 3:
                 # CW mode
@@ -143,7 +244,7 @@ class VvmApp:
                 if trig_count > trig_count_:
                     update_meas = True
                     trig_count_ = trig_count
-                    self.mq.publish('vvm/results/trig_count', str(trig_count))
+                    self.pq.publish('vvm/results/trig_count', str(trig_count))
 
             if update_meas:
                 Ms = array([1, self.pvs.M_A, self.pvs.M_B, self.pvs.M_C])
@@ -154,21 +255,51 @@ class VvmApp:
                 phases = self.cal.get_phases(f_ref * Ms[1:])
 
                 # Publish multiple values per topic (separated by ,)
-                temp = ','.join([str(v) for v in mags])
-                self.mq.publish('vvm/results/mags', temp)
+                self.cp.publish('mags', mags, ts)
 
                 vals = [self.c.read_reg("vvm_mag" + str(i)) for i in range(4)]
-                temp = ','.join([str(v) for v in vals])
-                self.mq.publish('vvm/results/raw_mags', temp)
+                self.cp.publish('raw_mags', vals, ts)
 
-                temp = ','.join([str(v) for v in phases])
-                self.mq.publish('vvm/results/phases', temp)
+                self.cp.publish('phases', phases, ts)
+
+            if self.pvs.trace:
+                self.publish_trace(f_ref)
 
             # Delay locked to the wall clock for more accurate cycle time
             dt = 1 / self.pvs.fps
             time.sleep(dt - time.time() % dt)
             cycle += 1
 
+    def publish_trace(self, f_ref):
+        '''
+        publish the mag / phase trace once its capture is done,
+        then arm the next one
+        '''
+        # still waiting for the trigger or capturing
+        if self.c.read_reg('vvm_trace_arm'):
+            return
+
+        if self.trace_armed:
+            Ms = array([1, self.pvs.M_A, self.pvs.M_B, self.pvs.M_C])
+            mags, phases = self.cal.get_trace(
+                f_ref * Ms,
+                int(self.pvs.vvm_ddc_shift),
+                int(self.pvs.vvm_trace_length)
+            )
+            self.pq.publish(
+                'vvm/results/trace',
+                vstack((mags, phases)).astype(float32).tobytes()
+            )
+            dt = self.pvs.vvm_trace_decimation * self.pvs.vvm_ddc_deci
+            self.pq.publish('vvm/results/trace_dt', dt / self.args.fs)
+
+        # CW mode: there is no pulse trigger, start right away
+        self.c.write_reg(
+            'vvm_trace_force', int(self.pvs.vvm_pulse_channel > 3)
+        )
+        self.c.write_reg('vvm_trace_arm', 1)
+        self.trace_armed = True
+
     def tune(self, f_tune=None):
         '''
         set down-converter center frequency to f_tune
@@ -194,9 +325,11 @@ class VvmApp:
             if i > 0:
                 self.c.write_reg('vvm_pp_mult' + str(i), int(m))
 
+        self.c.write_reg('vvm_ddc_commit', 1)  # latch all FTW shadow regs
         self.c.write_reg('vvm_ddc_dds_ctrl', 0x02)  # FTW update
+        self.c.write_reg('vvm_iir_restart', 1)  # settle on the new FTW
 
-        self.mq.publish('vvm/results/f_tune', f_tune, 0, True)
+        self.pq.publish('vvm/results/f_tune', f_tune, 0, True, keep=True)
         log.info('tuned f_ref to {:6f} MHz'.format(f_tune / 1e6))
 
 
@@ -231,6 +364,10 @@ def main():
         '--vvm_iir', default=10, type=int,
         help='IIR filter for result averaging. Smoothing factor from 0 - 15.'
     )
+    parser.add_argument(
+        '--vvm_iir_fast', default=1, type=int,
+        help='Ramp up the IIR averaging after a retune (1 = on)'
+    )
     parser.add_argument(
         '--fs', default=117.6e6, type=float,
         help='ADC sample rate [MHz]. Must match hello_LTC.py setting.'
@@ -275,6 +412,18 @@ def main():
         '--vvm_pulse_wait_post', default=1.0, type=float,
         help='Post acquisition hold-off time [s]'
     )
+    parser.add_argument(
+        '--trace', default=0, type=int,
+        help='Capture and publish mag / phase traces (1 = on)'
+    )
+    parser.add_argument(
+        '--vvm_trace_decimation', default=1, type=int,
+        help='Store one out of this many DDC outputs in the trace'
+    )
+    parser.add_argument(
+        '--vvm_trace_length', default=1024, type=int,
+        help='Number of entries in the trace'
+    )
     parser.add_argument(
         '-v', '--verbose', action='store_true',
         help='increase output verbosity'
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+'''
+Headless logger for VVM measurements
+
+Appends timestamped records of
+
+    t       unix time [s]
+    mags    REF, A, B, C magnitudes [dBm]
+    phases  A, B, C phases against REF [deg]
+    f_ref   REF frequency [Hz]
+
+to a chunk_log directory (see lib/chunk_log.py): zlib compressed chunks
+in rotating segments with an index, the oldest segments are deleted to
+stay below --max_size. Does not initialize the hardware, run it next to
+vvm_daemon.py or after vvm_app.py.
+
+On the zedboard:
+    ./vvm_logger.py --dir /home/vvm/log
+
+On a host PC, through litex_server_light:
+    ./vvm_logger.py --dir log --remote ../gateware/build/csr.csv
+
+Inspect / export a log:
+    ./vvm_logger.py --dir log --info
+    ./vvm_logger.py --dir log --export out.npz --t0 1700000000 --t1 1700000600
+'''
+import logging
+import signal
+import sys
+import time
+from numpy import array, savez
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+from lib.chunk_log import ChunkLogWriter, ChunkLogReader, get_segments, \
+    get_segment_size
+from lib.vvm_helpers import meas_f_ref, CalHelper, getRealFreq
+
+log = logging.getLogger('vvm_logger')
+
+REC_DTYPE = [
+    ('t', '<f8'),
+    ('mags', '<f4', 4),
+    ('phases', '<f4', 3),
+    ('f_ref', '<f8')
+]
+
+
+def log_forever(args, c):
+    cal = CalHelper(args.cal_file, args.vvm_ddc_shift, c, args.fs)
+    Ms = array([1, args.M_A, args.M_B, args.M_C])
+    w = ChunkLogWriter(
+        args.dir, REC_DTYPE, args.chunk, args.seg_size << 20,
+        args.max_size << 20
+    )
+    w.enforce_budget()
+
+    # Let SIGTERM (systemctl stop) leave through the finally block
+    signal.signal(signal.SIGTERM, lambda *x: sys.exit())
+
+    n = 0
+    last_ts = 0
+    last_flush = time.time()
+    try:
+        while True:
+            ts = time.time()
+
+            # REF frequency changes slowly, measure it once per second
+            if ts - last_ts > 1.0:
+                last_ts = ts
+                f_ref = getRealFreq(
+                    args.nyquist_band, meas_f_ref(c, args.fs), args.fs
+                )
+
+            # Bound the loss on power failure
+            if ts - last_flush > args.flush:
+                last_flush = ts
+                w.flush()
+
+            mags = cal.get_mags(f_ref * Ms, args.vvm_ddc_shift)
+            phases = cal.get_phases(f_ref * Ms[1:])
+            w.append((ts, mags, phases, f_ref))
+
+            n += 1
+            if n % 1000 == 0:
+                log.info('%d records', n)
+
+            # Delay locked to the wall clock for more accurate cycle time
+            dt = 1 / args.fps
+            time.sleep(dt - time.time() % dt)
+    finally:
+        w.close()
+        log.info('%d records written to %s', n, args.dir)
+
+
+def print_info(args):
+    r = ChunkLogReader(args.dir)
+    segs = get_segments(args.dir)
+    n_bytes = sum(get_segment_size(args.dir, s) for s in segs)
+    print('{:d} records in {:d} segments, {:.1f} MB'.format(
+        len(r), len(segs), n_bytes / 1e6
+    ))
+    if len(r) > 0:
+        t0, t1 = r.get_range()
+        print('from {:s} to {:s} ({:.0f} s)'.format(
+            time.ctime(t0), time.ctime(t1), t1 - t0
+        ))
+        print('last record:', r.read_chunk(len(r.idx) - 1)[-1])
+    r.close()
+
+
+def export(args):
+    r = ChunkLogReader(args.dir)
+    recs = r.read(args.t0, args.t1)
+    savez(args.export, **{k: recs[k] for k in recs.dtype.names})
+    r.close()
+    print('{:d} records written to {:s}'.format(len(recs), args.export))
+
+
+def main():
+    parser = ArgumentParser(
+        description=__doc__, formatter_class=RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '--dir', default='vvm_log',
+        help='Directory of the log'
+    )
+    parser.add_argument(
+        '--remote', metavar='CSR_CSV',
+        help='Log through litex_server_light instead of /dev/mem'
+    )
+    parser.add_argument(
+        '--udp', metavar='HOST',
+        help='With --remote: udp to litex_server_light --udp on HOST'
+    )
+    parser.add_argument(
+        '--fps', default=30.0, type=float,
+        help='Records per second'
+    )
+    parser.add_argument(
+        '--vvm_ddc_shift', default=2, type=int,
+        help='Must match the setting of vvm_daemon.py'
+    )
+    parser.add_argument(
+        '--fs', default=117.6e6, type=float,
+        help='ADC sample rate [MHz]. Must match hello_LTC.py setting.'
+    )
+    parser.add_argument(
+        '--cal_file', default='cal2_att.npz',
+        help='Amplitude / Phase calibration file'
+    )
+    parser.add_argument(
+        '--nyquist_band', default=8, type=int,
+        help='Nyquist band (N * fs / 2)'
+    )
+    parser.add_argument(
+        '--M_A', default=1, type=int,
+        help='f_ref multiplier for channel A'
+    )
+    parser.add_argument(
+        '--M_B', default=1, type=int,
+        help='f_ref multiplier for channel B'
+    )
+    parser.add_argument(
+        '--M_C', default=1, type=int,
+        help='f_ref multiplier for channel C'
+    )
+    parser.add_argument(
+        '--chunk', default=1024, type=int,
+        help='Records per compressed chunk'
+    )
+    parser.add_argument(
+        '--flush', default=10.0, type=float,
+        help='Write incomplete chunks after this many [s]'
+    )
+    parser.add_argument(
+        '--seg_size', default=16, type=int,
+        help='Start a new segment file after this many [MB]'
+    )
+    parser.add_argument(
+        '--max_size', default=512, type=int,
+        help='Delete the oldest segments above this many [MB]'
+    )
+    parser.add_argument(
+        '--info', action='store_true',
+        help='Print a summary of the log and exit'
+    )
+    parser.add_argument(
+        '--export', metavar='NPZ',
+        help='Write the records between --t0 and --t1 to a .npz file'
+    )
+    parser.add_argument(
+        '--t0', type=float,
+        help='Start of the exported time range [unix time]'
+    )
+    parser.add_argument(
+        '--t1', type=float,
+        help='End of the exported time range [unix time]'
+    )
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='increase output verbosity'
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.info:
+        print_info(args)
+    elif args.export:
+        export(args)
+    elif args.remote:
+        sys.path.append('../litex_server_apps/')
+        from common import conLitexServer
+        from lib.csr_lib import CsrLibLegacyAdapter
+        r = conLitexServer(args.remote, udp_host=args.udp)
+        try:
+            log_forever(args, CsrLibLegacyAdapter(r))
+        finally:
+            r.close()
+    else:
+        from lib.csr_lib import CsrLib
+        with CsrLib(0x40000000, 'csr.json') as c:
+            log.info('FPGA ident: %s', c.get_ident())
+            log_forever(args, c)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,28 @@
 #!/usr/bin/python3
 '''
 display phase / magnitude on the OLED screen
+
+event driven: sleeps until a mqtt value changes, the encoder is touched
+or the trigger times out. Then renders at most --fps frames per second.
 '''
+import time
+# to report the startup time, including the imports below
+T_START = time.time()
+
 import logging
 import signal
-import time
-from os import putenv
+import json
+import selectors
+import resource
+from os import putenv, pipe, read, write, set_blocking
 from random import randint
 import pygame as pg
-from pygame.draw import line
 from evdev import InputDevice
 import argparse
 import paho.mqtt.client as mqtt
 
+from lib.fb_display import FbDisplay
+
 log = logging.getLogger('vvm_oled')
 
 
@@ -49,15 +59,24 @@ class VvmOled:
         self.mq.message_callback_add('vvm/results/#', self.on_result)
         self.mq.message_callback_add('vvm/settings/#', self.on_result)
 
-        if not args.test:
-            putenv('SDL_NOMOUSE', '')
-            putenv('SDL_FBDEV', '/dev/fb1')
-            putenv('SDL_FBACCEL', '0')
-            putenv('SDL_VIDEODRIVER', 'fbcon')
-        pg.display.init()
+        if args.fb is not None:
+            # Draw into a numpy array, write it to the framebuffer directly.
+            # pygame is only used to render the glyphs, no SDL video
+            self.fb = self.d = FbDisplay(args.fb, 256, 64)
+            self.update_display = self.fb.update
+        else:
+            self.fb = None
+            if not args.test:
+                putenv('SDL_NOMOUSE', '')
+                putenv('SDL_FBDEV', '/dev/fb1')
+                putenv('SDL_FBACCEL', '0')
+                putenv('SDL_VIDEODRIVER', 'fbcon')
+            pg.display.init()
+            pg.mouse.set_visible(False)
+            # returns the display surface
+            self.d = pg.display.set_mode((256, 64))
+            self.update_display = pg.display.update
         pg.font.init()
-        pg.mouse.set_visible(False)
-        self.d = pg.display.set_mode((256, 64))  # returns the display surface
 
         fnts = {
             't': ['UbuntuMono-Regular', 14],  # tiny
@@ -71,39 +90,95 @@ class VvmOled:
         for k, v in fnts.items():
             self.fnts[k] = pg.font.Font('misc/fonts/{}.ttf'.format(v[0]), v[1])
 
+        # Pre-rendered characters, key = (font, color, character)
+        # value = (glyph, width)
+        self.glyphs = {}
+
+        # Fields written since the last flush(), in drawing order
+        # list of (key, glyphs), key = (s, f, c, x, y, w, h)
+        self.frame = []
+
+        # Keys of the fields which are currently on the display
+        self.fields = set()
+
+        # on_result() writes to this pipe to wake up loop_forever()
+        self.wake_r, self.wake_w = pipe()
+        set_blocking(self.wake_r, False)
+        set_blocking(self.wake_w, False)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.wake_r, selectors.EVENT_READ)
+        self.wake()  # draw the first frame
+
+        # when the trigger timeout check needs to run again
+        self.t_wake = None
+
         if not args.test:
             self.dev_rot = InputDevice('/dev/input/event0')
             self.dev_push = InputDevice('/dev/input/event1')
+            self.sel.register(self.dev_rot, selectors.EVENT_READ)
+            self.sel.register(self.dev_push, selectors.EVENT_READ)
 
     def on_connect(self, client, userdata, flags, rc):
         log.info('MQTT connected %s %s', flags, rc)
         client.subscribe('vvm/#')
 
+    def wake(self):
+        ''' make loop_forever() draw a new frame '''
+        try:
+            write(self.wake_w, b'w')
+        except BlockingIOError:
+            # pipe is full, plenty of wake-ups pending already
+            pass
+
     def on_result(self, client, user, m):
         ''' convert mqtt payload to float and shove it into self.pvs '''
         try:
             if m.topic == 'vvm/results/trig_count':
                 self.trig_ts = time.time()
+                self.wake()
+
+            # binary float32 array, not shown on the OLED
+            if m.topic == 'vvm/results/trace':
+                return
 
             k = m.topic.split('/')[-1]
 
+            if k == 'batch':
+                return
+
+            if k == 'batch_ack':
+                # json object, take over the values of an applied batch
+                for k_, v in json.loads(m.payload)['applied'].items():
+                    self.pvs[k_] = v
+                self.wake()
+                return
+
             if k in self.pvs:
                 old_val = self.pvs[k]
                 t = type(old_val)
             else:
+                old_val = None
                 t = float
 
             if t is list:
+                is_changed = False
                 for i, val in enumerate(m.payload.split(b',')):
-                    old_val[i] = float(val)
+                    val = float(val)
+                    is_changed |= old_val[i] != val
+                    old_val[i] = val
             else:
                 self.pvs[k] = float(m.payload)
+                is_changed = old_val != self.pvs[k]
+
+            if is_changed:
+                self.wake()
         except Exception as e:
             log.exception(e)
 
     def write(self, x, y, s, f='s', bold=False, white=False):
         '''
         write text to OLED surface with a bit of formating
+        it is composed from cached glyphs and only drawn by flush()
 
         x, y is the upper left corner,
         s is a string to write
@@ -116,10 +191,67 @@ class VvmOled:
             f += 'bold'
         if white:
             c = (0xFF, ) * 3
-        fo = self.fnts[f]
-        sur = fo.render(s, True, c, (0, 0, 0))
-        self.d.blit(sur, (x, y))
-        return x + sur.get_width(), y + sur.get_height()
+        gs = [self.get_glyph(f, c, ch) for ch in s]
+        w = sum([gw for g, gw in gs])
+        h = self.fnts[f].get_height()
+        self.frame.append(((s, f, c, x, y, w, h), gs))
+        return x + w, y + h
+
+    def hline(self, y, c=(0x10, ) * 3, w=2):
+        ''' draw a horizontal line across the screen at y '''
+        self.frame.append((('', None, c, 0, y, self.d.get_width(), w), None))
+
+    def get_glyph(self, f, c, ch):
+        ''' returns cached (glyph, width) with character ch rendered on it '''
+        k = (f, c, ch)
+        g = self.glyphs.get(k)
+        if g is None:
+            sur = self.fnts[f].render(ch, True, c, (0, 0, 0))
+            w, h = sur.get_size()
+            if self.fb is not None:
+                sur = FbDisplay.from_rgb(pg.image.tostring(sur, 'RGB'), w, h)
+            g = (sur, w)
+            self.glyphs[k] = g
+        return g
+
+    def flush(self, full=False):
+        '''
+        blit all fields written since the last flush() to the OLED.
+        Only fields which changed, or which overlap a changed one,
+        are drawn and pushed to the display.
+        full: clear and re-draw everything
+        '''
+        frame, self.frame = self.frame, []
+        new = set([k for k, gs in frame])
+        if full:
+            self.d.fill((0x00, ) * 3)
+            dirty = [self.d.get_rect()]
+            old = set()
+        else:
+            # erase fields which vanished or changed
+            dirty = []
+            old = self.fields
+            for k in old - new:
+                rect = pg.Rect(k[-4:])
+                self.d.fill((0x00, ) * 3, rect)
+                dirty.append(rect)
+
+        for k, gs in frame:
+            rect = pg.Rect(k[-4:])
+            if k in old and rect.collidelist(dirty) < 0:
+                continue
+            if gs is None:
+                self.d.fill(k[2], rect)
+            else:
+                x = rect.x
+                for g, gw in gs:
+                    self.d.blit(g, (x, rect.y))
+                    x += gw
+            dirty.append(rect)
+
+        self.fields = new
+        if len(dirty) > 0:
+            self.update_display(dirty)
 
     def update_status(self):
         p = self.pvs
@@ -134,7 +266,14 @@ class VvmOled:
             'vvm_pulse_wait_acq',
             'vvm_pulse_wait_post'
         ]])
-        self.is_timed_out = trig_dt > max_dt and p['vvm_pulse_channel'] <= 3
+        is_pulsed = p['vvm_pulse_channel'] <= 3
+        self.is_timed_out = trig_dt > max_dt and is_pulsed
+
+        # Wake up again when the trigger is about to time out
+        if is_pulsed and not self.is_timed_out:
+            self.t_wake = self.trig_ts + max_dt
+        else:
+            self.t_wake = None
 
         if not self.args.test:
             set_led(not(
@@ -185,8 +324,8 @@ class VvmOled:
                 x, _ = self.write(x, y, '{:>5.1f} dBm  '.format(m))
 
         # horizontal lines
-        line(self.d, (0x10,) * 3, (0, 16), (255, 16), 2)
-        line(self.d, (0x10,) * 3, (0, 44), (255, 44), 2)
+        self.hline(16)
+        self.hline(44)
 
     def draw_pv_screen(self, page=0, MAX_LINES=4):
         ks = []
@@ -209,7 +348,32 @@ class VvmOled:
     def loop_forever(self):
         p = self.pvs
         page = 0
+        page_ = None
+        t_render = 0
+        n_frames = 0
+        t_frame = 0
         while True:
+            # ---------------------------------------------
+            #  Sleep until something needs to be redrawn
+            # ---------------------------------------------
+            if self.args.test:
+                # need to poll the pygame keyboard events
+                timeout = 1 / self.args.fps
+            elif self.t_wake is None:
+                timeout = None
+            else:
+                timeout = max(self.t_wake - time.time(), 0)
+
+            for key, _ in self.sel.select(timeout):
+                if key.fileobj is self.wake_r:
+                    read(self.wake_r, 4096)
+
+            # Limit the frame rate, values arriving meanwhile are merged
+            dt = t_frame + 1 / self.args.fps - time.time()
+            if dt > 0:
+                time.sleep(dt)
+            t_frame = time.time()
+
             # -----------------------
             #  Handle user input
             # -----------------------
@@ -233,17 +397,28 @@ class VvmOled:
             # ----------------------
             #  Draw on OLED
             # ----------------------
-            self.d.fill((0x00, ) * 3)
+            ts = time.perf_counter()
             if page == 0:
                 self.draw_main_screen()
             else:
                 self.draw_pv_screen(page - 1)
-
-            pg.display.update()
-
-            # Delay locked to the wall clock for more accurate cycle time
-            dt = 1 / self.args.fps
-            time.sleep(dt - time.time() % dt)
+            self.flush(page != page_)
+
+            # Report startup / render time to compare the backends
+            t_render += time.perf_counter() - ts
+            n_frames += 1
+            if page_ is None:
+                log.info('first frame after %.3f s', time.time() - T_START)
+            if n_frames >= 100:
+                if self.args.test:
+                    log.info(
+                        'render time: %.3f ms / frame, max. RSS: %d kB',
+                        t_render / n_frames * 1e3,
+                        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                    )
+                t_render = 0
+                n_frames = 0
+            page_ = page
 
     def handle_input(self):
         ''' returns encoder steps and button pushes '''
@@ -251,7 +426,7 @@ class VvmOled:
         btn = False
 
         # keyboard input to simulate encoder
-        for event in pg.event.get():
+        for event in (pg.event.get() if self.fb is None else []):
             log.debug(str(event))
             if event.type == pg.QUIT:
                 pg.quit()
@@ -308,7 +483,7 @@ def main():
     )
     parser.add_argument(
         '--fps', default=30.0, type=float,
-        help='Default frames per second'
+        help='Maximum frames per second'
     )
     parser.add_argument(
         '-v', '--verbose', action='store_true',
@@ -318,6 +493,11 @@ def main():
         '--test', action='store_true',
         help='Test mode. Open pygame window, show random numbers.'
     )
+    parser.add_argument(
+        '--fb', default=None,
+        help='Draw directly to this framebuffer device (try /dev/fb1) without '
+             'SDL. Can also be a regular file for testing.'
+    )
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
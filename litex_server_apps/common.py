@@ -15,7 +15,19 @@ def getId(r):
     return s
 
 
-def conLitexServer(csr_csv="build/csr.csv", port=1234):
+def conLitexServer(csr_csv="build/csr.csv", port=1234, udp_host=None):
+    '''
+    udp_host: talk etherbone over udp directly to litex_server_light
+    --udp on that host, instead of tcp to a litex_server on localhost
+    '''
+    if udp_host is not None:
+        from litex.tools.remote.comm_udp import CommUDP
+        r = CommUDP(udp_host, port, csr_csv=csr_csv, debug=False)
+        r.open()
+        print("Connected to {:s}:{:d} (udp)".format(udp_host, port))
+        print(getId(r))
+        return r
+
     for i in range(32):
         try:
             r = RemoteClient(csr_csv=csr_csv, debug=False, port=port + i)
@@ -6,10 +6,11 @@ fft'ed and plotted.
 """
 from numpy import *
 from matplotlib.pyplot import *
-from scipy.signal import periodogram
+from scipy.signal import periodogram, get_window
 import threading
 import argparse
-from common import conLitexServer
+import time
+from common import conLitexServer, unique_filename
 
 import sys
 sys.path.append("../linux_apps/")
@@ -17,8 +18,81 @@ from lib.csr_lib import CsrLibLegacyAdapter
 from lib.vvm_helpers import initLTC, getSamples, initSi570
 
 
+class SpectrumAverager:
+    '''
+    Averages power spectra like periodogram(window='hanning',
+    scaling='spectrum') does for single blocks, with O(1) work per block.
+
+    mode:
+        'linear': mean over the last n_avg blocks, from a ring of spectra
+                  and a running sum
+        'exp': exponential average with a time constant of n_avg blocks
+        'peak': peak hold since the last reset()
+    '''
+    MODES = ('linear', 'exp', 'peak')
+
+    def __init__(self, N, fs, n_avg=8, mode='linear', nfft=None):
+        if mode not in self.MODES:
+            raise ValueError('unknown mode: ' + mode)
+        self.mode = mode
+        self.n_avg = n_avg
+        if nfft is None:
+            nfft = N * 2
+        self.f = fft.rfftfreq(nfft, 1 / fs)
+
+        w = get_window('hann', N)
+        self.win = w
+        # scaling='spectrum', one sided: double all but DC and Nyquist
+        self.scale = full(len(self.f), 2 / sum(w)**2)
+        self.scale[0] /= 2
+        if nfft % 2 == 0:
+            self.scale[-1] /= 2
+
+        # zero padded fft input
+        self.x = zeros(nfft)
+        self.ring = zeros((n_avg, len(self.f)))
+        self.sum = zeros(len(self.f))
+        self.avg = zeros(len(self.f))
+        self.reset()
+
+    def reset(self):
+        self.i = 0
+        self.n = 0
+        self.sum[:] = 0
+
+    def update(self, y):
+        ''' add a block of N samples, returns the averaged spectrum '''
+        N = len(self.win)
+        self.x[:N] = y
+        self.x[:N] -= mean(y)
+        self.x[:N] *= self.win
+        P = abs(fft.rfft(self.x))**2
+        P *= self.scale
+
+        if self.mode == 'linear':
+            self.sum += P
+            if self.n == self.n_avg:
+                self.sum -= self.ring[self.i]
+            self.ring[self.i] = P
+            self.i = (self.i + 1) % self.n_avg
+            if self.n < self.n_avg:
+                self.n += 1
+            if self.i == 0:
+                # get rid of accumulated rounding errors now and then
+                self.sum[:] = self.ring.sum(0)
+            self.avg[:] = self.sum / self.n
+        elif self.n == 0:
+            self.avg[:] = P
+            self.n = 1
+        elif self.mode == 'exp':
+            self.avg += (P - self.avg) / self.n_avg
+        else:
+            maximum(self.avg, P, out=self.avg)
+        return self.avg
+
+
 class ScopeController:
-    def __init__(self, r):
+    def __init__(self, r, c, args):
         self._trigRequest = True
         self._trigLevelRequest = 0
         self._curTrigLevel = None
@@ -26,9 +100,13 @@ class ScopeController:
         self._forceTrig = False
         self.isRunning = True
         self.r = r
-        # last 32 blocks of samples for dumping to .npz file
-        self.rollBuffer_t = []
-        self.rollBuffer_f = []
+        self.c = c
+        self.args = args
+        # last AVG blocks of samples for dumping to .npz file
+        self.ring_t = zeros((args.AVG, args.N))
+        self.i_t = 0
+        self.n_t = 0
+        self.sa = SpectrumAverager(args.N, args.fs, args.AVG, args.mode)
 
 
     def forceTrig(self, e):
@@ -59,19 +137,17 @@ class ScopeController:
             self._forceTrig = False
         return False
 
-    def buf_append(buf, val):
-        if len(buf) >= args.AVG:
-            buf.pop(0)
-        else:
-            print("Buf:", len(buf))
-        buf.append(val)
+    def resetAvg(self, x):
+        self.sa.reset()
 
     def dumpNpz(self, x):
         fName = unique_filename("measurements/dump.npz")
-        savez_compressed(fName, dat=vstack(self.rollBuffer_t))
-        print("wrote {:} buffers to {:}".format(len(self.rollBuffer_t), fName))
-        self.rollBuffer_t.clear()
-        self.rollBuffer_f.clear()
+        # oldest block first
+        dat = roll(self.ring_t, -self.i_t, 0)[-self.n_t:]
+        savez_compressed(fName, dat=dat)
+        print("wrote {:} buffers to {:}".format(self.n_t, fName))
+        self.n_t = 0
+        self.sa.reset()
 
     def ani_thread(self):
         tReq = False
@@ -79,7 +155,7 @@ class ScopeController:
             tReq |= self.handleSettings()
 
             # wait while acquisition is running
-            if r.regs.acq_trig_csr.read() >= 1:
+            if self.r.regs.acq_trig_csr.read() >= 1:
                 # print('y', end='', flush=True)
                 time.sleep(0.2)
                 continue
@@ -91,23 +167,16 @@ class ScopeController:
                 continue
 
             # print('z', end='', flush=True)
-            yVect = getSamples(c, args.CH, args.N)
-            ScopeController.buf_append(
-                self.rollBuffer_t,
-                yVect
+            yVect = getSamples(
+                self.c, self.args.CH, self.args.N, self.args.pretrig,
+                self.args.acc
             )
-            f, Pxx = periodogram(
-                yVect,
-                args.fs,
-                window='hanning',
-                scaling='spectrum',
-                nfft=args.N * 2
-            )
-            ScopeController.buf_append(
-                self.rollBuffer_f,
-                Pxx
-            )
-            spect = 10 * log10(mean(self.rollBuffer_f, 0)) + 3
+            self.ring_t[self.i_t] = yVect
+            self.i_t = (self.i_t + 1) % self.args.AVG
+            if self.n_t < self.args.AVG:
+                self.n_t += 1
+            Pxx = self.sa.update(yVect)
+            spect = 10 * log10(Pxx) + 3
             lt.set_ydata(yVect)
             lf.set_ydata(spect)
             fig.canvas.draw_idle()
@@ -145,7 +214,7 @@ def plotNpz(fNames, labels=None, ax=None, fs=120e6, *args, **kwargs):
 
 
 def main():
-    global fig, lt, lf, r, c, args, rollBuffer_t
+    global fig, lt, lf
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
         "--N", default=1024, type=int, help="Number of samples per acquisition"
@@ -159,6 +228,18 @@ def main():
     parser.add_argument(
         "--fs", default=117.6e6, type=float, help="ADC sample rate [MHz]. Must match hello_LTC.py setting."
     )
+    parser.add_argument(
+        "--mode", default="linear", choices=SpectrumAverager.MODES,
+        help="Spectrum averaging over AVG buffers: linear, exponential or peak hold"
+    )
+    parser.add_argument(
+        "--pretrig", type=int,
+        help="Samples to show before the trigger (circular acquisition mode)"
+    )
+    parser.add_argument(
+        "--acc", default=1, type=int,
+        help="Sum this many captures in hardware (accumulate mode)"
+    )
     parser.add_argument(
         "--noinit", action='store_true', help="Do not initialize the hardware."
     )
@@ -175,18 +256,24 @@ def main():
         # initSi570(c, 117.6e6)  # Bitbanging over ethernet is too slow :(
         initLTC(c, False)
     r.regs.acq_trig_channel.write(args.CH)
+    r.regs.acq_acc_count.write(args.acc)
+    if args.pretrig is None:
+        r.regs.acq_trig_circular.write(0)
+    else:
+        depth = r.mems.sample0.size // 4
+        r.regs.acq_trig_post.write(depth - 1 - args.pretrig)
+        r.regs.acq_trig_circular.write(1)
 
     # ----------------------------------------------
     #  Setup Matplotlib
     # ----------------------------------------------
-    sc = ScopeController(r)
+    sc = ScopeController(r, c, args)
     fig, axs = subplots(2, 1, figsize=(10, 6))
     xVect = linspace(0, args.N / args.fs, args.N, endpoint=False)
     yVect = zeros_like(xVect)
     yVect[:2] = [-1, 1]
-    f, Pxx = periodogram(yVect, args.fs, nfft=args.N * 2)
     lt, = axs[0].plot(xVect * 1e9, yVect, drawstyle='steps-post')
-    lf, = axs[1].plot(f / 1e6, Pxx)
+    lf, = axs[1].plot(sc.sa.f / 1e6, zeros_like(sc.sa.f))
     axs[0].set_xlabel("Time [ns]")
     axs[1].set_xlabel("Frequency [MHz]")
     axs[0].set_ylabel("ADC value [FS]")
@@ -215,6 +302,10 @@ def main():
     bDump = Button(axes([0.25, 0.01, 0.2, 0.05]), 'Dump .npz')
     bDump.on_clicked(sc.dumpNpz)
 
+    # Restart averaging, for peak hold
+    bReset = Button(axes([0.45, 0.01, 0.2, 0.05]), 'Reset avg.')
+    bReset.on_clicked(sc.resetAvg)
+
     threading.Thread(target=sc.ani_thread).start()
     show()
     sc.isRunning = False
@@ -13,6 +13,9 @@ from numpy import *
 from matplotlib.pyplot import *
 from matplotlib.animation import FuncAnimation
 import argparse
+import threading
+import time
+from collections import deque
 from common import conLitexServer, unique_filename
 
 import sys
@@ -23,13 +26,30 @@ from lib.vvm_helpers import initLTC, initSi570, meas_f_ref, twos_comps, \
     CalHelper, getNyquist
 
 
-def main():
-    global isInverted
+def minmax(dat, step):
+    '''
+    min / max decimation of the columns of dat (N, n_col) for plotting.
+    2 points for each block of step rows, such that short spikes stay
+    visible. Returns (2 * ceil(N / step), n_col)
+    '''
+    N, n_col = dat.shape
+    n_blk = -(-N // step)
+    d = ones((n_blk * step, n_col)) * nan
+    d[:N] = dat
+    d = d.reshape(n_blk, step, n_col)
+    out = empty((n_blk, 2, n_col))
+    # ignore NaNs of the empty part, without all-NaN warnings
+    out[:, 0] = fmin.reduce(d, 1)
+    out[:, 1] = fmax.reduce(d, 1)
+    return out.reshape(-1, n_col)
+
 
+def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
         "--N", default=1024, type=int,
-        help="Number of points to plot"
+        help="Number of points to plot. Above 2000, the plot shows min / max "
+             "of each block of N / 1000 points, the .npz dump has all"
     )
     parser.add_argument(
         "--deci", default=100, type=int,
@@ -55,13 +75,21 @@ def main():
         "--f_meas", default=499.6e6, type=float,
         help="Frequency of signal under test [Hz]."
     )
+    parser.add_argument(
+        "--interval", default=0.01, type=float,
+        help="Interval between register reads [s]"
+    )
+    parser.add_argument(
+        "--udp", metavar="HOST",
+        help="Connect over udp to litex_server_light --udp on HOST"
+    )
     args = parser.parse_args()
 
 
     # ----------------------------------------------
     #  Init hardware
     # ----------------------------------------------
-    r = conLitexServer('../gateware/build/csr.csv')
+    r = conLitexServer('../gateware/build/csr.csv', udp_host=args.udp)
     c = CsrLibLegacyAdapter(r)
 
     # ----------------------------------------------
@@ -83,6 +111,9 @@ def main():
     # This will change the scaling!
     r.regs.vvm_ddc_shift.write(args.ddcshift)
 
+    # deci and shift are shadow registers, make them effective
+    r.regs.vvm_ddc_commit.write(1)
+
     # IIR result averaging filter smoothing factor (0 - 15)
     r.regs.vvm_iir.write(args.iir)
 
@@ -92,22 +123,76 @@ def main():
     print('bw', args.fs / args.deci)
     print('iir_shift', r.regs.vvm_iir.read())
 
+    # ----------------------------------------------
+    #  Tune the DDC to f_meas
+    # ----------------------------------------------
+    # f_ref = meas_f_ref(c, args.fs)
+    f_ref = args.f_meas
+    f_tune, isInverted = getNyquist(f_ref, args.fs)
+    ftw = int((f_tune / args.fs) * 2**32)
+    for i, mult in enumerate((1, 1, 1, 1)):
+        ftw_ = int(ftw * mult)
+        reg = 'vvm_ddc_dds_ftw{}'.format(i)
+        c.write_reg(reg, ftw_)
+        # print(reg, ftw_, c.read_reg(reg))
+        if i > 0:
+            reg = 'vvm_pp_mult{}'.format(i)
+            c.write_reg(reg, mult)
+            # print(reg, mult, c.read_reg(reg))
+
+    print("f_ref at {:6f} MHz".format(
+        ftw_ / 2**32 * meas_f_ref(c, args.fs) / 1e6
+    ))
+    r.regs.vvm_ddc_commit.write(1)
+    r.regs.vvm_ddc_dds_ctrl.write(0x3)  # FTW_UPDATE, RST
+
+    # ----------------------------------------------
+    #  Acquisition thread
+    # ----------------------------------------------
+    # (mags, phases) tuples. deque.append() / popleft() are thread safe
+    q = deque(maxlen=args.N)
+    isRunning = True
+
+    def acq_thread():
+        while isRunning:
+            ts = time.perf_counter()
+            mags = cal.get_mags(args.f_meas, args.ddcshift)
+            phs = cal.get_phases(args.f_meas)
+            if isInverted:
+                phs *= -1
+            phs[mags[1:] < -50] = NaN
+            q.append((mags, phs))
+            dt = args.interval - (time.perf_counter() - ts)
+            if dt > 0:
+                time.sleep(dt)
+
     # ----------------------------------------------
     #  Setup Matplotlib
     # ----------------------------------------------
     fig, axs = subplots(2, sharex=True, figsize=(9, 7))
+    # Ring buffers, written at i_w. The plot sweeps over them
+    # like an oscilloscope in roll mode, without moving any data.
     datms = ones((args.N, 4)) * NaN
     datps = ones((args.N, 3)) * NaN
+    i_w = 0
+    # Plot at most ~2000 points per line, min / max of blocks of step points
+    step = 1 if args.N <= 2000 else -(-args.N // 1000)
+
+    def decimate(dat):
+        return dat if step == 1 else minmax(dat, step)
+
+    xs = arange(len(decimate(datms))) * step / (1 if step == 1 else 2)
     lms = []
     lps = []
-    for i in range(datms.shape[1]):
-        l, = axs[0].plot([], [], label="MAG{}".format(i))
+    for i, y in enumerate(decimate(datms).T):
+        l, = axs[0].plot(xs, y, label="MAG{}".format(i), animated=True)
         lms.append(l)
 
     next(axs[1]._get_lines.prop_cycler)
-    for i in range(datps.shape[1]):
-        l, = axs[1].plot([], [], label="PHS{}".format(i + 1))
+    for i, y in enumerate(decimate(datps).T):
+        l, = axs[1].plot(xs, y, label="PHS{}".format(i + 1), animated=True)
         lps.append(l)
+    cursors = [ax.axvline(0, color='k', lw=0.5, animated=True) for ax in axs]
 
     axs[0].set_ylim(-80, 0)
     axs[0].set_ylabel("Power [dBm]")
@@ -119,59 +204,55 @@ def main():
     ax.set_ylabel("Phase [deg]")
     fig.tight_layout()
 
-    isInverted = False
+    # render time statistics
+    t_upd = [0, 0, time.perf_counter()]
 
     def upd(frm):
-        global isInverted
-        datms[:] = roll(datms, -1, 0)
-        datps[:] = roll(datps, -1, 0)
-
-        mags = cal.get_mags(args.f_meas, args.ddcshift)
-        datms[-1, :] = mags
-        for i in range(4):
-            lms[i].set_data(arange(datms.shape[0]), datms[:, i])
-
-        datps[-1, :] = cal.get_phases(args.f_meas)
-        if isInverted:
-            datps[-1, :] *= -1
-        for i, p in enumerate(datps[-1, :]):
-            if mags[i + 1] < -50:
-                datps[-1, i] = NaN
-            lps[i].set_data(arange(datps.shape[0]), datps[:, i])
-
-        # if (frm % 100) == 0:
-        if frm == 0:
-            # f_ref = meas_f_ref(c, args.fs)
-            f_ref = args.f_meas
-            f_tune, isInverted = getNyquist(f_ref, args.fs)
-            ftw = int((f_tune / args.fs) * 2**32)
-            for i, mult in enumerate((1, 1, 1, 1)):
-                ftw_ = int(ftw * mult)
-                reg = 'vvm_ddc_dds_ftw{}'.format(i)
-                c.write_reg(reg, ftw_)
-                # print(reg, ftw_, c.read_reg(reg))
-                if i > 0:
-                    reg = 'vvm_pp_mult{}'.format(i)
-                    c.write_reg(reg, mult)
-                    # print(reg, mult, c.read_reg(reg))
-
-            print("f_ref at {:6f} MHz".format(
-                ftw_ / 2**32 * meas_f_ref(c, args.fs) / 1e6
-            ))
-            r.regs.vvm_ddc_dds_ctrl.write(0x2 | (frm == 0))  # FTW_UPDATE, RST
+        nonlocal i_w
+        ts = time.perf_counter()
+        # drain the queue into the ring buffers
+        while len(q) > 0:
+            mags, phs = q.popleft()
+            datms[i_w] = mags
+            datps[i_w] = phs
+            i_w = (i_w + 1) % args.N
 
+        for l, y in zip(lms, decimate(datms).T):
+            l.set_ydata(y)
+        for l, y in zip(lps, decimate(datps).T):
+            l.set_ydata(y)
+        for cursor in cursors:
+            cursor.set_xdata([i_w, i_w])
+
+        t_upd[0] += time.perf_counter() - ts
+        t_upd[1] += 1
+        if t_upd[1] >= 100:
+            dt = time.perf_counter() - t_upd[2]
+            print("upd(): {:.2f} ms, {:.1f} fps".format(
+                t_upd[0] / t_upd[1] * 1e3, t_upd[1] / dt
+            ))
+            t_upd[:] = [0, 0, time.perf_counter()]
+        return lms + lps + cursors
 
     def dumpNpz(x):
         fName = unique_filename("measurements/vvm_dump.npz")
-        savez_compressed(fName, datms=datms, datps=datps)
+        # oldest measurement first
+        savez_compressed(
+            fName,
+            datms=roll(datms, -i_w, 0),
+            datps=roll(datps, -i_w, 0)
+        )
         print("wrote {:} measurements to {:}".format(datms.shape[0], fName))
 
     # Buffer dump button
     bDump = Button(axes([0.005, 0.005, 0.1, 0.04]), 'Dump .npz')
     bDump.on_clicked(dumpNpz)
 
-    ani = FuncAnimation(fig, upd, interval=50)
+    threading.Thread(target=acq_thread, daemon=True).start()
+    ani = FuncAnimation(fig, upd, interval=50, blit=True)
     show()
+    isRunning = False
+
 
 if __name__ == '__main__':
     main()